@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+    cache.py
+    RAPIDpy
+
+    License: BSD-3-Clause
+"""
+import hashlib
+import os
+import re
+from shutil import copy2, rmtree
+from tempfile import mkdtemp, mkstemp
+
+from .helper_functions import log
+
+# namelist files written by RAPID instead of read
+RAPID_OUTPUT_FILE_PARAMETERS = ('Qout_file', 'Qfinal_file')
+
+
+def _link_or_copy(source_file, destination_file):
+    """
+    Hardlink the file if possible, otherwise copy it
+    """
+    try:
+        os.remove(destination_file)
+    except OSError:
+        pass
+    try:
+        os.link(source_file, destination_file)
+    except (AttributeError, OSError):
+        copy2(source_file, destination_file)
+
+
+class RAPIDResultCache(object):
+    """
+    This class keeps the output of RAPID simulations in a directory so
+    that running the same simulation again copies the output instead of
+    running RAPID. A simulation is the same if the rapid_namelist file
+    generated for it has the same parameters and the input files in it
+    have the same contents. The least recently used simulations are
+    removed from the cache when it is larger than *max_size*.
+
+    .. warning:: With *use_hardlinks*, the output files are hardlinks to
+                 the files in the cache. Changing them in place also
+                 changes the cache. Replacing them, as
+                 :meth:`~RAPIDpy.rapid.RAPID.make_output_cf_compliant`
+                 does, is safe.
+
+    Attributes
+    ----------
+    cache_directory: str
+        Directory to keep the cached output in.
+    max_size: int, optional
+        Maximum size of the cache in bytes. Default is 10 GB.
+    use_hardlinks: bool, optional
+        Hardlink the output files to the cache instead of copying them
+        when possible. Default is True.
+
+
+    Example:
+
+    .. code:: python
+
+        from datetime import datetime
+        from RAPIDpy import RAPID
+        from RAPIDpy.cache import RAPIDResultCache
+
+        rapid_cache = RAPIDResultCache('../rapid-io/cache',
+                                       max_size=100*1024**3)
+        rapid_manager = RAPID(
+            rapid_executable_location='~/work/rapid/src/rapid',
+            ZS_TauR=3*3600,
+            ZS_dtR=15*60,
+            ZS_TauM=365*24*3600,
+            ZS_dtM=3*3600,
+            rapid_connect_file='../rapid-io/input/rapid_connect.csv',
+            Vlat_file='../rapid-io/input/m3_riv.nc',
+            riv_bas_id_file='../rapid-io/input/riv_bas_id.csv',
+            k_file='../rapid-io/input/k.csv',
+            x_file='../rapid-io/input/x.csv',
+            Qout_file='../rapid-io/output/Qout.nc'
+        )
+        rapid_manager.update_reach_number_data()
+
+        rapid_cache.run(rapid_manager)
+        rapid_cache.make_output_cf_compliant(
+            rapid_manager,
+            simulation_start_datetime=datetime(1980, 1, 1),
+            comid_lat_lon_z_file='../rapid-io/input/comid_lat_lon_z.csv')
+    """
+    def __init__(self, cache_directory, max_size=10*1024**3,
+                 use_hardlinks=True):
+        self.cache_directory = cache_directory
+        self.max_size = max_size
+        self.use_hardlinks = use_hardlinks
+        self._file_digest_dict = {}
+        if not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+
+    def _get_file_digest(self, file_path):
+        """
+        Get the SHA-256 digest of the contents of a file. The digest is
+        kept while the size and modification time of the file are the same.
+        """
+        file_stat = os.stat(file_path)
+        file_key = (os.path.abspath(file_path), file_stat.st_size,
+                    file_stat.st_mtime)
+        if file_key not in self._file_digest_dict:
+            file_hash = hashlib.sha256()
+            with open(file_path, 'rb') as hash_file:
+                for file_block in iter(lambda: hash_file.read(1024**2), b''):
+                    file_hash.update(file_block)
+            self._file_digest_dict[file_key] = file_hash.hexdigest()
+        return self._file_digest_dict[file_key]
+
+    def _get_key(self, key_line_list):
+        """
+        Get the cache key from lines of text
+        """
+        return hashlib.sha256("\n".join(key_line_list)
+                              .encode('utf-8')).hexdigest()
+
+    def get_run_key(self, rapid_manager, rapid_namelist_file=""):
+        """
+        Get the cache key of a RAPID simulation from the rapid_namelist
+        file generated for it with the paths of the input files replaced
+        by the digests of their contents.
+
+        Parameters
+        ----------
+        rapid_manager: :obj:`~RAPIDpy.rapid.RAPID`
+            RAPID manager with the parameters of the simulation.
+        rapid_namelist_file: str, optional
+            Path of namelist file to use in the simulation.
+
+        Returns
+        -------
+        str:
+            The cache key of the simulation.
+        """
+        file_handle, temp_namelist_file = mkstemp(prefix='rapid_namelist_')
+        os.close(file_handle)
+        try:
+            if not rapid_namelist_file or \
+                    not os.path.exists(rapid_namelist_file):
+                rapid_manager.generate_namelist_file(temp_namelist_file)
+            else:
+                rapid_manager.update_namelist_file(rapid_namelist_file,
+                                                   temp_namelist_file)
+            with open(temp_namelist_file) as namelist_file:
+                namelist_line_list = namelist_file.read().splitlines()
+        finally:
+            os.remove(temp_namelist_file)
+
+        key_line_list = ["ksp_type = {0}".format(rapid_manager._ksp_type)]
+        for line in namelist_line_list:
+            file_match = re.match(r"\s*(\w+_file)\s*=\s*'(.*)'\s*$", line)
+            if file_match:
+                attr, file_path = file_match.groups()
+                if attr in RAPID_OUTPUT_FILE_PARAMETERS:
+                    continue
+                file_path = getattr(rapid_manager, attr, "") or file_path
+                if os.path.isfile(file_path):
+                    line = "{0} = {1}".format(attr,
+                                              self._get_file_digest(file_path))
+            key_line_list.append(line)
+        return self._get_key(key_line_list)
+
+    def _get_entry_directory(self, cache_key):
+        """
+        Get the directory of a cache entry
+        """
+        return os.path.join(self.cache_directory, cache_key)
+
+    def _restore(self, cache_key, output_file_dict):
+        """
+        Copy the files of a cache entry to the output files.
+        Returns False if the entry is not in the cache.
+        """
+        entry_directory = self._get_entry_directory(cache_key)
+        if not os.path.isdir(entry_directory):
+            return False
+        for name in output_file_dict:
+            if not os.path.exists(os.path.join(entry_directory, name)):
+                return False
+        for name, output_file in output_file_dict.items():
+            cache_file = os.path.join(entry_directory, name)
+            if self.use_hardlinks:
+                _link_or_copy(cache_file, output_file)
+            else:
+                copy2(cache_file, output_file)
+        # mark as recently used
+        os.utime(entry_directory, None)
+        return True
+
+    def _store(self, cache_key, output_file_dict):
+        """
+        Add the output files to the cache and remove the least
+        recently used entries if the cache is too large
+        """
+        entry_directory = self._get_entry_directory(cache_key)
+        temp_entry_directory = mkdtemp(prefix='.{0}_'.format(cache_key),
+                                       dir=self.cache_directory)
+        for name, output_file in output_file_dict.items():
+            cache_file = os.path.join(temp_entry_directory, name)
+            if self.use_hardlinks:
+                _link_or_copy(output_file, cache_file)
+            else:
+                copy2(output_file, cache_file)
+        rmtree(entry_directory, ignore_errors=True)
+        try:
+            os.rename(temp_entry_directory, entry_directory)
+        except OSError:
+            # another process added the same entry
+            rmtree(temp_entry_directory, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used simulations from the cache until
+        it is not larger than *max_size*.
+        """
+        entry_list = []
+        cache_size = 0
+        for cache_key in os.listdir(self.cache_directory):
+            entry_directory = self._get_entry_directory(cache_key)
+            if cache_key.startswith('.') or \
+                    not os.path.isdir(entry_directory):
+                continue
+            entry_size = sum(os.path.getsize(os.path.join(entry_directory,
+                                                          name))
+                             for name in os.listdir(entry_directory))
+            entry_list.append((os.path.getmtime(entry_directory),
+                               entry_size, entry_directory))
+            cache_size += entry_size
+
+        for _, entry_size, entry_directory in sorted(entry_list):
+            if cache_size <= self.max_size:
+                break
+            rmtree(entry_directory, ignore_errors=True)
+            cache_size -= entry_size
+
+    def run(self, rapid_manager, rapid_namelist_file="", **kwargs):
+        """
+        Copy the output of the simulation from the cache if it is in
+        the cache, otherwise run RAPID and add the output to the cache.
+
+        Parameters
+        ----------
+        rapid_manager: :obj:`~RAPIDpy.rapid.RAPID`
+            RAPID manager with the parameters of the simulation.
+        rapid_namelist_file: str, optional
+            Path of namelist file to use in the simulation.
+        **kwargs: dict
+            Other arguments of :meth:`~RAPIDpy.rapid.RAPID.run`.
+
+        Returns
+        -------
+        bool:
+            True if the output was copied from the cache.
+        """
+        cache_key = self.get_run_key(rapid_manager, rapid_namelist_file)
+        output_file_dict = {
+            'Qout_file': rapid_manager.Qout_file,
+        }
+        if str(rapid_manager.BS_opt_Qfinal).lower() == 'true' and \
+                rapid_manager.Qfinal_file:
+            output_file_dict['Qfinal_file'] = rapid_manager.Qfinal_file
+
+        if self._restore(cache_key, output_file_dict):
+            log("Copied RAPID output from cache to {0} ..."
+                .format(rapid_manager.Qout_file),
+                "INFO")
+            return True
+
+        # output files may be hardlinks to other entries of the cache
+        # that RAPID would overwrite
+        for output_file in output_file_dict.values():
+            try:
+                os.remove(output_file)
+            except OSError:
+                pass
+        rapid_manager.run(rapid_namelist_file=rapid_namelist_file, **kwargs)
+        self._store(cache_key, output_file_dict)
+        return False
+
+    def make_output_cf_compliant(self, rapid_manager,
+                                 simulation_start_datetime,
+                                 comid_lat_lon_z_file="",
+                                 project_name="Normal RAPID project"):
+        """
+        Copy the CF compliant output from the cache if it is in the
+        cache, otherwise run
+        :meth:`~RAPIDpy.rapid.RAPID.make_output_cf_compliant`
+        and add the output to the cache.
+
+        Parameters
+        ----------
+        rapid_manager: :obj:`~RAPIDpy.rapid.RAPID`
+            RAPID manager with the Qout_file of the simulation.
+        simulation_start_datetime: datetime
+            Datetime object with the start date of the simulation.
+        comid_lat_lon_z_file: str, optional
+            Path to the *comid_lat_lon_z.csv* file. If none given,
+            spatial information will be skipped.
+        project_name: str, optional
+            Name of project to add to the RAPID output file.
+
+        Returns
+        -------
+        bool:
+            True if the output was copied from the cache.
+        """
+        key_line_list = [
+            "convert_to_cf",
+            "simulation_start_datetime = {0}"
+            .format(simulation_start_datetime.isoformat()),
+            "project_name = {0}".format(project_name),
+            "ZS_TauR = {0}".format(rapid_manager.ZS_TauR),
+        ]
+        for attr, file_path in (
+                ('Qout_file', rapid_manager.Qout_file),
+                ('Qinit_file', rapid_manager.Qinit_file),
+                ('rapid_connect_file', rapid_manager.rapid_connect_file),
+                ('comid_lat_lon_z_file', comid_lat_lon_z_file)):
+            if file_path and os.path.isfile(file_path):
+                file_path = self._get_file_digest(file_path)
+            key_line_list.append("{0} = {1}".format(attr, file_path))
+        cache_key = self._get_key(key_line_list)
+        output_file_dict = {
+            'Qout_file': rapid_manager.Qout_file,
+        }
+
+        if self._restore(cache_key, output_file_dict):
+            log("Copied CF compliant RAPID output from cache to {0} ..."
+                .format(rapid_manager.Qout_file),
+                "INFO")
+            return True
+
+        rapid_manager.make_output_cf_compliant(
+            simulation_start_datetime=simulation_start_datetime,
+            comid_lat_lon_z_file=comid_lat_lon_z_file,
+            project_name=project_name)
+        self._store(cache_key, output_file_dict)
+        return False
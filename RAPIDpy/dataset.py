@@ -42,11 +42,12 @@ def compare_qout_files(dataset1_path, dataset2_path):
             " Reordering data for comparison.",
             "WARNING")
 
-        d2_reordered_river_index_list = []
-        for rivid in d1.get_river_id_array():
-            reordered_index = np.where(d2.get_river_id_array() == rivid)[0][0]
-            d2_reordered_river_index_list.append(reordered_index)
-        d2_reordered_qout = d2.get_qout_index(d2_reordered_river_index_list)
+        d2_reordered_river_index_array, river_id_found_array = \
+            d2.get_river_index_array(d1.get_river_id_array())
+        if not river_id_found_array.all():
+            log("COMID/rivid input not the same.",
+                "ERROR")
+        d2_reordered_qout = d2.get_qout_index(d2_reordered_river_index_array)
     else:
         d2_reordered_qout = d2.get_qout()
 
@@ -224,6 +225,11 @@ class RAPIDDataset(object):
         self.datetime_simulation_start = datetime_simulation_start
         self.simulation_time_step_seconds = simulation_time_step_seconds
 
+        # river ID lookup read once from the file when needed
+        self._river_id_array = None
+        self._sorted_river_id_array = None
+        self._river_id_sort_index = None
+
     def __enter__(self):
         return self
 
@@ -539,6 +545,7 @@ class RAPIDDataset(object):
     def get_river_id_array(self):
         """
         This method returns the river ID array for this file.
+        It is read from the file once and kept, do not modify it.
 
         Returns
         -------
@@ -555,7 +562,64 @@ class RAPIDDataset(object):
                 river_ids = qout_nc.get_river_id_array()
 
         """
-        return self.qout_nc.variables[self.river_id_variable][:]
+        if self._river_id_array is None:
+            self._river_id_array = \
+                self.qout_nc.variables[self.river_id_variable][:]
+        return self._river_id_array
+
+    def get_river_index_array(self, river_id_array):
+        """
+        This method retrieves the river index in the netCDF
+        dataset of each river ID with a binary search of
+        the sorted river IDs of the file.
+
+        Parameters
+        ----------
+        river_id_array: list or :obj:`numpy.array`
+            Array of river ID's for the river segments you want the index of.
+
+        Returns
+        -------
+        :obj:`numpy.array`
+            The index of each river ID in the file (0 if not found).
+        :obj:`numpy.array`
+            Boolean array that is True where the river ID was found.
+
+
+        Example::
+
+            from RAPIDpy import RAPIDDataset
+
+            path_to_rapid_qout = '/path/to/Qout.nc'
+            river_id_array = [53458, 53459]
+
+            with RAPIDDataset(path_to_rapid_qout) as qout_nc:
+                river_index_array, river_id_found_array = \
+                    qout_nc.get_river_index_array(river_id_array)
+
+        """
+        if self._sorted_river_id_array is None:
+            river_id_array_file = np.asarray(self.get_river_id_array())
+            # stable sort for the first index of repeated river IDs
+            self._river_id_sort_index = \
+                np.argsort(river_id_array_file, kind='mergesort')
+            self._sorted_river_id_array = \
+                river_id_array_file[self._river_id_sort_index]
+
+        river_id_array = np.asarray(river_id_array)
+        if self._sorted_river_id_array.size == 0:
+            return (np.zeros(river_id_array.shape, dtype=np.int64),
+                    np.zeros(river_id_array.shape, dtype=bool))
+
+        sorted_index_array = np.minimum(
+            np.searchsorted(self._sorted_river_id_array, river_id_array),
+            self._sorted_river_id_array.size - 1)
+        river_id_found_array = \
+            self._sorted_river_id_array[sorted_index_array] == river_id_array
+        river_index_array = np.where(
+            river_id_found_array,
+            self._river_id_sort_index[sorted_index_array], 0)
+        return river_index_array, river_id_found_array
 
     def get_river_index(self, river_id):
         """
@@ -584,11 +648,12 @@ class RAPIDDataset(object):
                 river_index = qout_nc.get_river_index(river_id)
 
         """
-        try:
-            return np.where(self.get_river_id_array() == river_id)[0][0]
-        except IndexError:
+        river_index_array, river_id_found_array = \
+            self.get_river_index_array([river_id])
+        if not river_id_found_array[0]:
             raise IndexError("ERROR: River ID {0} not found in dataset "
                              "...".format(river_id))
+        return river_index_array[0]
 
     def get_subset_riverid_index_list(self, river_id_list):
         """
@@ -612,28 +677,23 @@ class RAPIDDataset(object):
             An array of the missing river ids.
 
         """
-        netcdf_river_indices_list = []
-        valid_river_ids = []
-        missing_river_ids = []
-        for river_id in river_id_list:
-            # get where streamids are in netcdf file
-            try:
-                netcdf_river_indices_list \
-                    .append(self.get_river_index(river_id))
-                valid_river_ids.append(river_id)
-            except IndexError:
-                log("ReachID {0} not found in netCDF dataset."
-                    " Skipping ...".format(river_id),
-                    "WARNING")
-                missing_river_ids.append(river_id)
+        river_id_list = np.array(river_id_list)
+        netcdf_river_indices_list, river_id_found_array = \
+            self.get_river_index_array(river_id_list)
+        missing_river_ids = river_id_list[~river_id_found_array]
+        for river_id in missing_river_ids:
+            log("ReachID {0} not found in netCDF dataset."
+                " Skipping ...".format(river_id),
+                "WARNING")
 
-        np_valid_river_indices_list = np.array(netcdf_river_indices_list)
-        np_valid_river_ids = np.array(valid_river_ids)
+        np_valid_river_indices_list = \
+            netcdf_river_indices_list[river_id_found_array]
+        np_valid_river_ids = river_id_list[river_id_found_array]
         sorted_indexes = np.argsort(np_valid_river_indices_list)
 
         return(np_valid_river_indices_list[sorted_indexes],
                np_valid_river_ids[sorted_indexes],
-               np.array(missing_river_ids))
+               missing_river_ids)
 
     def get_qout(self,
                  river_id_array=None,
@@ -723,6 +783,9 @@ class RAPIDDataset(object):
                 river_id_array = [river_id_array]
             riverid_index_list_subset = \
                 self.get_subset_riverid_index_list(river_id_array)[0]
+            if riverid_index_list_subset.size == 0:
+                raise IndexError("ERROR: River IDs {0} not found in dataset "
+                                 "...".format(river_id_array))
 
         return self.get_qout_index(riverid_index_list_subset,
                                    date_search_start,
@@ -0,0 +1,546 @@
+# -*- coding: utf-8 -*-
+"""
+    decomposition.py
+    RAPIDpy
+
+    License: BSD-3-Clause
+"""
+from copy import deepcopy
+import heapq
+import multiprocessing
+import os
+import re
+
+from netCDF4 import Dataset
+import numpy as np
+
+from .helper_functions import log, open_csv
+from .scheduler import RAPIDScheduler
+
+
+def get_outlet_index_array(river_id_array, downstream_id_array):
+    """
+    Get the index of the outlet of each river of a network. The outlet
+    is the river the water of the river reaches where the river
+    downstream is not in the network.
+
+    Parameters
+    ----------
+    river_id_array: :obj:`numpy.array`
+        The river IDs (first column of the rapid_connect file).
+    downstream_id_array: :obj:`numpy.array`
+        The river ID downstream of each river (second column of the
+        rapid_connect file).
+
+    Returns
+    -------
+    :obj:`numpy.array`
+        The index of the outlet of each river in *river_id_array*.
+    """
+    sort_index = np.argsort(river_id_array)
+    downstream_sort_index = np.searchsorted(river_id_array[sort_index],
+                                            downstream_id_array)
+    downstream_sort_index[downstream_sort_index >= river_id_array.size] = 0
+    outlet_index_array = sort_index[downstream_sort_index]
+    is_outlet = river_id_array[outlet_index_array] != downstream_id_array
+    outlet_index_array[is_outlet] = np.where(is_outlet)[0]
+
+    # follow the rivers downstream doubling the distance every time
+    for _ in range(max(1, int(np.ceil(np.log2(max(river_id_array.size,
+                                                  2))))) + 1):
+        next_outlet_index_array = outlet_index_array[outlet_index_array]
+        if (next_outlet_index_array == outlet_index_array).all():
+            return outlet_index_array
+        outlet_index_array = next_outlet_index_array
+
+    log("The river network has a loop ...",
+        "ERROR")
+
+
+def group_outlet_trees(outlet_index_array, num_groups, size_array=None):
+    """
+    Divide the rivers of a network into groups of whole outlet trees
+    (an outlet with all of the rivers upstream of it) with about the
+    same number of rivers in each group. The largest trees are added
+    first, each to the group with the fewest rivers.
+
+    Parameters
+    ----------
+    outlet_index_array: :obj:`numpy.array`
+        The index of the outlet of each river
+        (See: :func:`get_outlet_index_array`).
+    num_groups: int
+        Number of groups to divide the rivers into.
+    size_array: :obj:`numpy.array`, optional
+        Size of each river to balance the groups by.
+        Default is one for each river.
+
+    Returns
+    -------
+    :obj:`numpy.array`
+        The group index of each river. Groups without any rivers are
+        only left when there are fewer trees than groups.
+    """
+    if size_array is None:
+        size_array = np.ones(outlet_index_array.size)
+    outlet_array, tree_index_array = np.unique(outlet_index_array,
+                                               return_inverse=True)
+    tree_size_array = np.bincount(tree_index_array.ravel(),
+                                  weights=size_array,
+                                  minlength=outlet_array.size)
+
+    group_heap = [(0, group_index) for group_index in range(num_groups)]
+    tree_group_array = np.zeros(outlet_array.size, dtype=int)
+    # largest first and in the order of the outlets for ties
+    for tree_index in np.argsort(-tree_size_array, kind='mergesort'):
+        group_size, group_index = heapq.heappop(group_heap)
+        tree_group_array[tree_index] = group_index
+        heapq.heappush(group_heap,
+                       (group_size + tree_size_array[tree_index],
+                        group_index))
+    return tree_group_array[tree_index_array.ravel()]
+
+
+def _read_csv_lines(csv_file, header=False):
+    """
+    Read the lines of a CSV file with the header line separate
+    """
+    with open_csv(csv_file) as csv_con:
+        csv_lines = [csv_line for csv_line in csv_con if csv_line.strip()]
+    if header:
+        return csv_lines[:1], csv_lines[1:]
+    return [], csv_lines
+
+
+def _write_csv_lines(csv_file, header_lines, csv_lines, line_index_array):
+    """
+    Write the header and a subset of the lines of a CSV file
+    """
+    with open_csv(csv_file, 'w') as csv_con:
+        csv_con.writelines(header_lines)
+        csv_con.writelines(csv_lines[line_index] for line_index
+                           in line_index_array)
+
+
+def _get_first_column(csv_lines):
+    """
+    Get the integer IDs in the first column of CSV lines
+    """
+    return np.array([int(float(csv_line.split(",")[0]))
+                     for csv_line in csv_lines], dtype=np.int64)
+
+
+def _find_input_files(input_directory, pattern, required=True):
+    """
+    Find the files in the input directory matching the pattern
+    ignoring case
+    """
+    file_list = [file_name for file_name in
+                 sorted(os.listdir(input_directory))
+                 if re.search(pattern, file_name, re.IGNORECASE)]
+    if not file_list and required:
+        log("{0} not found in {1} ...".format(pattern, input_directory),
+            "ERROR")
+    return file_list
+
+
+def _find_input_file(input_directory, pattern):
+    """
+    Get the path of the file in the input directory matching the
+    pattern ignoring case
+    """
+    return os.path.join(input_directory,
+                        _find_input_files(input_directory, pattern)[0])
+
+
+def decompose_rapid_input_directory(rapid_input_directory,
+                                    output_directory,
+                                    num_groups):
+    """
+    Divide the river network of a RAPID input directory into groups of
+    independent outlet trees that can be routed at the same time.
+
+    The rivers of each outlet tree are always in the same group and the
+    groups have about the same number of rivers in the riv_bas_id file.
+    Each group gets a directory named after the input directory
+    with the subset of the rapid_connect, riv_bas_id, k, x, weight
+    and comid_lat_lon_z files in the original order of the rivers.
+    The directories can be used as RAPID input directories, for
+    example with :func:`~RAPIDpy.inflow.run_lsm_rapid_process`, and
+    the Qout files of the groups can be merged back together with
+    :func:`merge_qout_files`.
+
+    Parameters
+    ----------
+    rapid_input_directory: str
+        Path to the directory with the rapid_connect.csv,
+        riv_bas_id.csv, k.csv and x.csv files.
+    output_directory: str
+        Path to the directory to create the directories
+        of the groups in.
+    num_groups: int
+        Number of groups to divide the river network into.
+
+    Returns
+    -------
+    list:
+        The directories of the groups with rivers.
+
+
+    Example:
+
+    .. code:: python
+
+        from RAPIDpy.decomposition import decompose_rapid_input_directory
+
+        group_input_directory_list = decompose_rapid_input_directory(
+            rapid_input_directory='/rapid-io/input/conus',
+            output_directory='/rapid-io/input',
+            num_groups=8
+        )
+    """
+    def find_file(pattern, required=True):
+        """
+        Find the input files matching the pattern
+        """
+        return _find_input_files(rapid_input_directory, pattern, required)
+
+    rapid_connect_file = find_file(r'^rapid_connect\.csv$')[0]
+    riv_bas_id_file = find_file(r'^riv_bas_id\.csv$')[0]
+    rapid_connect_lines = \
+        _read_csv_lines(os.path.join(rapid_input_directory,
+                                     rapid_connect_file))[1]
+    river_id_array = _get_first_column(rapid_connect_lines)
+    downstream_id_array = np.array([int(float(line.split(",")[1]))
+                                    for line in rapid_connect_lines],
+                                   dtype=np.int64)
+    riv_bas_id_lines = \
+        _read_csv_lines(os.path.join(rapid_input_directory,
+                                     riv_bas_id_file))[1]
+    riv_bas_id_array = _get_first_column(riv_bas_id_lines)
+
+    # balance the groups by the number of rivers routed
+    river_sort_index = np.argsort(river_id_array)
+    size_array = np.zeros(river_id_array.size)
+    riv_bas_sort_index = np.searchsorted(river_id_array[river_sort_index],
+                                         riv_bas_id_array)
+    riv_bas_sort_index[riv_bas_sort_index >= river_id_array.size] = 0
+    riv_bas_index_array = river_sort_index[riv_bas_sort_index]
+    if (river_id_array[riv_bas_index_array] != riv_bas_id_array).any():
+        log("The riv_bas_id file has rivers not in the "
+            "rapid_connect file ...",
+            "ERROR")
+    size_array[riv_bas_index_array] = 1
+
+    river_group_array = group_outlet_trees(
+        get_outlet_index_array(river_id_array, downstream_id_array),
+        num_groups, size_array)
+    riv_bas_group_array = river_group_array[riv_bas_index_array]
+
+    # files with a river ID in the first column and a header
+    river_id_file_list = \
+        [(file_name, _read_csv_lines(os.path.join(rapid_input_directory,
+                                                  file_name), header=True))
+         for file_name in find_file(r'^weight_.*\.csv$', required=False) +
+         find_file(r'^comid_lat_lon_z.*\.csv$', required=False)]
+    # files in the order of the rapid_connect file
+    connect_file_list = \
+        [(file_name, _read_csv_lines(os.path.join(rapid_input_directory,
+                                                  file_name)))
+         for file_name in find_file(r'^k\.csv$') + find_file(r'^x\.csv$')]
+
+    input_directory_name = \
+        os.path.basename(os.path.normpath(rapid_input_directory))
+    group_input_directory_list = []
+    for group_index in range(num_groups):
+        group_river_index_array = np.where(river_group_array ==
+                                           group_index)[0]
+        group_riv_bas_index_array = np.where(riv_bas_group_array ==
+                                             group_index)[0]
+        if group_riv_bas_index_array.size == 0:
+            continue
+
+        group_input_directory = \
+            os.path.join(output_directory,
+                         "{0}_group_{1}".format(input_directory_name,
+                                                group_index))
+        if not os.path.exists(group_input_directory):
+            os.makedirs(group_input_directory)
+        _write_csv_lines(os.path.join(group_input_directory,
+                                      rapid_connect_file),
+                         [], rapid_connect_lines, group_river_index_array)
+        _write_csv_lines(os.path.join(group_input_directory,
+                                      riv_bas_id_file),
+                         [], riv_bas_id_lines, group_riv_bas_index_array)
+        for file_name, (header_lines, csv_lines) in connect_file_list:
+            _write_csv_lines(os.path.join(group_input_directory, file_name),
+                             header_lines, csv_lines,
+                             group_river_index_array)
+
+        group_river_id_array = np.sort(river_id_array[group_river_index_array])
+        for file_name, (header_lines, csv_lines) in river_id_file_list:
+            file_river_id_array = _get_first_column(csv_lines)
+            file_sort_index = np.searchsorted(group_river_id_array,
+                                              file_river_id_array)
+            file_sort_index[file_sort_index >=
+                            group_river_id_array.size] = 0
+            _write_csv_lines(os.path.join(group_input_directory, file_name),
+                             header_lines, csv_lines,
+                             np.where(group_river_id_array[file_sort_index] ==
+                                      file_river_id_array)[0])
+
+        group_input_directory_list.append(group_input_directory)
+
+    log("Divided {0} into {1} groups ..."
+        .format(rapid_input_directory, len(group_input_directory_list)),
+        "INFO")
+    return group_input_directory_list
+
+
+def merge_qout_files(qout_file_list, riv_bas_id_file, out_qout_file):
+    """
+    Merge the Qout files of groups of rivers, for example from
+    :func:`decompose_rapid_input_directory`, into one Qout file with
+    the rivers in the order of the riv_bas_id file. The variables
+    along the river ID dimension are merged and the other variables
+    are copied from the first file.
+
+    Parameters
+    ----------
+    qout_file_list: list
+        Paths to the Qout files of the groups.
+    riv_bas_id_file: str
+        Path to the riv_bas_id file with the river order of the output.
+    out_qout_file: str
+        Path to the merged Qout file.
+    """
+    riv_bas_id_array = np.loadtxt(riv_bas_id_file, ndmin=1, delimiter=",",
+                                  usecols=(0,), dtype=np.int64)
+    riv_bas_sort_index = np.argsort(riv_bas_id_array)
+
+    qout_nc_list = []
+    try:
+        for qout_file in qout_file_list:
+            qout_nc_list.append(Dataset(qout_file))
+        template_nc = qout_nc_list[0]
+        river_id_dimension = 'COMID' \
+            if 'COMID' in template_nc.dimensions else 'rivid'
+
+        # the position of the rivers of each file in the output
+        river_out_index_list = []
+        river_found_array = np.zeros(riv_bas_id_array.size, dtype=bool)
+        for qout_file, qout_nc in zip(qout_file_list, qout_nc_list):
+            qout_river_id_array = \
+                qout_nc.variables[river_id_dimension][:].astype(np.int64)
+            river_sort_index = np.searchsorted(
+                riv_bas_id_array[riv_bas_sort_index], qout_river_id_array)
+            river_sort_index[river_sort_index >= riv_bas_id_array.size] = 0
+            river_out_index_array = riv_bas_sort_index[river_sort_index]
+            if (riv_bas_id_array[river_out_index_array] !=
+                    qout_river_id_array).any():
+                log("{0} has rivers not in {1} ...".format(qout_file,
+                                                           riv_bas_id_file),
+                    "ERROR")
+            river_found_array[river_out_index_array] = True
+            river_out_index_list.append(river_out_index_array)
+        if not river_found_array.all():
+            log("Rivers {0} not found in the Qout files ..."
+                .format(riv_bas_id_array[~river_found_array]),
+                "ERROR")
+
+        with Dataset(out_qout_file, "w",
+                     format=template_nc.data_model) as out_nc:
+            out_nc.setncatts({attr: template_nc.getncattr(attr)
+                              for attr in template_nc.ncattrs()})
+            for dim_name, dim in template_nc.dimensions.items():
+                dim_size = len(dim)
+                if dim_name == river_id_dimension:
+                    dim_size = riv_bas_id_array.size
+                out_nc.createDimension(
+                    dim_name, None if dim.isunlimited() else dim_size)
+
+            for var_name, var in template_nc.variables.items():
+                fill_value = getattr(var, '_FillValue', None)
+                out_var = out_nc.createVariable(var_name, var.dtype,
+                                                var.dimensions,
+                                                fill_value=fill_value)
+                out_var.setncatts({attr: var.getncattr(attr)
+                                   for attr in var.ncattrs()
+                                   if attr != '_FillValue'})
+                if river_id_dimension not in var.dimensions:
+                    out_var[...] = var[...]
+                    continue
+
+                # merge the variable a block of the first dimension
+                # at a time if the river ID dimension is not first
+                river_axis = var.dimensions.index(river_id_dimension)
+                block_slice_list = [slice(None)]
+                if river_axis > 0:
+                    block_size = max(1, 2**24 // max(1, int(np.prod(
+                        out_var.shape[1:]))))
+                    block_slice_list = \
+                        [slice(block_start,
+                               min(block_start + block_size, var.shape[0]))
+                         for block_start in range(0, var.shape[0],
+                                                  block_size)]
+                for block_slice in block_slice_list:
+                    out_block = None
+                    for qout_nc, river_out_index_array in \
+                            zip(qout_nc_list, river_out_index_list):
+                        in_block = qout_nc.variables[var_name][block_slice]
+                        if out_block is None:
+                            out_shape = list(in_block.shape)
+                            out_shape[river_axis] = riv_bas_id_array.size
+                            out_block = np.ma.masked_all(out_shape,
+                                                         dtype=var.dtype)
+                        out_index = [slice(None)] * len(out_shape)
+                        out_index[river_axis] = river_out_index_array
+                        out_block[tuple(out_index)] = in_block
+                    out_var[block_slice] = out_block
+    finally:
+        for qout_nc in qout_nc_list:
+            qout_nc.close()
+
+
+def _run_muskingum_group(rapid_manager):
+    """
+    Route a group with the Muskingum routing in Python
+    """
+    rapid_manager.run_muskingum()
+    return rapid_manager.Qout_file
+
+
+def run_rapid_groups(rapid_manager, group_input_directory_list,
+                     group_vlat_file_list, num_processes=None,
+                     muskingum=False):
+    """
+    Run RAPID for the groups of a river network from
+    :func:`decompose_rapid_input_directory` at the same time and
+    merge the Qout files of the groups into the *Qout_file* of the
+    RAPID manager in the order of its *riv_bas_id_file*.
+
+    The other parameters of the RAPID manager are used for all of the
+    groups and its *Qinit_file* is divided into the groups as well.
+
+    Parameters
+    ----------
+    rapid_manager: :obj:`~RAPIDpy.rapid.RAPID`
+        RAPID manager with the parameters of the whole river network.
+    group_input_directory_list: list
+        The input directories of the groups.
+    group_vlat_file_list: list
+        The m3 file of each group, for example generated with the
+        weight tables of the groups.
+    num_processes: int, optional
+        Number of groups to route with *muskingum* at the same time.
+        Default is the number of groups. The RAPID program runs the
+        groups with :class:`~RAPIDpy.scheduler.RAPIDScheduler` instead,
+        which divides the RAPID processors (*num_processors*) of the
+        RAPID manager among the groups by their number of reaches.
+    muskingum: bool, optional
+        If True, the groups are routed with
+        :meth:`~RAPIDpy.rapid.RAPID.run_muskingum` instead of the
+        RAPID program. Default is False.
+
+
+    Example:
+
+    .. code:: python
+
+        from RAPIDpy import RAPID
+        from RAPIDpy.decomposition import run_rapid_groups
+
+        rapid_manager = RAPID(
+            rapid_executable_location='~/work/rapid/src/rapid',
+            ZS_TauR=3*3600,
+            ZS_dtR=15*60,
+            ZS_TauM=30*24*3600,
+            rapid_connect_file='/rapid-io/input/conus/rapid_connect.csv',
+            riv_bas_id_file='/rapid-io/input/conus/riv_bas_id.csv',
+            Qout_file='/rapid-io/output/conus/Qout.nc'
+        )
+
+        run_rapid_groups(
+            rapid_manager,
+            group_input_directory_list=['/rapid-io/input/conus_group_0',
+                                        '/rapid-io/input/conus_group_1'],
+            group_vlat_file_list=['/rapid-io/output/conus_group_0/m3.nc',
+                                  '/rapid-io/output/conus_group_1/m3.nc']
+        )
+    """
+    if len(group_input_directory_list) != len(group_vlat_file_list):
+        log("Need one m3 file for each group ...",
+            "ERROR")
+
+    qinit_river_id_array = None
+    if rapid_manager.BS_opt_Qinit and rapid_manager.Qinit_file:
+        qinit_river_id_array = np.loadtxt(rapid_manager.rapid_connect_file,
+                                          ndmin=1, delimiter=",",
+                                          usecols=(0,), dtype=np.int64)
+        qinit_lines = _read_csv_lines(rapid_manager.Qinit_file)[1]
+        qinit_sort_index = np.argsort(qinit_river_id_array)
+
+    qout_file_name = os.path.basename(rapid_manager.Qout_file)
+    group_rapid_manager_list = []
+    for group_input_directory, group_vlat_file in \
+            zip(group_input_directory_list, group_vlat_file_list):
+        group_rapid_manager = deepcopy(rapid_manager)
+        rapid_connect_file = _find_input_file(group_input_directory,
+                                              r'^rapid_connect\.csv$')
+        group_rapid_manager.update_parameters(
+            rapid_connect_file=rapid_connect_file,
+            riv_bas_id_file=_find_input_file(group_input_directory,
+                                             r'^riv_bas_id\.csv$'),
+            k_file=_find_input_file(group_input_directory, r'^k\.csv$'),
+            x_file=_find_input_file(group_input_directory, r'^x\.csv$'),
+            Vlat_file=group_vlat_file,
+            Qout_file=os.path.join(group_input_directory,
+                                   'Qout_{0}'.format(qout_file_name)),
+        )
+        if qinit_river_id_array is not None:
+            group_river_id_array = \
+                np.loadtxt(rapid_connect_file, ndmin=1, delimiter=",",
+                           usecols=(0,), dtype=np.int64)
+            group_qinit_file = os.path.join(group_input_directory,
+                                            'qinit.csv')
+            _write_csv_lines(
+                group_qinit_file, [], qinit_lines,
+                qinit_sort_index[np.searchsorted(
+                    qinit_river_id_array[qinit_sort_index],
+                    group_river_id_array)])
+            group_rapid_manager.update_parameters(Qinit_file=group_qinit_file)
+        group_rapid_manager.update_reach_number_data()
+        group_rapid_manager_list.append(group_rapid_manager)
+
+    if not muskingum:
+        # pylint: disable=protected-access
+        rapid_scheduler = RAPIDScheduler(rapid_manager._num_processors)
+        for group_rapid_manager in group_rapid_manager_list:
+            rapid_scheduler.add_run(group_rapid_manager)
+        rapid_scheduler.run()
+        qout_file_list = [group_rapid_manager.Qout_file
+                          for group_rapid_manager in group_rapid_manager_list]
+    else:
+        if num_processes is None:
+            num_processes = len(group_rapid_manager_list)
+        num_processes = max(1, min(num_processes,
+                                   len(group_rapid_manager_list)))
+        log("Running {0} groups with {1} processes ..."
+            .format(len(group_rapid_manager_list), num_processes),
+            "INFO")
+        if num_processes == 1:
+            qout_file_list = [_run_muskingum_group(group_rapid_manager)
+                              for group_rapid_manager
+                              in group_rapid_manager_list]
+        else:
+            pool = multiprocessing.Pool(num_processes)
+            try:
+                qout_file_list = pool.map(_run_muskingum_group,
+                                          group_rapid_manager_list,
+                                          chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+
+    merge_qout_files(qout_file_list, rapid_manager.riv_bas_id_file,
+                     rapid_manager.Qout_file)
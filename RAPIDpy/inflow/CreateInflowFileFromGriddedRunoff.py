@@ -9,13 +9,22 @@
 from abc import abstractmethod
 import csv
 from datetime import datetime
+import hashlib
+import json
 import sys
 import os
-
-from netCDF4 import Dataset
+from shutil import rmtree
+from tempfile import mkdtemp, mkstemp
+import threading
+try:
+    from queue import Full, Queue
+except ImportError:
+    from Queue import Full, Queue
+
+from netCDF4 import Dataset, default_fillvals
 import numpy as np
 from pytz import utc
-from past.builtins import xrange  # pylint: disable=redefined-builtin
+from scipy.sparse import csr_matrix
 
 # local
 from ..helper_functions import open_csv
@@ -31,11 +40,23 @@ class CreateInflowFileFromGriddedRunoff(object):
     land_surface_model_name = "land surface model"
     header_wt = ['rivid', 'area_sqm', 'lon_index', 'lat_index', 'npoints']
     runoff_vars = []
+    # number of time steps between the resets of grids with runoff
+    # accumulated over time. ERA Interim Low Res (T255) is accumulated
+    # over the 3-hourly time steps from 0 and from 12.
+    grid_accumulation_reset_steps = {'t255': 4}
 
     def __init__(self):
         self.dict_list = []
         self.count = 0
         self.size_stream_id = 0
+        self.weight_operator = None
+        self.weight_operator_list = []
+        self.weight_lat_indices = None
+        self.weight_lon_indices = None
+        self.weight_table_source_list = None
+        self.runoff_hyperslabs = None
+        self.accumulation_reset_steps = None
+        self.weight_table_cache_directory = None
         self.simulation_time_step_seconds = 0
         self.time_units = 'seconds since 1970-01-01 00:00:00+00:00'
         self.error_messages = [
@@ -51,10 +72,187 @@ class CreateInflowFileFromGriddedRunoff(object):
             "Incorrect sequence of rows in the weight table"
         ]
 
+    # arrays of the compiled weight table, each in a .npy file
+    weight_table_cache_arrays = ('dict_list', 'weight_lat_indices',
+                                 'weight_lon_indices', 'operator_data',
+                                 'operator_indices', 'operator_indptr')
+
+    @staticmethod
+    def get_weight_table_cache_directory(in_weight_table, cache_directory):
+        """
+        Path to the compiled weight table of the weight table CSV
+        in the cache directory
+        """
+        in_weight_table = os.path.abspath(in_weight_table)
+        return os.path.join(
+            cache_directory,
+            "{0}_{1}".format(
+                os.path.splitext(os.path.basename(in_weight_table))[0],
+                hashlib.sha1(in_weight_table.encode('utf-8'))
+                .hexdigest()[:16]))
+
+    @staticmethod
+    def get_weight_table_source_list(in_weight_table_list):
+        """
+        Path, size and modification time of each weight table CSV
+        to check if the weight tables read in are still current.
+        """
+        return [(os.path.abspath(in_weight_table),
+                 os.path.getsize(in_weight_table),
+                 os.path.getmtime(in_weight_table))
+                for in_weight_table in in_weight_table_list]
+
+    @staticmethod
+    def _get_file_hash(in_file):
+        """
+        SHA1 hash of the file contents
+        """
+        file_hash = hashlib.sha1()
+        with open(in_file, "rb") as in_file_handle:
+            for file_block in iter(lambda: in_file_handle.read(2 ** 20), b""):
+                file_hash.update(file_block)
+        return file_hash.hexdigest()
+
+    def _load_weight_table_cache(self, in_weight_table):
+        """
+        Memory map the compiled weight table if it was created from the
+        current weight table CSV. Returns True if it was loaded.
+
+        The CSV size must match. If the modification time changed,
+        the contents hash must match and the new modification time is
+        recorded so that the CSV is only hashed once.
+        """
+        weight_cache_directory = self.get_weight_table_cache_directory(
+            in_weight_table, self.weight_table_cache_directory)
+        source_file = os.path.join(weight_cache_directory, 'source.json')
+        if not os.path.exists(source_file):
+            return False
+        try:
+            with open(source_file) as source_json:
+                source_info = json.load(source_json)
+            if source_info['source_size'] != \
+                    os.path.getsize(in_weight_table):
+                return False
+            source_mtime = os.path.getmtime(in_weight_table)
+            update_source = source_info['source_mtime'] != source_mtime
+            if update_source and source_info['source_hash'] != \
+                    self._get_file_hash(in_weight_table):
+                return False
+            # the processes reading the same files share the memory
+            weight_cache = {
+                array_name: np.load(os.path.join(weight_cache_directory,
+                                                 array_name + '.npy'),
+                                    mmap_mode='r')
+                for array_name in self.weight_table_cache_arrays
+            }
+            self.dict_list = weight_cache['dict_list']
+            self.count = self.dict_list.shape[0]
+            self.size_stream_id = source_info['size_stream_id']
+            self.weight_lat_indices = weight_cache['weight_lat_indices']
+            self.weight_lon_indices = weight_cache['weight_lon_indices']
+            self.weight_operator = csr_matrix(
+                (weight_cache['operator_data'],
+                 weight_cache['operator_indices'],
+                 weight_cache['operator_indptr']),
+                shape=(self.size_stream_id,
+                       self.weight_lat_indices.size))
+        except Exception:
+            print("WARNING: Unable to read compiled weight table {0}. "
+                  "Reading the weight table CSV ..."
+                  .format(weight_cache_directory))
+            return False
+        self.weight_operator_list = [self.weight_operator]
+        if update_source:
+            source_info['source_mtime'] = source_mtime
+            self._write_weight_table_cache_source(weight_cache_directory,
+                                                  source_info)
+        return True
+
+    @staticmethod
+    def _write_weight_table_cache_source(weight_cache_directory, source_info):
+        """
+        Replace the source information of a compiled weight table.
+        The compiled weight table is still used if this fails.
+        """
+        temp_source_file = None
+        try:
+            file_handle, temp_source_file = \
+                mkstemp(prefix='.tmp_', dir=weight_cache_directory)
+            with os.fdopen(file_handle, 'w') as source_json:
+                json.dump(source_info, source_json)
+            os.rename(temp_source_file,
+                      os.path.join(weight_cache_directory, 'source.json'))
+        except (IOError, OSError):
+            print("WARNING: Unable to update compiled weight table {0} ..."
+                  .format(weight_cache_directory))
+            if temp_source_file is not None and \
+                    os.path.exists(temp_source_file):
+                os.remove(temp_source_file)
+
+    def _write_weight_table_cache(self, in_weight_table):
+        """
+        Write the compiled weight table to the cache directory.
+        The weight table is still used if this fails.
+        """
+        weight_cache_directory = self.get_weight_table_cache_directory(
+            in_weight_table, self.weight_table_cache_directory)
+        weight_cache = {
+            'dict_list': self.dict_list,
+            'weight_lat_indices': self.weight_lat_indices,
+            'weight_lon_indices': self.weight_lon_indices,
+            'operator_data': self.weight_operator.data,
+            'operator_indices': self.weight_operator.indices,
+            'operator_indptr': self.weight_operator.indptr,
+        }
+        temp_cache_directory = None
+        try:
+            if not os.path.exists(self.weight_table_cache_directory):
+                os.makedirs(self.weight_table_cache_directory)
+            # unique temporary directory so simultaneous writers
+            # do not collide
+            temp_cache_directory = \
+                mkdtemp(prefix='.tmp_',
+                        dir=self.weight_table_cache_directory)
+            for array_name in self.weight_table_cache_arrays:
+                np.save(os.path.join(temp_cache_directory,
+                                     array_name + '.npy'),
+                        weight_cache[array_name])
+            with open(os.path.join(temp_cache_directory, 'source.json'),
+                      'w') as source_json:
+                json.dump({
+                    'source_size': os.path.getsize(in_weight_table),
+                    'source_mtime': os.path.getmtime(in_weight_table),
+                    'source_hash': self._get_file_hash(in_weight_table),
+                    'size_stream_id': int(self.size_stream_id),
+                }, source_json)
+            if os.path.exists(weight_cache_directory):
+                rmtree(weight_cache_directory)
+            os.rename(temp_cache_directory, weight_cache_directory)
+        except (IOError, OSError):
+            print("WARNING: Unable to write compiled weight table {0} ..."
+                  .format(weight_cache_directory))
+            if temp_cache_directory is not None:
+                rmtree(temp_cache_directory, ignore_errors=True)
+
     def read_in_weight_table(self, in_weight_table):
         """
         Read in weight table
+
+        If *weight_table_cache_directory* is set, the compiled weight
+        table is memory mapped from the cache directory when it matches
+        the CSV and is written there otherwise. Processes that memory
+        map the same compiled weight table share one copy in memory.
+
+        Parameters
+        ----------
+        in_weight_table: str
+            Path to the weight table CSV.
         """
+        self.weight_table_source_list = None
+        use_cache = self.weight_table_cache_directory is not None
+        if use_cache and self._load_weight_table_cache(in_weight_table):
+            return
+
         print("Reading the weight table...")
         with open_csv(in_weight_table, "r") as csvfile:
             reader = csv.reader(csvfile)
@@ -86,6 +284,504 @@ class CreateInflowFileFromGriddedRunoff(object):
         self.size_stream_id = \
             len(np.unique(np.array(self.dict_list[self.header_wt[0]],
                                    dtype=np.int32)))
+        self._compile_weight_operator()
+        if use_cache:
+            self._write_weight_table_cache(in_weight_table)
+
+    def _compile_weight_operator(self):
+        """
+        Compile the weight table into a sparse matrix that maps
+        the unique grid cells in the table to the river segments.
+
+        The rows of the matrix are in weight table stream order
+        and the columns match *weight_lat_indices* and
+        *weight_lon_indices*.
+        """
+        rivids = self.dict_list[self.header_wt[0]]
+        npoints = self.dict_list[self.header_wt[4]]
+
+        # each stream must be a contiguous block of npoints rows
+        stream_starts = \
+            np.flatnonzero(np.r_[True, rivids[1:] != rivids[:-1]])
+        stream_lengths = np.diff(np.r_[stream_starts, self.count])
+        if stream_starts.size != self.size_stream_id or \
+                (npoints[stream_starts] != stream_lengths).any():
+            invalid_index = np.flatnonzero(
+                npoints[stream_starts] != stream_lengths)
+            if invalid_index.size > 0:
+                print("ROW INDEX {0}"
+                      .format(stream_starts[invalid_index[0]]))
+                print("COMID {0}"
+                      .format(rivids[stream_starts[invalid_index[0]]]))
+            raise Exception(self.error_messages[6])
+        stream_indices = np.repeat(np.arange(self.size_stream_id),
+                                   stream_lengths)
+
+        # only keep one column per grid cell
+        lon_indices = self.dict_list[self.header_wt[2]].astype(np.int64)
+        lat_indices = self.dict_list[self.header_wt[3]].astype(np.int64)
+        lon_size = int(lon_indices.max()) + 1
+        cell_ids, cell_indices = \
+            np.unique(lat_indices * lon_size + lon_indices,
+                      return_inverse=True)
+        self.weight_lat_indices = cell_ids // lon_size
+        self.weight_lon_indices = cell_ids % lon_size
+
+        area_sqm = np.array(self.dict_list[self.header_wt[1]],
+                            dtype=np.float64)
+        area_sqm[np.isnan(area_sqm)] = 0
+        # duplicate stream/cell pairs are summed
+        self.weight_operator = csr_matrix(
+            (area_sqm, (stream_indices, cell_indices.ravel())),
+            shape=(self.size_stream_id, cell_ids.size))
+        self.weight_operator_list = [self.weight_operator]
+
+    def read_in_weight_tables(self, in_weight_table_list):
+        """
+        Read in weight tables from multiple watersheds on the same grid.
+
+        The weight table grid cells become the union of the grid cells
+        in all of the tables and *weight_operator_list* contains the
+        operator for each table in the order given.
+        """
+        weight_table_source_list = \
+            self.get_weight_table_source_list(in_weight_table_list)
+        if len(in_weight_table_list) == 1:
+            self.read_in_weight_table(in_weight_table_list[0])
+            self.weight_table_source_list = weight_table_source_list
+            return
+
+        weight_operator_list = []
+        cell_index_list = []
+        for in_weight_table in in_weight_table_list:
+            self.read_in_weight_table(in_weight_table)
+            weight_operator_list.append(self.weight_operator)
+            cell_index_list.append((self.weight_lat_indices,
+                                    self.weight_lon_indices))
+
+        lon_size = max(int(lon_indices.max()) + 1
+                       for _, lon_indices in cell_index_list)
+        cell_ids_list = [lat_indices * lon_size + lon_indices
+                         for lat_indices, lon_indices in cell_index_list]
+        union_cell_ids = np.unique(np.concatenate(cell_ids_list))
+        self.weight_lat_indices = union_cell_ids // lon_size
+        self.weight_lon_indices = union_cell_ids % lon_size
+
+        # move the columns of each operator to the union of grid cells
+        self.weight_operator_list = []
+        for weight_operator, cell_ids in zip(weight_operator_list,
+                                             cell_ids_list):
+            union_column = np.searchsorted(union_cell_ids, cell_ids)
+            weight_operator = weight_operator.tocoo()
+            self.weight_operator_list.append(csr_matrix(
+                (weight_operator.data,
+                 (weight_operator.row, union_column[weight_operator.col])),
+                shape=(weight_operator.shape[0], union_cell_ids.size)))
+        self.weight_operator = None
+        self.weight_table_source_list = weight_table_source_list
+
+    def get_accumulation_reset_steps(self, grid_type):
+        """
+        Get the number of time steps between the resets of the
+        accumulated runoff. None means the runoff is not accumulated.
+        """
+        if self.accumulation_reset_steps is not None:
+            return self.accumulation_reset_steps
+        return self.grid_accumulation_reset_steps.get(grid_type)
+
+    @staticmethod
+    def _deaccumulate_runoff(runoff_cells, reset_steps, time_index_start=0,
+                             previous_runoff_cells=None):
+        """
+        Convert runoff on the weight table grid cells (time x cell)
+        accumulated since the last reset to the runoff in each time step.
+
+        The accumulation resets every *reset_steps* time steps from
+        the start of the file and the first time step after a reset is
+        the runoff in that time step. *time_index_start* is the index
+        in the file of the first time step in *runoff_cells* and
+        *previous_runoff_cells* is the accumulated runoff of the time
+        step before it. Negative runoff from decreasing accumulations
+        is set to zero.
+        """
+        reset_steps = int(reset_steps)
+        step_runoff_cells = np.empty_like(runoff_cells)
+        step_runoff_cells[1:] = runoff_cells[1:] - runoff_cells[:-1]
+        step_runoff_cells[0] = runoff_cells[0]
+        if time_index_start % reset_steps != 0:
+            step_runoff_cells[0] -= previous_runoff_cells
+
+        reset_time_indices = np.arange(-time_index_start % reset_steps,
+                                       runoff_cells.shape[0], reset_steps)
+        step_runoff_cells[reset_time_indices] = \
+            runoff_cells[reset_time_indices]
+        step_runoff_cells[step_runoff_cells < 0] = 0
+        return step_runoff_cells
+
+    def _apply_weight_operators(self, runoff_cells, conversion_factor,
+                                weight_operator_list=None):
+        """
+        Convert runoff on the weight table grid cells (time x cell or
+        cell) to water volume inflow for each stream (time x stream
+        or stream). Returns one inflow array per weight table.
+
+        If *weight_operator_list* is given, the runoff is already
+        filtered and the inflow is computed in place in the data type
+        of the operators.
+        """
+        if weight_operator_list is None:
+            # filter nan
+            runoff_cells = np.where(np.isnan(runoff_cells), 0, runoff_cells)
+
+        inflow_data_list = []
+        for weight_operator in \
+                weight_operator_list or self.weight_operator_list:
+            if runoff_cells.ndim == 1:
+                inflow_data = weight_operator.dot(runoff_cells)
+            else:
+                inflow_data = weight_operator.dot(runoff_cells.T).T
+            if weight_operator_list is None:
+                inflow_data = inflow_data * conversion_factor
+            else:
+                inflow_data *= conversion_factor
+            inflow_data_list.append(inflow_data)
+        return inflow_data_list
+
+    def _plan_runoff_hyperslabs(self, runoff_var, tile_size=32):
+        """
+        Plan the rectangular lat/lon slabs to read from the runoff
+        variable so that only the weight table grid cells and the
+        chunks they are in are read.
+
+        The grid is split into tiles made of whole chunks of the
+        variable with at least *tile_size* cells on a side. The tiles
+        with weight table grid cells are merged into rectangles along
+        longitude and then along latitude. If that does not reduce the
+        area read, the bounding box of the grid cells is used.
+
+        Sets *runoff_hyperslabs* to a list of
+        (lat_slice, lon_slice, cell_indices, slab_indices) where the
+        grid cells at *cell_indices* are at *slab_indices* in the
+        flattened slab.
+        """
+        lat_size, lon_size = runoff_var.shape[-2:]
+        if self.weight_lat_indices.max() >= lat_size or \
+                self.weight_lon_indices.max() >= lon_size:
+            raise Exception("ERROR: Weight table grid cells outside of "
+                            "the {0} grid ...".format(
+                                self.land_surface_model_name))
+
+        chunk_lat_size = chunk_lon_size = 1
+        chunking = runoff_var.chunking()
+        if chunking not in (None, 'contiguous'):
+            chunk_lat_size, chunk_lon_size = chunking[-2:]
+        tile_lat_size = chunk_lat_size * -(-tile_size // chunk_lat_size)
+        tile_lon_size = chunk_lon_size * -(-tile_size // chunk_lon_size)
+
+        # merge the tiles with grid cells along longitude
+        num_tile_cols = lon_size // tile_lon_size + 1
+        tiles = np.unique(
+            self.weight_lat_indices // tile_lat_size * num_tile_cols
+            + self.weight_lon_indices // tile_lon_size)
+        tile_rows = tiles // num_tile_cols
+        tile_cols = tiles % num_tile_cols
+        run_starts = np.flatnonzero(
+            np.r_[True, (tile_rows[1:] != tile_rows[:-1]) |
+                  (tile_cols[1:] != tile_cols[:-1] + 1)])
+        run_ends = np.r_[run_starts[1:], tiles.size] - 1
+
+        # merge runs covering the same longitudes in consecutive rows
+        rectangle_list = []
+        open_rectangles = {}
+        for run_start, run_end in zip(run_starts, run_ends):
+            row = tile_rows[run_start]
+            cols = (tile_cols[run_start], tile_cols[run_end])
+            rectangle = open_rectangles.get(cols)
+            if rectangle is not None and rectangle[1] == row - 1:
+                rectangle[1] = row
+            else:
+                rectangle = [row, row, cols[0], cols[1]]
+                rectangle_list.append(rectangle)
+                open_rectangles[cols] = rectangle
+
+        slab_list = [(slice(int(row_start * tile_lat_size),
+                            int(min((row_end + 1) * tile_lat_size,
+                                    lat_size))),
+                      slice(int(col_start * tile_lon_size),
+                            int(min((col_end + 1) * tile_lon_size,
+                                    lon_size))))
+                     for row_start, row_end, col_start, col_end
+                     in rectangle_list]
+
+        bounding_box = (slice(int(self.weight_lat_indices.min()),
+                              int(self.weight_lat_indices.max()) + 1),
+                        slice(int(self.weight_lon_indices.min()),
+                              int(self.weight_lon_indices.max()) + 1))
+        if sum((lat_slice.stop - lat_slice.start) *
+               (lon_slice.stop - lon_slice.start)
+               for lat_slice, lon_slice in slab_list) >= \
+                (bounding_box[0].stop - bounding_box[0].start) * \
+                (bounding_box[1].stop - bounding_box[1].start):
+            slab_list = [bounding_box]
+
+        self.runoff_hyperslabs = []
+        for lat_slice, lon_slice in slab_list:
+            cell_indices = np.flatnonzero(
+                (self.weight_lat_indices >= lat_slice.start) &
+                (self.weight_lat_indices < lat_slice.stop) &
+                (self.weight_lon_indices >= lon_slice.start) &
+                (self.weight_lon_indices < lon_slice.stop))
+            slab_indices = \
+                (self.weight_lat_indices[cell_indices] - lat_slice.start) \
+                * (lon_slice.stop - lon_slice.start) \
+                + (self.weight_lon_indices[cell_indices] - lon_slice.start)
+            self.runoff_hyperslabs.append((lat_slice, lon_slice,
+                                           cell_indices, slab_indices))
+
+    @staticmethod
+    def _read_float32_runoff(runoff_var, slab):
+        """
+        Read a slab of a runoff variable as float32 with the fill
+        values set to zero.
+
+        The netCDF4 masking and scaling is skipped and the fill values
+        and scaling are applied to the raw data here unless the variable
+        has valid range attributes, which need the netCDF4 masking.
+        """
+        if any(hasattr(runoff_var, attr)
+               for attr in ('valid_min', 'valid_max', 'valid_range')):
+            runoff_var.set_auto_maskandscale(True)
+            runoff_data = runoff_var[slab]
+            try:
+                runoff_data = runoff_data.filled(fill_value=0)
+            except AttributeError:
+                pass
+            return runoff_data.astype(np.float32, copy=False)
+
+        runoff_var.set_auto_maskandscale(False)
+        raw_data = runoff_var[slab]
+
+        # the values netCDF4 would mask
+        fill_value_list = []
+        if hasattr(runoff_var, 'missing_value'):
+            fill_value_list += list(np.atleast_1d(runoff_var.missing_value))
+        if hasattr(runoff_var, '_FillValue'):
+            fill_value_list.append(runoff_var._FillValue)
+        elif raw_data.dtype.itemsize > 1:
+            fill_value_list.append(
+                default_fillvals[raw_data.dtype.str[1:]])
+        fill_mask = None
+        for fill_value in fill_value_list:
+            if fill_mask is None:
+                fill_mask = (raw_data == fill_value)
+            else:
+                fill_mask |= (raw_data == fill_value)
+
+        if hasattr(runoff_var, 'scale_factor') or \
+                hasattr(runoff_var, 'add_offset'):
+            # unpack in float64 as the offset can be much larger
+            # than the runoff
+            runoff_data = raw_data * \
+                np.float64(getattr(runoff_var, 'scale_factor', 1.0))
+            runoff_data += getattr(runoff_var, 'add_offset', 0.0)
+            runoff_data = runoff_data.astype(np.float32)
+        else:
+            runoff_data = raw_data.astype(np.float32, copy=False)
+        if fill_mask is not None and fill_mask.any():
+            runoff_data[fill_mask] = 0
+        return runoff_data
+
+    def _read_runoff_cells(self, data_in_nc, time_slice=None,
+                           use_float32=False):
+        """
+        Read the sum of the runoff variables on the weight table grid
+        cells (time x cell or cell) with masked values set to zero.
+        If *time_slice* is given, only those time steps are read.
+
+        With *use_float32*, the runoff is read as float32 without the
+        netCDF4 masked arrays (see :meth:`_read_float32_runoff`) and
+        negative and NaN values are also set to zero.
+        """
+        runoff_var = data_in_nc.variables[self.runoff_vars[0]]
+        if self.runoff_hyperslabs is None:
+            self._plan_runoff_hyperslabs(runoff_var)
+
+        runoff_cells = None
+        for lat_slice, lon_slice, cell_indices, slab_indices \
+                in self.runoff_hyperslabs:
+            slab = (Ellipsis, lat_slice, lon_slice)
+            if time_slice is not None:
+                slab = (time_slice, lat_slice, lon_slice)
+            # obtain subset of surface and subsurface runoff
+            if use_float32:
+                runoff_slab = self._read_float32_runoff(runoff_var, slab)
+                for var_name in self.runoff_vars[1:]:
+                    runoff_slab += self._read_float32_runoff(
+                        data_in_nc.variables[var_name], slab)
+                # set negative and NaN values to zero in place
+                np.fmax(runoff_slab, 0, out=runoff_slab)
+            else:
+                runoff_slab = runoff_var[slab]
+                for var_name in self.runoff_vars[1:]:
+                    runoff_slab += data_in_nc.variables[var_name][slab]
+            runoff_slab = runoff_slab.reshape(runoff_slab.shape[:-2] + (-1,))
+            try:
+                # set masked values to zero
+                runoff_slab = runoff_slab.filled(fill_value=0)
+            except AttributeError:
+                pass
+
+            if runoff_cells is None:
+                runoff_cells = np.empty(
+                    runoff_slab.shape[:-1] + self.weight_lat_indices.shape,
+                    dtype=runoff_slab.dtype)
+            runoff_cells[..., cell_indices] = runoff_slab[..., slab_indices]
+
+        return runoff_cells
+
+    def _read_runoff_blocks(self, nc_file_list, index_list, time_block_size,
+                            steps_per_file, convert_one_hour_to_three,
+                            netcdf_lock, use_float32=False):
+        """
+        Read the runoff on the weight table grid cells of each group of
+        runoff files in *nc_file_list* one block of time at a time.
+        The runoff of the files in a group is summed. The netCDF library
+        is only used while holding *netcdf_lock*. See
+        :meth:`_read_runoff_cells` for *use_float32*.
+
+        Yields
+        ------
+        tuple:
+            The index from *index_list*, the name of the first file,
+            the time block (slice or None for the whole file), the
+            number of output time steps in the file, whether the file
+            has multiple output time steps and the runoff.
+        """
+        for nc_file_array_index, nc_file_array in enumerate(nc_file_list):
+
+            index = index_list[nc_file_array_index]
+
+            if not isinstance(nc_file_array, list):
+                nc_file_array = [nc_file_array]
+
+            data_in_nc_list = []
+            try:
+                with netcdf_lock:
+                    for nc_file in nc_file_array:
+                        # Validate the netcdf dataset
+                        self.data_validation(nc_file)
+
+                        # Read the netcdf dataset
+                        data_in_nc_list.append(Dataset(nc_file))
+
+                    runoff_var = \
+                        data_in_nc_list[-1].variables[self.runoff_vars[0]]
+                    runoff_dimension_size = len(runoff_var.dimensions)
+                    len_time_subset = 1
+                    if runoff_dimension_size == 3:
+                        len_time_subset = runoff_var.shape[0]
+                len_time_out = len_time_subset
+                if convert_one_hour_to_three:
+                    len_time_out //= 3
+
+                # split the file into blocks of time
+                time_block_list = [None]
+                if time_block_size and runoff_dimension_size == 3 \
+                        and len_time_out > 1 \
+                        and not (convert_one_hour_to_three and
+                                 steps_per_file % 3 != 0):
+                    block_size = int(time_block_size)
+                    if convert_one_hour_to_three:
+                        block_size = 3 * -(-block_size // 3)
+                    time_block_list = \
+                        [slice(block_start,
+                               min(block_start + block_size,
+                                   len_time_subset))
+                         for block_start in range(0, len_time_subset,
+                                                  block_size)]
+
+                for time_block in time_block_list:
+                    data_subset_all = None
+                    for data_in_nc in data_in_nc_list:
+                        # obtain the runoff on the weight table grid cells
+                        with netcdf_lock:
+                            data_subset_new = \
+                                self._read_runoff_cells(data_in_nc,
+                                                        time_block,
+                                                        use_float32)
+
+                        # FILTER DATA
+                        # set negative values to zero
+                        if not use_float32:
+                            data_subset_new[data_subset_new < 0] = 0
+
+                        # combine data
+                        if data_subset_all is None:
+                            data_subset_all = data_subset_new
+                        else:
+                            data_subset_all = np.add(data_subset_all,
+                                                     data_subset_new)
+
+                    yield (index, nc_file_array[0], time_block,
+                           len_time_out,
+                           runoff_dimension_size == 3 and len_time_out > 1,
+                           data_subset_all)
+            finally:
+                with netcdf_lock:
+                    for data_in_nc in data_in_nc_list:
+                        data_in_nc.close()
+
+    @staticmethod
+    def _read_ahead(block_iter, read_ahead_blocks):
+        """
+        Get the items of *block_iter* from a thread that keeps up to
+        *read_ahead_blocks* items read ahead of the items in use.
+        """
+        block_queue = Queue(maxsize=read_ahead_blocks)
+        stop_reading = threading.Event()
+
+        def put_block(block):
+            """
+            Wait for space in the queue unless reading was stopped.
+            """
+            while not stop_reading.is_set():
+                try:
+                    block_queue.put(block, timeout=1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def read_blocks():
+            """
+            Put the items of *block_iter* on the queue followed by
+            None or the error raised reading them.
+            """
+            try:
+                for block in block_iter:
+                    if not put_block((block, None)):
+                        return
+            except Exception as ex:
+                put_block((None, ex))
+                return
+            finally:
+                block_iter.close()
+            put_block((None, None))
+
+        reader = threading.Thread(target=read_blocks)
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                block, error = block_queue.get()
+                if error is not None:
+                    raise error
+                if block is None:
+                    break
+                yield block
+        finally:
+            stop_reading.set()
+            reader.join()
 
     @staticmethod
     def _write_lat_lon(data_out_nc, rivid_lat_lon_z_file):
@@ -165,40 +861,91 @@ class CreateInflowFileFromGriddedRunoff(object):
                                  in_rapid_connect_file,
                                  in_rivid_lat_lon_z_file,
                                  land_surface_model_description,
-                                 modeling_institution
+                                 modeling_institution,
+                                 unlimited_time=False,
+                                 file_format="NETCDF3_CLASSIC",
+                                 chunksizes=None,
+                                 complevel=4
                                  ):
         """
         Generate inflow file for RAPID
+
+        If *unlimited_time* is True, the time dimension is unlimited so
+        that more time steps can be added to the file later with
+        :func:`extend_output_time`. The time dimension is also unlimited
+        if the inflow is too large for a fixed size variable in a
+        NETCDF3 *file_format*.
+
+        With a NETCDF4 *file_format*, the inflow is stored in chunks of
+        *chunksizes* (time, rivid) time steps and river reaches
+        (see :func:`get_inflow_chunksizes` for the default) compressed
+        with zlib and the shuffle filter at *complevel* (1-9, 0 for
+        no compression).
         """
         self.simulation_time_step_seconds = simulation_time_step_seconds
 
         # Create output inflow netcdf data
         print("Generating inflow file ...")
-        data_out_nc = Dataset(out_nc, "w", format="NETCDF3_CLASSIC")
         rivid_list = np.loadtxt(in_rapid_connect_file,
                                 delimiter=",",
                                 ndmin=1,
                                 usecols=(0,),
                                 dtype=int)
-        # create dimensions
-        data_out_nc.createDimension('time', number_of_timesteps)
-        data_out_nc.createDimension('rivid', len(rivid_list))
-        data_out_nc.createDimension('nv', 2)
-        # create variables
-        # m3_riv
-        m3_riv_var = data_out_nc.createVariable('m3_riv', 'f4',
-                                                ('time', 'rivid'),
-                                                fill_value=0)
-        m3_riv_var.long_name = 'accumulated external water volume ' \
-                               'inflow upstream of each river reach'
-        m3_riv_var.units = 'm3'
-        m3_riv_var.coordinates = 'lon lat'
-        m3_riv_var.grid_mapping = 'crs'
-        m3_riv_var.cell_methods = "time: sum"
-        data_out_nc.close()
 
+        # the classic formats limit the size of fixed size variables
+        m3_riv_kwargs = {}
+        if file_format.startswith("NETCDF4"):
+            if chunksizes is None:
+                chunksizes = self.get_inflow_chunksizes(
+                    None if unlimited_time else number_of_timesteps,
+                    len(rivid_list))
+            # chunks cannot be larger than fixed size dimensions
+            chunksizes = (
+                chunksizes[0] if unlimited_time
+                else max(1, min(chunksizes[0], number_of_timesteps)),
+                max(1, min(chunksizes[1], len(rivid_list))))
+            m3_riv_kwargs = {
+                'chunksizes': chunksizes,
+                'zlib': complevel > 0,
+                'complevel': max(complevel, 1),
+                'shuffle': complevel > 0,
+            }
+        elif not unlimited_time:
+            max_variable_size = {
+                'NETCDF3_CLASSIC': 2 ** 31 - 4,
+                'NETCDF3_64BIT_OFFSET': 2 ** 32 - 4,
+                'NETCDF3_64BIT': 2 ** 32 - 4,
+            }.get(file_format)
+            if max_variable_size is not None and \
+                    4 * number_of_timesteps * len(rivid_list) > \
+                    max_variable_size:
+                print("WARNING: The inflow is too large for a fixed size "
+                      "variable in the {0} format. Using an unlimited "
+                      "time dimension ...".format(file_format))
+                unlimited_time = True
+
+        data_out_nc = Dataset(out_nc, "w", format=file_format)
         try:
-            data_out_nc = Dataset(out_nc, "a", format="NETCDF3_CLASSIC")
+            # create dimensions
+            if unlimited_time:
+                data_out_nc.createDimension('time', None)
+            else:
+                data_out_nc.createDimension('time', number_of_timesteps)
+            data_out_nc.createDimension('rivid', len(rivid_list))
+            data_out_nc.createDimension('nv', 2)
+            # create variables
+            # m3_riv
+            m3_riv_var = data_out_nc.createVariable('m3_riv', 'f4',
+                                                    ('time', 'rivid'),
+                                                    fill_value=0,
+                                                    **m3_riv_kwargs)
+            m3_riv_var.long_name = 'accumulated external water volume ' \
+                                   'inflow upstream of each river reach'
+            m3_riv_var.units = 'm3'
+            m3_riv_var.coordinates = 'lon lat'
+            m3_riv_var.grid_mapping = 'crs'
+            m3_riv_var.cell_methods = "time: sum"
+
             # rivid
             rivid_var = data_out_nc.createVariable('rivid', 'i4',
                                                    ('rivid',))
@@ -217,23 +964,11 @@ class CreateInflowFileFromGriddedRunoff(object):
             time_var.calendar = 'gregorian'
             time_var.bounds = 'time_bnds'
 
-            initial_time_seconds = \
-                (start_datetime_utc.replace(tzinfo=utc) -
-                 datetime(1970, 1, 1, tzinfo=utc)).total_seconds()
-            final_time_seconds = \
-                initial_time_seconds + number_of_timesteps\
-                * simulation_time_step_seconds
-            time_array = np.arange(initial_time_seconds, final_time_seconds,
-                                   simulation_time_step_seconds)
-            time_var[:] = time_array
-
             # time_bnds
-            time_bnds_var = data_out_nc.createVariable('time_bnds', 'i4',
-                                                       ('time', 'nv',))
-            for time_index, time_element in enumerate(time_array):
-                time_bnds_var[time_index, 0] = time_element
-                time_bnds_var[time_index, 1] = \
-                    time_element + simulation_time_step_seconds
+            data_out_nc.createVariable('time_bnds', 'i4', ('time', 'nv',))
+            self._write_time(data_out_nc, start_datetime_utc, 0,
+                             number_of_timesteps,
+                             simulation_time_step_seconds)
 
             # longitude
             lon_var = data_out_nc.createVariable('lon', 'f8', ('rivid',),
@@ -270,13 +1005,101 @@ class CreateInflowFileFromGriddedRunoff(object):
 
             # write lat lon data
             self._write_lat_lon(data_out_nc, in_rivid_lat_lon_z_file)
-
+        finally:
             # close file
             data_out_nc.close()
-        except RuntimeError:
-            print("File size too big to add data beforehand."
-                  " Performing conversion after ...")
-    
+
+    @staticmethod
+    def get_inflow_chunksizes(number_of_timesteps, number_of_rivids,
+                              chunk_values=2 ** 20):
+        """
+        Get the default (time, rivid) chunk sizes of the inflow in
+        NETCDF4 files. Chunks have all of the river reaches (up to
+        *chunk_values*) and as many time steps as fit in *chunk_values*
+        values (4 MiB) so that RAPID reading one time step at a time
+        decompresses each chunk once. *number_of_timesteps* is None for
+        an unlimited time dimension.
+        """
+        chunk_rivid_size = max(1, min(number_of_rivids, chunk_values))
+        chunk_time_size = max(1, chunk_values // chunk_rivid_size)
+        if number_of_timesteps is not None:
+            chunk_time_size = max(1, min(chunk_time_size,
+                                         number_of_timesteps))
+        return chunk_time_size, chunk_rivid_size
+
+    @staticmethod
+    def _write_time(data_out_nc, start_datetime_utc, time_start_index,
+                    number_of_timesteps, simulation_time_step_seconds):
+        """
+        Write the time and time bounds from *time_start_index*
+        up to *number_of_timesteps*
+        """
+        if number_of_timesteps <= time_start_index:
+            return
+        initial_time_seconds = \
+            (start_datetime_utc.replace(tzinfo=utc) -
+             datetime(1970, 1, 1, tzinfo=utc)).total_seconds()
+        time_array = initial_time_seconds + \
+            np.arange(time_start_index, number_of_timesteps) \
+            * simulation_time_step_seconds
+        time_slice = slice(time_start_index, int(number_of_timesteps))
+        data_out_nc.variables['time'][time_slice] = time_array
+        data_out_nc.variables['time_bnds'][time_slice, :] = \
+            np.column_stack((time_array,
+                             time_array + simulation_time_step_seconds))
+
+    @staticmethod
+    def get_number_of_output_timesteps(out_nc, start_datetime_utc,
+                                       simulation_time_step_seconds):
+        """
+        Get the number of time steps with a time in an inflow file
+        generated with an unlimited time dimension.
+
+        Returns None if more time steps cannot be added to the file
+        (the time dimension is not unlimited or the time does not begin
+        at *start_datetime_utc* with *simulation_time_step_seconds*).
+        """
+        with Dataset(out_nc) as data_out_nc:
+            if not data_out_nc.dimensions['time'].isunlimited():
+                return None
+            time_array = data_out_nc.variables['time'][:]
+
+        time_mask = np.ma.getmaskarray(time_array)
+        number_of_timesteps = time_array.size
+        if time_mask.any():
+            number_of_timesteps = int(np.argmax(time_mask))
+        time_array = np.ma.getdata(time_array)[:number_of_timesteps]
+
+        initial_time_seconds = \
+            (start_datetime_utc.replace(tzinfo=utc) -
+             datetime(1970, 1, 1, tzinfo=utc)).total_seconds()
+        expected_time_array = initial_time_seconds + \
+            np.arange(number_of_timesteps) * simulation_time_step_seconds
+        if not np.array_equal(time_array, expected_time_array):
+            return None
+        return number_of_timesteps
+
+    def extend_output_time(self, out_nc, start_datetime_utc,
+                           number_of_timesteps,
+                           simulation_time_step_seconds):
+        """
+        Add the time and time bounds to an inflow file generated with an
+        unlimited time dimension for the time steps after the ones the
+        file already has up to *number_of_timesteps*.
+        """
+        existing_number_of_timesteps = \
+            self.get_number_of_output_timesteps(out_nc,
+                                                start_datetime_utc,
+                                                simulation_time_step_seconds)
+        if existing_number_of_timesteps is None:
+            raise Exception("ERROR: Unable to add time steps to {0} ..."
+                            .format(out_nc))
+        with Dataset(out_nc, "a") as data_out_nc:
+            self._write_time(data_out_nc, start_datetime_utc,
+                             existing_number_of_timesteps,
+                             number_of_timesteps,
+                             simulation_time_step_seconds)
+
     def sum_inflow_over_time_increment(self, inflow_data,
                                        old_timestep_hours,
                                        new_timestep_hours,
@@ -287,12 +1110,16 @@ class CreateInflowFileFromGriddedRunoff(object):
         """
         file_time_hours = steps_per_file * old_timestep_hours
         file_time_is_divisible = (file_time_hours % new_timestep_hours == 0)
-        if file_time_is_divisible:
-            new_time_dim = int(file_time_hours / new_timestep_hours)
-            # We add a new dimension, tmp_dim, to sum over.
-            tmp_dim = int(new_timestep_hours)
-            inflow_data = inflow_data.reshape(new_time_dim, tmp_dim, -1)
-            inflow_data = inflow_data.sum(axis=1)
+        if not file_time_is_divisible:
+            raise Exception("ERROR: {0} {1}-hourly time steps cannot be "
+                            "summed to {2}-hourly time steps ..."
+                            .format(steps_per_file, old_timestep_hours,
+                                    new_timestep_hours))
+        new_time_dim = int(file_time_hours / new_timestep_hours)
+        # We add a new dimension, tmp_dim, to sum over.
+        tmp_dim = int(new_timestep_hours)
+        inflow_data = inflow_data.reshape(new_time_dim, tmp_dim, -1)
+        inflow_data = inflow_data.sum(axis=1)
 
         return inflow_data
 
@@ -331,13 +1158,65 @@ class CreateInflowFileFromGriddedRunoff(object):
 
     def execute(self, nc_file_list, index_list, in_weight_table,
                 out_nc, grid_type, mp_lock, steps_per_file=1,
-                convert_one_hour_to_three=False):
-
-        """The source code of the tool."""
-        if not os.path.exists(out_nc):
-            raise Exception("Outfile has not been created. "
-                            "You need to run: generateOutputInflowFile "
-                            "function ...")
+                convert_one_hour_to_three=False, write_queue=None,
+                time_block_size=None, read_ahead_blocks=None,
+                use_float32=False):
+
+        """The source code of the tool.
+
+        To generate inflow for multiple watersheds on the same grid
+        while reading each runoff file once, *in_weight_table* and
+        *out_nc* can be lists of the same length.
+
+        If *write_queue* is given, the inflow is put on the queue as
+        (output file index, time index, inflow array) for a writer
+        process instead of being written to *out_nc* using *mp_lock*.
+        After all of the inflow for an index in *index_list* is on the
+        queue, (None, index, file name) is put on the queue.
+
+        If *time_block_size* is given, runoff files with a time dimension
+        are read, converted and written *time_block_size* time steps at
+        a time to limit the memory used for long files. The size is
+        rounded up to a multiple of 3 with *convert_one_hour_to_three*.
+
+        If *read_ahead_blocks* is given, the runoff is read by a thread
+        up to *read_ahead_blocks* files or time blocks ahead of the
+        one being converted so that reading the files overlaps with
+        the conversion. At most *read_ahead_blocks* blocks wait in
+        memory. The netCDF library is not thread safe, so one thread
+        reads and the files are only written while it is not reading.
+
+        If *use_float32* is True, the runoff is read without the netCDF4
+        masked arrays and the inflow is computed in float32, the data
+        type of the inflow file, instead of float64. This uses half of
+        the memory and is faster. The inflow is the same as with float64
+        to a relative tolerance of 1e-5. Runoff accumulated over time is
+        converted in float64 as the differences between the accumulated
+        values lose too much precision in float32.
+
+        Runoff accumulated over time (see
+        :meth:`get_accumulation_reset_steps`) is converted to the runoff
+        in each time step before it is weighted.
+
+        The weight tables are not read again if they were read in with
+        :meth:`read_in_weight_tables` and have not changed since.
+        """
+        in_weight_table_list = in_weight_table
+        if not isinstance(in_weight_table_list, list):
+            in_weight_table_list = [in_weight_table_list]
+        out_nc_list = out_nc
+        if not isinstance(out_nc_list, list):
+            out_nc_list = [out_nc_list]
+
+        if len(in_weight_table_list) != len(out_nc_list):
+            raise Exception("ERROR: Number of weight tables not equal to "
+                            "number of output inflow files ...")
+
+        for out_nc in out_nc_list:
+            if not os.path.exists(out_nc):
+                raise Exception("Outfile has not been created. "
+                                "You need to run: generateOutputInflowFile "
+                                "function ...")
 
         if len(nc_file_list) != len(index_list):
             raise Exception("ERROR: Number of runoff files not equal to "
@@ -348,189 +1227,134 @@ class CreateInflowFileFromGriddedRunoff(object):
             demo_file_list = [demo_file_list]
 
         self.data_validation(demo_file_list[0])
-        self.read_in_weight_table(in_weight_table)
+        if self.weight_table_source_list != \
+                self.get_weight_table_source_list(in_weight_table_list):
+            self.read_in_weight_tables(in_weight_table_list)
+        self.runoff_hyperslabs = None
 
         conversion_factor = self.get_conversion_factor(demo_file_list[0],
                                                        len(demo_file_list))
-
-        # get indices of subset of data
-        lon_ind_all = [int(i) for i in self.dict_list[self.header_wt[2]]]
-        lat_ind_all = [int(j) for j in self.dict_list[self.header_wt[3]]]
-
-        # Obtain a subset of  runoff data based on the indices in the
-        # weight table
-        min_lon_ind_all = min(lon_ind_all)
-        max_lon_ind_all = max(lon_ind_all)
-        min_lat_ind_all = min(lat_ind_all)
-        max_lat_ind_all = max(lat_ind_all)
-        lon_slice = slice(min_lon_ind_all, max_lon_ind_all + 1)
-        lat_slice = slice(min_lat_ind_all, max_lat_ind_all + 1)
-        index_new = []
+        if grid_type == 't255':
+            # ERA Interim Low Res (T255) runoff is in m
+            conversion_factor = 1
+        accumulation_reset_steps = \
+            self.get_accumulation_reset_steps(grid_type)
+        # accumulated runoff is read and converted in float64
+        use_float32 = use_float32 and not accumulation_reset_steps
+
+        netcdf_lock = threading.Lock()
+        runoff_blocks = self._read_runoff_blocks(nc_file_list, index_list,
+                                                 time_block_size,
+                                                 steps_per_file,
+                                                 convert_one_hour_to_three,
+                                                 netcdf_lock,
+                                                 use_float32)
+        if read_ahead_blocks:
+            runoff_blocks = self._read_ahead(runoff_blocks,
+                                             int(read_ahead_blocks))
+
+        weight_operator_list = None
+        if use_float32:
+            weight_operator_list = \
+                [weight_operator.astype(np.float32)
+                 for weight_operator in self.weight_operator_list]
+            conversion_factor = np.float32(conversion_factor)
 
         # combine inflow data
-        for nc_file_array_index, nc_file_array in enumerate(nc_file_list):
-
-            index = index_list[nc_file_array_index]
-
-            if not isinstance(nc_file_array, list):
-                nc_file_array = [nc_file_array]
-
-            data_subset_all = None
-            for nc_file in nc_file_array:
-                # Validate the netcdf dataset
-                self.data_validation(nc_file)
-
-                # Read the netcdf dataset
-                data_in_nc = Dataset(nc_file)
-
-                # Calculate water inflows
-                runoff_dimension_size = \
-                    len(data_in_nc.variables[self.runoff_vars[0]].dimensions)
-                if runoff_dimension_size == 2:
-                    # obtain subset of surface and subsurface runoff
-                    data_subset_runoff = \
-                        data_in_nc.variables[self.runoff_vars[0]][
-                            lat_slice, lon_slice]
-                    for var_name in self.runoff_vars[1:]:
-                        data_subset_runoff += \
-                            data_in_nc.variables[var_name][
-                                lat_slice, lon_slice]
-
-                    # get runoff dims
-                    len_time_subset = 1
-                    len_lat_subset = data_subset_runoff.shape[0]
-                    len_lon_subset = data_subset_runoff.shape[1]
-
-                    # reshape the runoff
-                    data_subset_runoff = data_subset_runoff.reshape(
-                        len_lat_subset * len_lon_subset)
-
-                elif runoff_dimension_size == 3:
-                    # obtain subset of surface and subsurface runoff
-                    data_subset_runoff = \
-                        data_in_nc.variables[self.runoff_vars[0]][
-                            :, lat_slice, lon_slice]
-                    for var_name in self.runoff_vars[1:]:
-                        data_subset_runoff += \
-                            data_in_nc.variables[var_name][
-                                :, lat_slice, lon_slice]
-
-                    # get runoff dims
-                    len_time_subset = data_subset_runoff.shape[0]
-                    len_lat_subset = data_subset_runoff.shape[1]
-                    len_lon_subset = data_subset_runoff.shape[2]
-                    # reshape the runoff
-                    data_subset_runoff = \
-                        data_subset_runoff.reshape(
-                            len_time_subset,
-                            (len_lat_subset * len_lon_subset))
-
-                data_in_nc.close()
-
-                if not index_new:
-                    # compute new indices based on the data_subset_surface
-                    for r in range(0, self.count):
-                        ind_lat_orig = lat_ind_all[r]
-                        ind_lon_orig = lon_ind_all[r]
-                        index_new.append(
-                            (ind_lat_orig - min_lat_ind_all) * len_lon_subset
-                            + (ind_lon_orig - min_lon_ind_all))
-
-                # obtain a new subset of data
-                if runoff_dimension_size == 2:
-                    data_subset_new = data_subset_runoff[index_new]
-                elif runoff_dimension_size == 3:
-                    data_subset_new = data_subset_runoff[:, index_new]
-
-                # FILTER DATA
-                try:
-                    # set masked values to zero
-                    data_subset_new = data_subset_new.filled(fill_value=0)
-                except AttributeError:
-                    pass
-                # set negative values to zero
-                data_subset_new[data_subset_new < 0] = 0
-
-                # combine data
-                if data_subset_all is None:
-                    data_subset_all = data_subset_new
-                else:
-                    data_subset_all = np.add(data_subset_all, data_subset_new)
-
-            if runoff_dimension_size == 3 and len_time_subset > 1:
-                inflow_data = np.zeros((len_time_subset, self.size_stream_id))
-            else:
-                inflow_data = np.zeros(self.size_stream_id)
-
-            pointer = 0
-            for stream_index in xrange(self.size_stream_id):
-                npoints = int(self.dict_list[self.header_wt[4]][pointer])
-                # Check if all npoints points correspond to the same streamID
-                if len(set(self.dict_list[self.header_wt[0]][
-                           pointer: (pointer + npoints)])) != 1:
-                    print("ROW INDEX {0}".format(pointer))
-                    print("COMID {0}".format(
-                        self.dict_list[self.header_wt[0]][pointer]))
-                    raise Exception(self.error_messages[2])
-
-                area_sqm_npoints = \
-                    np.array([float(k) for k in
-                              self.dict_list[self.header_wt[1]][
-                              pointer: (pointer + npoints)]])
-
-                # assume data is incremental
-                if runoff_dimension_size == 3:
-                    data_goal = data_subset_all[:, pointer:(pointer + npoints)]
-                else:
-                    data_goal = data_subset_all[pointer:(pointer + npoints)]
-
-                if grid_type == 't255':
-                    # A) ERA Interim Low Res (T255) - data is cumulative
-                    # from time 3/6/9/12
-                    # (time zero not included, so assumed to be zero)
-                    ro_first_half = \
-                        np.concatenate([data_goal[0:1, ],
-                                        np.subtract(data_goal[1:4, ],
-                                                    data_goal[0:3, ])])
-                    # from time 15/18/21/24
-                    # (time restarts at time 12, assumed to be zero)
-                    ro_second_half = \
-                        np.concatenate([data_goal[4:5, ],
-                                        np.subtract(data_goal[5:, ],
-                                                    data_goal[4:7, ])])
-                    ro_stream = \
-                        np.multiply(
-                            np.concatenate([ro_first_half, ro_second_half]),
-                            area_sqm_npoints)
-
-                else:
-                    ro_stream = data_goal * area_sqm_npoints * \
-                                conversion_factor
-
-                # filter nan
-                ro_stream[np.isnan(ro_stream)] = 0
-
-                if ro_stream.any():
-                    if runoff_dimension_size == 3 and len_time_subset > 1:
-                        inflow_data[:, stream_index] = ro_stream.sum(axis=1)
-                    else:
-                        inflow_data[stream_index] = ro_stream.sum()
+        previous_index = None
+        previous_data_subset_all = None
+        try:
+            for index, nc_file, time_block, len_time_out, \
+                    multiple_time_steps, data_subset_all in runoff_blocks:
+
+                if index != previous_index:
+                    if previous_index is not None and \
+                            write_queue is not None:
+                        write_queue.put((None, previous_index,
+                                         os.path.basename(previous_file)))
+                    previous_index = index
+                    previous_file = nc_file
+                    previous_data_subset_all = None
+
+                # convert accumulated data to incremental
+                if accumulation_reset_steps and data_subset_all.ndim == 2:
+                    time_index_start = 0
+                    if time_block is not None:
+                        time_index_start = time_block.start
+                    accumulated_data_subset_all = data_subset_all
+                    data_subset_all = self._deaccumulate_runoff(
+                        data_subset_all,
+                        accumulation_reset_steps,
+                        time_index_start,
+                        previous_data_subset_all)
+                    previous_data_subset_all = \
+                        accumulated_data_subset_all[-1]
+
+                inflow_data_list = \
+                    self._apply_weight_operators(data_subset_all,
+                                                 conversion_factor,
+                                                 weight_operator_list)
+
+                time_start = index * len_time_out
+                sum_steps = steps_per_file
+                if time_block is not None:
+                    sum_steps = time_block.stop - time_block.start
+                    time_start += time_block.start
+                    if convert_one_hour_to_three:
+                        time_start = \
+                            index * len_time_out + time_block.start // 3
+
+                self._write_inflow_data(inflow_data_list, out_nc_list,
+                                        index, time_start,
+                                        multiple_time_steps,
+                                        convert_one_hour_to_three,
+                                        sum_steps, mp_lock, write_queue,
+                                        netcdf_lock)
+        finally:
+            runoff_blocks.close()
+
+        if previous_index is not None and write_queue is not None:
+            write_queue.put((None, previous_index,
+                             os.path.basename(previous_file)))
+
+    def _write_inflow_data(self, inflow_data_list, out_nc_list, index,
+                           time_start, multiple_time_steps,
+                           convert_one_hour_to_three, steps_per_file,
+                           mp_lock, write_queue, netcdf_lock):
+        """
+        Write the inflow for each output file starting at *time_start*
+        if there are *multiple_time_steps* or at *index* otherwise.
+        The output files are only written while holding *netcdf_lock*.
+        """
+        for out_index, inflow_data in enumerate(inflow_data_list):
+            if not multiple_time_steps:
+                inflow_data = inflow_data.ravel()
 
-                pointer += npoints
-                
             if convert_one_hour_to_three:
-               inflow_data = self.sum_inflow_over_time_increment(
-                   inflow_data, 1, 3, steps_per_file)
-               len_time_subset /= 3
-               
+                inflow_data = self.sum_inflow_over_time_increment(
+                    inflow_data, 1, 3, steps_per_file)
+
+            if write_queue is not None:
+                time_index = index
+                if multiple_time_steps:
+                    time_index = time_start
+                write_queue.put((
+                    out_index,
+                    time_index,
+                    inflow_data.reshape(-1, inflow_data.shape[-1])
+                    .astype(np.float32, copy=False)))
+                continue
+
             # only one process is allowed to write at a time to netcdf file
             mp_lock.acquire()
-            data_out_nc = Dataset(out_nc, "a", format="NETCDF3_CLASSIC")
-            if runoff_dimension_size == 3 and len_time_subset > 1:
-                data_out_nc.variables['m3_riv'][
-                    index*len_time_subset:(index+1)*len_time_subset, :] = \
-                    inflow_data
-            else:
-                data_out_nc.variables['m3_riv'][index] = inflow_data
-            data_out_nc.close()
+            with netcdf_lock:
+                data_out_nc = Dataset(out_nc_list[out_index], "a",
+                                      format="NETCDF3_CLASSIC")
+                if multiple_time_steps:
+                    data_out_nc.variables['m3_riv'][
+                        time_start:time_start + inflow_data.shape[0], :] = \
+                        inflow_data
+                else:
+                    data_out_nc.variables['m3_riv'][index] = inflow_data
+                data_out_nc.close()
             mp_lock.release()
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+   lsm_manifest.py
+   RAPIDpy
+
+   License: BSD 3-Clause
+"""
+from datetime import datetime
+import json
+import multiprocessing
+import os
+
+# external packages
+from netCDF4 import Dataset, chartostring
+import numpy as np
+import pandas as pd
+from xarray.coding.times import decode_cf_datetime
+
+
+def read_lsm_file_datetimes(lsm_file, time_var):
+    """
+    Read the datetimes of the time variable in an LSM file
+    without reading any other variables.
+
+    Parameters
+    ----------
+    lsm_file: str
+        Path to the LSM file.
+    time_var: str
+        Name of the time variable.
+
+    Returns
+    -------
+    :obj:`pandas.DatetimeIndex`
+    """
+    with Dataset(lsm_file) as lsm_nc:
+        time_variable = lsm_nc.variables[time_var]
+        time_values = np.ma.getdata(time_variable[:])
+        time_units = getattr(time_variable, 'units', None)
+        time_calendar = getattr(time_variable, 'calendar', 'standard')
+
+    if time_values.dtype.kind in 'SU' and time_values.ndim > 1:
+        # WRF Times are character arrays
+        time_values = chartostring(time_values)
+    elif time_values.dtype.kind in 'iuf' and time_units is not None:
+        time_values = decode_cf_datetime(time_values.ravel(),
+                                         time_units,
+                                         time_calendar)
+    time_values = np.atleast_1d(time_values).ravel()
+
+    try:
+        time_values = [time_val.decode('utf-8') for
+                       time_val in time_values]
+    except AttributeError:
+        pass
+
+    try:
+        return pd.to_datetime(time_values)
+    except ValueError:
+        # WRF DATETIME FORMAT
+        return pd.to_datetime(time_values, format="%Y-%m-%d_%H:%M:%S")
+
+
+def read_lsm_file_info(lsm_file, time_var, time_dim):
+    """
+    Read the time and grid information from an LSM file.
+
+    Returns
+    -------
+    dict:
+        time_size, time_start, time_end and time_step (seconds between
+        the first two times) with times as ISO strings, time_increasing
+        and time_uniform (whether the times are strictly increasing
+        and evenly spaced) and grid, the names and sizes of the
+        dimensions other than time.
+    """
+    with Dataset(lsm_file) as lsm_nc:
+        grid = ";".join("{0}={1}".format(dim_name, len(dim))
+                        for dim_name, dim in sorted(lsm_nc.dimensions.items())
+                        if dim_name != time_dim)
+
+    lsm_file_info = {
+        'grid': grid,
+        'time_size': None,
+        'time_start': None,
+        'time_end': None,
+        'time_step': None,
+        'time_increasing': True,
+        'time_uniform': True,
+    }
+    if time_var is not None:
+        datetime_array = read_lsm_file_datetimes(lsm_file, time_var)
+        lsm_file_info['time_size'] = len(datetime_array)
+        lsm_file_info['time_start'] = datetime_array[0].isoformat()
+        lsm_file_info['time_end'] = datetime_array[-1].isoformat()
+        if len(datetime_array) > 1:
+            lsm_file_info['time_step'] = \
+                (datetime_array[1] - datetime_array[0]).total_seconds()
+            time_diffs = np.diff(datetime_array.values)
+            lsm_file_info['time_increasing'] = \
+                bool((time_diffs > np.timedelta64(0)).all())
+            lsm_file_info['time_uniform'] = \
+                bool((time_diffs == time_diffs[0]).all())
+    return lsm_file_info
+
+
+def _read_lsm_file_info_args(args):
+    """
+    Pool wrapper for :func:`read_lsm_file_info`
+    """
+    return read_lsm_file_info(*args)
+
+
+def read_lsm_file_info_list(lsm_file_list, time_var, time_dim,
+                            num_processes=1):
+    """
+    Read the time and grid information from a list of LSM files
+    with up to *num_processes* processes, each with one file open at
+    a time. See :func:`read_lsm_file_info`.
+
+    Returns
+    -------
+    list:
+        The information of each file in the order of *lsm_file_list*.
+    """
+    job_list = [(lsm_file, time_var, time_dim) for lsm_file in lsm_file_list]
+    num_processes = min(num_processes, len(job_list))
+    if num_processes <= 1:
+        return [_read_lsm_file_info_args(job) for job in job_list]
+
+    pool = multiprocessing.Pool(num_processes)
+    try:
+        return pool.map(_read_lsm_file_info_args, job_list,
+                        chunksize=max(1, len(job_list) //
+                                      (num_processes * 4)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+class LSMFileManifest(object):
+    """
+    List of the files in an LSM data directory with their size,
+    modification time, file name datetime, and time and grid
+    information so that large archives are not scanned and read
+    again on every run.
+
+    Directories are only listed again when their modification time
+    changes. All of the files listed are checked with os.stat and LSM
+    files are only read again when their size or modification time
+    changes, including files changed in place.
+
+    Parameters
+    ----------
+    lsm_data_location: str
+        Path to the directory with the LSM files.
+    lsm_manifest_file: str, optional
+        Path to the JSON file to keep the manifest in between runs.
+        If not set, the manifest is only kept in memory.
+    """
+    version = 2
+
+    def __init__(self, lsm_data_location, lsm_manifest_file=None):
+        self.lsm_data_location = os.path.abspath(lsm_data_location)
+        self.lsm_manifest_file = lsm_manifest_file
+        self.directories = {}
+        self.files = {}
+        self.file_datetime_pattern = None
+
+        if lsm_manifest_file and os.path.exists(lsm_manifest_file):
+            try:
+                with open(lsm_manifest_file) as manifest:
+                    manifest_data = json.load(manifest)
+            except ValueError:
+                print("WARNING: Invalid LSM manifest {0}. "
+                      "Scanning the LSM files ...".format(lsm_manifest_file))
+                return
+            if manifest_data.get('version') == self.version and \
+                    manifest_data.get('lsm_data_location') == \
+                    self.lsm_data_location:
+                self.directories = manifest_data['directories']
+                self.files = manifest_data['files']
+                self.file_datetime_pattern = \
+                    manifest_data['file_datetime_pattern']
+
+    def update(self):
+        """
+        Update the manifest with the files in the LSM data directory
+        """
+        directories = {}
+        files = {}
+        directory_list = [""]
+        while directory_list:
+            directory = directory_list.pop()
+            directory_path = os.path.join(self.lsm_data_location, directory)
+            directory_mtime = os.path.getmtime(directory_path)
+            directory_info = self.directories.get(directory)
+            if directory_info is None or \
+                    directory_info['mtime'] != directory_mtime:
+                directory_info = {
+                    'mtime': directory_mtime,
+                    'directories': [],
+                    'files': [],
+                }
+                for file_name in os.listdir(directory_path):
+                    relative_path = os.path.join(directory, file_name)
+                    if os.path.isdir(os.path.join(self.lsm_data_location,
+                                                  relative_path)):
+                        directory_info['directories'].append(relative_path)
+                    else:
+                        directory_info['files'].append(relative_path)
+            directories[directory] = directory_info
+            directory_list += directory_info['directories']
+            # files rewritten in place do not change the directory
+            for relative_path in directory_info['files']:
+                file_info = self.files.get(relative_path)
+                file_stat = os.stat(os.path.join(self.lsm_data_location,
+                                                 relative_path))
+                if file_info is None or \
+                        file_info['size'] != file_stat.st_size or \
+                        file_info['mtime'] != file_stat.st_mtime:
+                    file_info = {
+                        'size': file_stat.st_size,
+                        'mtime': file_stat.st_mtime,
+                    }
+                files[relative_path] = file_info
+
+        self.directories = directories
+        self.files = files
+
+    def save(self):
+        """
+        Write the manifest to the manifest file if there is one
+        """
+        if not self.lsm_manifest_file:
+            return
+        temp_manifest_file = "{0}.{1}.tmp".format(self.lsm_manifest_file,
+                                                  os.getpid())
+        with open(temp_manifest_file, "w") as manifest:
+            json.dump({
+                'version': self.version,
+                'lsm_data_location': self.lsm_data_location,
+                'file_datetime_pattern': self.file_datetime_pattern,
+                'directories': self.directories,
+                'files': self.files,
+            }, manifest)
+        if os.path.exists(self.lsm_manifest_file):
+            os.remove(self.lsm_manifest_file)
+        os.rename(temp_manifest_file, self.lsm_manifest_file)
+
+    def _get_file_info(self, lsm_file):
+        """
+        Get the manifest entry of an LSM file
+        """
+        return self.files[os.path.relpath(lsm_file, self.lsm_data_location)]
+
+    def get_file_list(self, file_endings):
+        """
+        Get the sorted list of LSM files ending with one of
+        *file_endings*.
+        """
+        return sorted(os.path.join(self.lsm_data_location, relative_path)
+                      for relative_path in self.files
+                      if relative_path.endswith(tuple(file_endings)))
+
+    def get_file_size(self, lsm_file):
+        """
+        Get the size of an LSM file in bytes
+        """
+        return self._get_file_info(lsm_file)['size']
+
+    def get_file_datetime(self, lsm_file, file_re_match,
+                          file_datetime_pattern):
+        """
+        Get the datetime in the name of an LSM file
+        """
+        datetime_pattern = [file_re_match.pattern, file_datetime_pattern]
+        if datetime_pattern != self.file_datetime_pattern:
+            for file_info in self.files.values():
+                file_info.pop('file_datetime', None)
+            self.file_datetime_pattern = datetime_pattern
+
+        file_info = self._get_file_info(lsm_file)
+        if 'file_datetime' not in file_info:
+            file_info['file_datetime'] = datetime.strptime(
+                file_re_match.search(lsm_file).group(0),
+                file_datetime_pattern).isoformat()
+        return pd.Timestamp(file_info['file_datetime']).to_pydatetime()
+
+    def get_file_time_info_list(self, lsm_file_list, lsm_grid_info,
+                                num_processes=1):
+        """
+        Get the time and grid information of a list of LSM files.
+        Files not in the manifest yet are read with up to
+        *num_processes* processes. See :func:`read_lsm_file_info`.
+        """
+        missing_file_list = [lsm_file for lsm_file in lsm_file_list
+                             if 'time_size' not in
+                             self._get_file_info(lsm_file)]
+        if missing_file_list:
+            print("Reading time information from {0} LSM files ..."
+                  .format(len(missing_file_list)))
+            missing_info_list = \
+                read_lsm_file_info_list(missing_file_list,
+                                        lsm_grid_info['time_var'],
+                                        lsm_grid_info['time_dim'],
+                                        num_processes)
+            for lsm_file, lsm_file_info in zip(missing_file_list,
+                                               missing_info_list):
+                self._get_file_info(lsm_file).update(lsm_file_info)
+
+        return [self._get_file_info(lsm_file) for lsm_file in lsm_file_list]
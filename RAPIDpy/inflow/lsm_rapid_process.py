@@ -6,6 +6,7 @@
    Created by Alan D. Snow, 2015.
    License: BSD 3-Clause
 """
+from copy import copy
 from datetime import datetime, timedelta
 import multiprocessing
 import os
@@ -14,12 +15,14 @@ import traceback
 
 # external packages
 import pandas as pd
-#import pangaea
 from netCDF4 import Dataset
 import numpy as np
 
 # local imports
 from ..rapid import RAPID
+from ..scheduler import RAPIDScheduler
+from .CreateInflowFileFromGriddedRunoff import \
+    CreateInflowFileFromGriddedRunoff
 from .CreateInflowFileFromERAInterimRunoff import \
     CreateInflowFileFromERAInterimRunoff
 from .CreateInflowFileFromERA5Runoff import \
@@ -27,14 +30,12 @@ from .CreateInflowFileFromERA5Runoff import \
 from .CreateInflowFileFromLDASRunoff import CreateInflowFileFromLDASRunoff
 from .CreateInflowFileFromWRFHydroRunoff import \
     CreateInflowFileFromWRFHydroRunoff
+from .lsm_manifest import LSMFileManifest, read_lsm_file_info_list
 from ..postprocess.generate_return_periods import generate_return_periods
 from ..postprocess.generate_seasonal_averages import generate_seasonal_averages
 from ..utilities import (case_insensitive_file_search,
                          get_valid_directory_list,
-                         partition)
-
-from ..pangaea.read import open_mfdataset
-
+                         size_partition)
 
 
 # -----------------------------------------------------------------------------
@@ -53,7 +54,11 @@ def generate_inflows_from_runoff(args):
     mp_lock = args[6]
     steps_per_file = args[7]
     convert_one_hour_to_three = args[8]
-    
+    write_queue = args[9]
+    time_block_size = args[10]
+    read_ahead_blocks = args[11]
+    use_float32 = args[12]
+
     time_start_all = datetime.utcnow()
 
     if not isinstance(runoff_file_list, list):
@@ -85,7 +90,11 @@ def generate_inflows_from_runoff(args):
                                       mp_lock=mp_lock,
                                       steps_per_file=steps_per_file,
                                       convert_one_hour_to_three=\
-                                      convert_one_hour_to_three)
+                                      convert_one_hour_to_three,
+                                      write_queue=write_queue,
+                                      time_block_size=time_block_size,
+                                      read_ahead_blocks=read_ahead_blocks,
+                                      use_float32=use_float32)
         except Exception:
             # This prints the type, value, and stack trace of the
             # current exception being handled.
@@ -97,6 +106,315 @@ def generate_inflows_from_runoff(args):
               .format(time_finish_ecmwf-time_start_all))
 
 
+def get_inflow_time_chunk_size(inflow_nc):
+    """
+    Get the number of time steps in the chunks of the inflow in
+    a RAPID inflow file or None if it is not chunked along time.
+    """
+    chunking = inflow_nc.variables['m3_riv'].chunking()
+    if chunking in (None, 'contiguous') or chunking[0] <= 1:
+        return None
+    return chunking[0]
+
+
+def _flush_inflow_buffer(m3_riv_var, inflow_buffer, time_chunk_size=None,
+                         time_size=None):
+    """
+    Write the buffered inflow blocks with one write for
+    each contiguous range of time.
+
+    The buffer has (arrival, inflow) for each time index. If
+    *time_chunk_size* is given, only the whole chunks of time in each
+    range are written so that each chunk of a compressed file is only
+    compressed once. The chunk at the end of a time dimension with
+    *time_size* time steps counts as whole. The rest of each range
+    stays in the buffer with the earliest arrival of its blocks.
+    """
+    run_list = []
+    for time_index in sorted(inflow_buffer):
+        arrival, inflow_data = inflow_buffer[time_index]
+        if not run_list or time_index != run_list[-1][1]:
+            run_list.append([time_index, time_index, arrival, []])
+        run_list[-1][1] += inflow_data.shape[0]
+        run_list[-1][2] = min(run_list[-1][2], arrival)
+        run_list[-1][3].append(inflow_data)
+
+    inflow_buffer.clear()
+    for run_start, run_end, arrival, run_blocks in run_list:
+        write_start, write_end = run_start, run_end
+        if time_chunk_size:
+            write_start = -(-run_start // time_chunk_size) * time_chunk_size
+            if time_size is None or run_end < time_size:
+                write_end = run_end // time_chunk_size * time_chunk_size
+
+        run_data = np.concatenate(run_blocks)
+        if write_start >= write_end:
+            inflow_buffer[run_start] = (arrival, run_data)
+            continue
+        m3_riv_var[write_start:write_end, :] = \
+            run_data[write_start - run_start:write_end - run_start]
+        if write_start > run_start:
+            inflow_buffer[run_start] = \
+                (arrival, run_data[:write_start - run_start])
+        if write_end < run_end:
+            inflow_buffer[write_end] = \
+                (arrival, run_data[write_end - run_start:])
+
+
+def get_inflow_manifest_file(rapid_inflow_file):
+    """
+    Get the path to the file next to the RAPID inflow file with
+    the LSM indices that have been written to the inflow file.
+    """
+    return "{0}_completed.csv".format(os.path.splitext(rapid_inflow_file)[0])
+
+
+def read_inflow_manifest(rapid_inflow_file, lsm_file_list):
+    """
+    Get the indices in *lsm_file_list* that have been written to the
+    RAPID inflow file. An index only counts if the LSM file name
+    recorded for it is the same as in *lsm_file_list*.
+    """
+    completed_index_set = set()
+    manifest_file = get_inflow_manifest_file(rapid_inflow_file)
+    if not os.path.exists(manifest_file):
+        return completed_index_set
+
+    with open(manifest_file) as manifest:
+        for manifest_line in manifest:
+            manifest_row = manifest_line.strip().split(",")
+            # the last line may be incomplete if the writer was stopped
+            if len(manifest_row) != 2 or not manifest_row[0].isdigit():
+                continue
+            lsm_index = int(manifest_row[0])
+            if lsm_index < len(lsm_file_list) and \
+                    get_lsm_file_name(lsm_file_list[lsm_index]) == \
+                    manifest_row[1]:
+                completed_index_set.add(lsm_index)
+    return completed_index_set
+
+
+def get_inflow_file_time_size(rapid_inflow_file):
+    """
+    Get the number of time steps in the RAPID inflow file
+    or None if it does not exist or cannot be read.
+    """
+    if not os.path.exists(rapid_inflow_file):
+        return None
+    try:
+        with Dataset(rapid_inflow_file) as inflow_nc:
+            return len(inflow_nc.variables['m3_riv'])
+    except (IOError, OSError, RuntimeError, KeyError):
+        return None
+
+
+def get_lsm_file_name(lsm_file):
+    """
+    Name of the LSM file (or first in a group of LSM files)
+    used to identify it in the inflow manifest
+    """
+    if isinstance(lsm_file, list):
+        lsm_file = lsm_file[0]
+    return os.path.basename(lsm_file)
+
+
+def _flush_inflow_files(rapid_inflow_file_list, inflow_nc_list,
+                        inflow_buffer_list, completed_list,
+                        align_chunks=False):
+    """
+    Write the buffered inflow to the inflow files and then record the
+    completed LSM indices in the inflow manifests.
+
+    The completed list has (arrival, LSM index, LSM file name). With
+    *align_chunks*, only whole chunks of time are written (see
+    :func:`_flush_inflow_buffer`) and the LSM indices completed after
+    the earliest arrival of the inflow left in the buffers are kept in
+    the list. Returns the number of bytes left in the buffers.
+    """
+    for inflow_nc, inflow_buffer in zip(inflow_nc_list, inflow_buffer_list):
+        time_chunk_size = None
+        time_size = None
+        if align_chunks:
+            time_chunk_size = get_inflow_time_chunk_size(inflow_nc)
+            if not inflow_nc.dimensions['time'].isunlimited():
+                time_size = len(inflow_nc.dimensions['time'])
+        _flush_inflow_buffer(inflow_nc.variables['m3_riv'], inflow_buffer,
+                             time_chunk_size, time_size)
+        inflow_nc.sync()
+
+    buffer_arrival_list = [arrival for inflow_buffer in inflow_buffer_list
+                           for arrival, _ in inflow_buffer.values()]
+    buffer_bytes = sum(inflow_data.nbytes
+                       for inflow_buffer in inflow_buffer_list
+                       for _, inflow_data in inflow_buffer.values())
+    written_completed_list = completed_list[:]
+    if buffer_arrival_list:
+        first_buffer_arrival = min(buffer_arrival_list)
+        written_completed_list = [completed for completed in completed_list
+                                  if completed[0] < first_buffer_arrival]
+
+    if written_completed_list:
+        for rapid_inflow_file in rapid_inflow_file_list:
+            manifest_file = get_inflow_manifest_file(rapid_inflow_file)
+            # end a line left incomplete by an interrupted writer
+            incomplete_line = False
+            if os.path.exists(manifest_file) and \
+                    os.path.getsize(manifest_file) > 0:
+                with open(manifest_file, "rb") as manifest:
+                    manifest.seek(-1, os.SEEK_END)
+                    incomplete_line = manifest.read(1) != b"\n"
+            with open(manifest_file, "a") as manifest:
+                if incomplete_line:
+                    manifest.write("\n")
+                for _, lsm_index, lsm_file_name in written_completed_list:
+                    manifest.write("{0},{1}\n".format(lsm_index,
+                                                      lsm_file_name))
+        # the completed list is in order of arrival
+        del completed_list[:len(written_completed_list)]
+    return buffer_bytes
+
+
+def _sum_inflow_time_steps(inflow_buffer, partial_inflow_buffer,
+                           time_index, inflow_data, time_step_factor,
+                           arrival):
+    """
+    Sum the inflow of the LSM time steps starting at *time_index*
+    into inflow time steps of *time_step_factor* LSM time steps.
+
+    Inflow time steps with the inflow of all of their LSM time steps
+    are added to *inflow_buffer*. The others are kept in
+    *partial_inflow_buffer* as [number of LSM time steps, inflow]
+    until the rest of their inflow arrives from the same or another
+    LSM file. Inflow time steps are added with *arrival*. Returns the
+    number of bytes added to *inflow_buffer*.
+    """
+    out_time_indices = \
+        (time_index + np.arange(inflow_data.shape[0])) // time_step_factor
+    start_indices = \
+        np.concatenate([[0], np.flatnonzero(np.diff(out_time_indices)) + 1])
+    step_counts = np.diff(np.append(start_indices, inflow_data.shape[0]))
+    inflow_sums = np.add.reduceat(inflow_data.astype(np.float64),
+                                  start_indices, axis=0)
+
+    added_bytes = 0
+    for out_time_index, step_count, inflow_sum in \
+            zip(out_time_indices[start_indices], step_counts, inflow_sums):
+        if out_time_index in partial_inflow_buffer:
+            partial_step_count, partial_inflow_sum = \
+                partial_inflow_buffer.pop(out_time_index)
+            step_count += partial_step_count
+            inflow_sum = inflow_sum + partial_inflow_sum
+        if step_count < time_step_factor:
+            partial_inflow_buffer[out_time_index] = [step_count, inflow_sum]
+            continue
+        inflow_buffer[out_time_index] = \
+            (arrival, inflow_sum.astype(np.float32).reshape(1, -1))
+        added_bytes += inflow_buffer[out_time_index][1].nbytes
+    return added_bytes
+
+
+def write_inflows_from_queue(rapid_inflow_file_list, write_queue,
+                             max_buffer_bytes=256 * 1024 ** 2,
+                             max_buffer_seconds=60,
+                             time_step_factor=1):
+    """
+    Write the inflow computed by generate_inflows_from_runoff to the
+    RAPID inflow files. This is the only process with the inflow
+    files open. Blocks are buffered and contiguous time ranges are
+    written together. Stops when None is received from the queue.
+
+    Messages with an output index of None mark an LSM index as
+    complete. These are recorded in the inflow manifest next to each
+    inflow file once the inflow is written so that an interrupted run
+    can be resumed. The buffer is written at least every
+    *max_buffer_seconds* when there are completed LSM indices.
+
+    If *time_step_factor* is more than 1, the time indices of the
+    messages are LSM time steps and the inflow of every
+    *time_step_factor* LSM time steps is summed into one inflow time
+    step (see :func:`_sum_inflow_time_steps`).
+
+    Inflow files chunked along time (NETCDF4) are written in whole
+    chunks so that compressed chunks are not read and compressed again.
+    Inflow that does not fill a chunk stays in the buffer until the
+    rest of the chunk arrives or the buffer is full.
+    """
+    inflow_nc_list = []
+    inflow_buffer_list = [{} for _ in rapid_inflow_file_list]
+    partial_inflow_buffer_list = [{} for _ in rapid_inflow_file_list]
+    completed_list = []
+    buffer_bytes = 0
+    num_messages = 0
+    last_flush_time = datetime.utcnow()
+    write_error = False
+    try:
+        for rapid_inflow_file in rapid_inflow_file_list:
+            inflow_nc_list.append(Dataset(rapid_inflow_file, "a"))
+    except Exception:
+        traceback.print_exc()
+        write_error = True
+
+    while True:
+        message = write_queue.get()
+        if message is None:
+            break
+        # keep emptying the queue so the workers do not block
+        if write_error:
+            continue
+        num_messages += 1
+        try:
+            out_index, time_index, inflow_data = message
+            if out_index is None:
+                # all of the inflow for the LSM index has been sent
+                completed_list.append((num_messages, time_index,
+                                       inflow_data))
+            elif time_step_factor > 1:
+                buffer_bytes += _sum_inflow_time_steps(
+                    inflow_buffer_list[out_index],
+                    partial_inflow_buffer_list[out_index],
+                    time_index, inflow_data, time_step_factor,
+                    num_messages)
+            else:
+                inflow_buffer_list[out_index][time_index] = \
+                    (num_messages, inflow_data)
+                buffer_bytes += inflow_data.nbytes
+            if buffer_bytes >= max_buffer_bytes or \
+                    (completed_list and
+                     (datetime.utcnow() - last_flush_time).total_seconds()
+                     >= max_buffer_seconds):
+                buffer_bytes = _flush_inflow_files(
+                    rapid_inflow_file_list, inflow_nc_list,
+                    inflow_buffer_list, completed_list, align_chunks=True)
+                # write the partial chunks if they fill the buffer
+                if buffer_bytes >= max_buffer_bytes / 2:
+                    buffer_bytes = _flush_inflow_files(
+                        rapid_inflow_file_list, inflow_nc_list,
+                        inflow_buffer_list, completed_list)
+                last_flush_time = datetime.utcnow()
+        except Exception:
+            traceback.print_exc()
+            write_error = True
+
+    num_partial_time_steps = max(len(partial_inflow_buffer)
+                                 for partial_inflow_buffer
+                                 in partial_inflow_buffer_list)
+    if num_partial_time_steps and not write_error:
+        print("WARNING: {0} inflow time steps without the inflow of all "
+              "of their LSM time steps were not written ..."
+              .format(num_partial_time_steps))
+
+    try:
+        if not write_error:
+            _flush_inflow_files(rapid_inflow_file_list, inflow_nc_list,
+                                inflow_buffer_list, completed_list)
+    finally:
+        for inflow_nc in inflow_nc_list:
+            inflow_nc.close()
+
+    if write_error:
+        raise Exception("ERROR: Writing to the RAPID inflow file failed ...")
+
+
 # -----------------------------------------------------------------------------
 # UTILITY FUNCTIONS
 # -----------------------------------------------------------------------------
@@ -501,13 +819,64 @@ def identify_lsm_grid(lsm_grid_path):
     return lsm_file_data
 
 
+def check_lsm_time_coverage(lsm_file_list, lsm_file_info_list, time_step):
+    """
+    Check that the times in the LSM files increase from file to file
+    and warn about gaps in the times.
+
+    Parameters
+    ----------
+    lsm_file_list: list
+        The sorted list of LSM files.
+    lsm_file_info_list: list
+        The time information of each LSM file
+        (see :func:`RAPIDpy.inflow.lsm_manifest.read_lsm_file_info`).
+    time_step: int
+        The expected number of seconds between times.
+    """
+    gap_list = []
+    previous_time_end = None
+    for lsm_file, lsm_file_info in zip(lsm_file_list, lsm_file_info_list):
+        if not lsm_file_info.get('time_increasing', True):
+            raise ValueError("The times in {0} are not increasing."
+                             .format(lsm_file))
+        if not lsm_file_info.get('time_uniform', True) or \
+                (lsm_file_info['time_size'] > 1 and
+                 int(lsm_file_info['time_step']) != time_step):
+            gap_list.append(lsm_file)
+
+        time_start = pd.to_datetime(lsm_file_info['time_start'])
+        if previous_time_end is not None:
+            time_diff = (time_start - previous_time_end).total_seconds()
+            if time_diff <= 0:
+                raise ValueError("The times in {0} overlap or are before "
+                                 "the times in the previous LSM file."
+                                 .format(lsm_file))
+            if time_diff != time_step:
+                gap_list.append(lsm_file)
+        previous_time_end = pd.to_datetime(lsm_file_info['time_end'])
+
+    if gap_list:
+        print("WARNING: Times in {0} LSM files are not {1} seconds apart. "
+              "First file with a gap: {2}"
+              .format(len(gap_list), time_step, gap_list[0]))
+
+
 def determine_start_end_timestep(lsm_file_list,
                                  file_re_match=None,
                                  file_datetime_pattern=None,
                                  expected_time_step=None,
-                                 lsm_grid_info=None):
+                                 lsm_grid_info=None,
+                                 lsm_file_info_list=None,
+                                 num_processes=1):
     """
     Determine the start and end date from LSM input files
+
+    Only the time variable of each LSM file is read, with up to
+    *num_processes* processes. If *lsm_file_info_list* is given, the
+    time information in it
+    (see :func:`RAPIDpy.inflow.lsm_manifest.read_lsm_file_info`)
+    is used instead of reading the LSM files.
     """
     if lsm_grid_info is None:
         lsm_grid_info = identify_lsm_grid(lsm_file_list[0])
@@ -560,30 +929,35 @@ def determine_start_end_timestep(lsm_file_list,
                               file_datetime_pattern) \
             + timedelta(seconds=(file_size_time-1) * time_step)
     else:
-        with open_mfdataset(lsm_file_list, #pangaea.open_mfdataset
-                                    lat_var=lsm_grid_info['latitude_var'],
-                                    lon_var=lsm_grid_info['longitude_var'],
-                                    time_var=lsm_grid_info['time_var'],
-                                    lat_dim=lsm_grid_info['latitude_dim'],
-                                    lon_dim=lsm_grid_info['longitude_dim'],
-                                    time_dim=lsm_grid_info['time_dim']) as xds:
-
-            datetime_arr = [pd.to_datetime(dval) for dval in
-                            xds.lsm.datetime.values]
-            actual_simulation_start_datetime = datetime_arr[0]
-            actual_simulation_end_datetime = datetime_arr[-1]
-            total_num_time_steps = len(datetime_arr)
-
-            if total_num_time_steps <= 1:
-                if expected_time_step is not None:
-                    time_step = int(expected_time_step)
-                else:
-                    raise ValueError("Only one LSM file with one timestep "
-                                     "present. 'expected_time_step' parameter "
-                                     "required to continue.")
+        if lsm_file_info_list is None:
+            lsm_file_info_list = \
+                read_lsm_file_info_list(lsm_file_list,
+                                        lsm_grid_info['time_var'],
+                                        lsm_grid_info['time_dim'],
+                                        num_processes)
+
+        actual_simulation_start_datetime = \
+            pd.to_datetime(lsm_file_info_list[0]['time_start'])
+        actual_simulation_end_datetime = \
+            pd.to_datetime(lsm_file_info_list[-1]['time_end'])
+        total_num_time_steps = sum(lsm_file_info['time_size']
+                                   for lsm_file_info in lsm_file_info_list)
+
+        if total_num_time_steps <= 1:
+            if expected_time_step is not None:
+                time_step = int(expected_time_step)
             else:
-                time_step = int(np.diff(xds.lsm.datetime.values)[0]
-                                / np.timedelta64(1, 's'))
+                raise ValueError("Only one LSM file with one timestep "
+                                 "present. 'expected_time_step' parameter "
+                                 "required to continue.")
+        elif lsm_file_info_list[0]['time_size'] > 1:
+            time_step = int(lsm_file_info_list[0]['time_step'])
+        else:
+            time_step = int((pd.to_datetime(
+                lsm_file_info_list[1]['time_start']) -
+                actual_simulation_start_datetime).total_seconds())
+
+        check_lsm_time_coverage(lsm_file_list, lsm_file_info_list, time_step)
 
     if expected_time_step is not None:
         if time_step != int(expected_time_step):
@@ -594,6 +968,54 @@ def determine_start_end_timestep(lsm_file_list,
             time_step, total_num_time_steps)
 
 
+def find_incremental_inflow_start(rapid_inflow_file,
+                                  rapid_inflow_file_start,
+                                  ensemble_file_ending,
+                                  rapid_inflow_tool,
+                                  simulation_start_datetime,
+                                  time_step,
+                                  steps_per_lsm_index,
+                                  num_lsm_indices):
+    """
+    Find the inflow file in the directory of *rapid_inflow_file* with
+    the same start and rename it to *rapid_inflow_file*.
+
+    Returns the index of the first LSM file (or group of LSM files)
+    not in the inflow file or None if there is no inflow file
+    that can be added to.
+    """
+    rapid_inflow_directory = os.path.dirname(rapid_inflow_file)
+    rapid_inflow_file_re = re.compile(r"{0}to\d{{8}}{1}$".format(
+        re.escape(rapid_inflow_file_start),
+        re.escape(ensemble_file_ending)))
+    existing_inflow_file_list = \
+        sorted(inflow_file for inflow_file
+               in os.listdir(rapid_inflow_directory)
+               if rapid_inflow_file_re.match(inflow_file))
+    if not existing_inflow_file_list:
+        return None
+
+    existing_inflow_file = os.path.join(rapid_inflow_directory,
+                                        existing_inflow_file_list[-1])
+    number_of_timesteps = \
+        rapid_inflow_tool.get_number_of_output_timesteps(
+            existing_inflow_file, simulation_start_datetime, time_step)
+    if number_of_timesteps is None or \
+            number_of_timesteps > steps_per_lsm_index * num_lsm_indices:
+        print("WARNING: Unable to add to inflow file {0}. "
+              "Generating the inflow file ...".format(existing_inflow_file))
+        return None
+
+    if existing_inflow_file != rapid_inflow_file:
+        os.rename(existing_inflow_file, rapid_inflow_file)
+        existing_manifest_file = \
+            get_inflow_manifest_file(existing_inflow_file)
+        if os.path.exists(existing_manifest_file):
+            os.rename(existing_manifest_file,
+                      get_inflow_manifest_file(rapid_inflow_file))
+    return number_of_timesteps // steps_per_lsm_index
+
+
 # ------------------------------------------------------------------------------
 # MAIN PROCESS
 # ------------------------------------------------------------------------------
@@ -622,7 +1044,22 @@ def run_lsm_rapid_process(rapid_executable_location,
                           modeling_institution="US Army Engineer Research "
                                                "and Development Center",
                           convert_one_hour_to_three=False,
-                          expected_time_step=None):
+                          expected_time_step=None,
+                          single_pass_multi_watershed=False,
+                          lsm_time_block_size=None,
+                          incremental_inflow=False,
+                          resume_inflow=False,
+                          lsm_manifest_file=None,
+                          num_parallel_ensembles=1,
+                          lsm_accumulation_reset_steps=None,
+                          inflow_time_step=None,
+                          lsm_read_ahead_blocks=None,
+                          lsm_use_float32=False,
+                          inflow_file_format="NETCDF3_CLASSIC",
+                          inflow_chunksizes=None,
+                          inflow_complevel=4,
+                          run_watersheds_concurrently=False,
+                          weight_table_cache_directory=None):
     # pylint: disable=anomalous-backslash-in-string
     """
     This is the main process to generate inflow for RAPID and to run RAPID.
@@ -703,6 +1140,94 @@ def run_lsm_rapid_process(rapid_executable_location,
     expected_time_step: int, optional
         The time step in seconds of your LSM input data if only one file
         is given. Required if only one file is present.
+    single_pass_multi_watershed: bool, optional
+        If True, the inflow for all of the watersheds in
+        `rapid_io_files_location` is generated in one pass that reads
+        each LSM file once. Default is False.
+    lsm_time_block_size: int, optional
+        If set, LSM files with multiple time steps are converted to
+        inflow this many time steps at a time instead of loading the
+        whole file into memory. Use this for long (e.g. yearly) files.
+        Default is None.
+    incremental_inflow: bool, optional
+        If True, the inflow file in the output directory with the same
+        start date is extended with the inflow from the LSM files after
+        the ones already in it instead of generating the inflow file
+        again. The file is renamed with the new end date. New inflow
+        files are created with an unlimited time dimension to allow
+        this. Default is False.
+    resume_inflow: bool, optional
+        If True and the inflow file exists, only the LSM files not yet
+        recorded as written in the inflow manifest next to the inflow
+        file (\*_completed.csv) are processed. Use this to restart a run
+        that was stopped part way through. Default is False.
+    lsm_manifest_file: str, optional
+        Path to a JSON file to keep the list of LSM files with their
+        time and grid information in between runs. Only new or changed
+        LSM files and directories are scanned and read when it is set.
+        Default is None.
+    num_parallel_ensembles: int, optional
+        The number of ensembles in `ensemble_list` to generate inflow
+        for at the same time. Their inflow jobs share the processors
+        and RAPID runs for each ensemble in the background while the
+        next ensembles generate inflow. All of the ensembles must be on
+        the same grid. Default is 1.
+    lsm_accumulation_reset_steps: int, optional
+        If set, the LSM runoff is accumulated over time with the
+        accumulation reset every this many time steps from the start
+        of each file (e.g. forecast runoff accumulated from the start
+        of the forecast). It is converted to the runoff in each time
+        step before generating the inflow. ERA Interim T255 runoff is
+        converted with 4 if this is not set. Default is None.
+    inflow_time_step: int, optional
+        The time step in seconds of the inflow file if it is longer
+        than the LSM time step (e.g. 10800 for 3-hourly inflow from
+        hourly LSM files). It must be a multiple of the LSM time step.
+        The inflow of the LSM time steps is summed as it is written,
+        including inflow time steps that span several LSM files.
+        LSM time steps at the end that do not make a whole inflow
+        time step are not used. Default is None.
+    lsm_read_ahead_blocks: int, optional
+        If set, each process reads the LSM files in a thread up to this
+        many files (or time blocks with `lsm_time_block_size`) ahead of
+        the one being converted to inflow so that reading the files
+        overlaps with the conversion. This is the maximum number of
+        blocks of runoff waiting in memory in each process. Use this
+        when reading the LSM files is slow (e.g. on network storage).
+        Default is None.
+    lsm_use_float32: bool, optional
+        If True, the LSM runoff is read without masked arrays and
+        converted to inflow in float32, the data type of the inflow
+        file, which uses half of the memory and is faster. The inflow
+        is the same as with the default float64 to a relative tolerance
+        of 1e-5. Runoff accumulated over time is still converted in
+        float64. Default is False.
+    inflow_file_format: str, optional
+        The netCDF format of the inflow files. Use "NETCDF4" for
+        inflow files too large for the NETCDF3 formats or to compress
+        them. RAPID must be built with a netCDF library with NETCDF4
+        support to read them. Default is "NETCDF3_CLASSIC".
+    inflow_chunksizes: tuple, optional
+        The (time, rivid) chunk sizes of the inflow in NETCDF4 inflow
+        files. By default, chunks of up to 4 MiB have all of the river
+        reaches and as many time steps as fit. The inflow is written in
+        whole chunks of time. Default is None.
+    inflow_complevel: int, optional
+        The zlib compression level (1-9) of the inflow in NETCDF4 inflow
+        files with the shuffle filter. 0 turns off compression.
+        Default is 4.
+    run_watersheds_concurrently: bool, optional
+        If True, RAPID runs for the watersheds of an ensemble at the same
+        time with the processors divided among them by their number of
+        river reaches (See: :class:`~RAPIDpy.scheduler.RAPIDScheduler`).
+        The output of each watershed is processed as soon as its
+        simulation finishes. Default is False.
+    weight_table_cache_directory: str, optional
+        If set, the weight tables are compiled once into this directory
+        and the inflow processes memory map the compiled weight tables
+        instead of reading the weight table CSV files. The compiled
+        weight tables are rebuilt when the CSV files change.
+        Default is None.
 
 
     Returns
@@ -811,11 +1336,12 @@ def run_lsm_rapid_process(rapid_executable_location,
                          "'rapid_input_location' and 'rapid_output_location'"
                          " set to continue.")
 
-    all_output_file_information = []
+    # scan the LSM files once for all of the ensembles
+    lsm_manifest = LSMFileManifest(lsm_data_location, lsm_manifest_file)
+    lsm_manifest.update()
+
+    ensemble_file_list = []
     for ensemble in ensemble_list:
-        output_file_information = {
-            'ensemble': ensemble,
-        }
         ensemble_file_ending = ".nc"
         ensemble_file_ending4 = ".nc4"
         if ensemble is not None:
@@ -823,48 +1349,92 @@ def run_lsm_rapid_process(rapid_executable_location,
             ensemble_file_ending4 = "_{0}.nc4".format(ensemble)
 
         # get list of files
-        lsm_file_list = []
-        for walkdir_info in os.walk(lsm_data_location,
-                                    followlinks=True):
-            for lsm_file in walkdir_info[2]:
-                if lsm_file.endswith(ensemble_file_ending) or \
-                        lsm_file.endswith(ensemble_file_ending4):
-                    lsm_file_list.append(
-                        os.path.join(walkdir_info[0], lsm_file))
-        lsm_file_list = sorted(lsm_file_list)
-
-        # IDENTIFY THE GRID
-        lsm_file_data = identify_lsm_grid(lsm_file_list[0])
- 
-        # load in the datetime pattern
-        if file_datetime_pattern is None or file_datetime_re_pattern is None:
-            file_datetime_re_pattern = \
-                DEFAULT_LSM_INPUTS[lsm_file_data['grid_type']][
-                    'file_datetime_re_pattern']
-            file_datetime_pattern = \
-                DEFAULT_LSM_INPUTS[lsm_file_data['grid_type']][
-                    'file_datetime_pattern']
-        file_re_match = re.compile(file_datetime_re_pattern)
-
-        # get subset based on time bounds
-        if simulation_start_datetime is not None:
-            print("Filtering files by datetime ...")
+        lsm_file_list = lsm_manifest.get_file_list(
+            (ensemble_file_ending, ensemble_file_ending4))
+        ensemble_file_list.append([ensemble, ensemble_file_ending,
+                                   lsm_file_list])
+
+    # IDENTIFY THE GRID once as the ensembles share the grid
+    lsm_file_data = identify_lsm_grid(ensemble_file_list[0][2][0])
+    lsm_file_data['rapid_inflow_tool'].accumulation_reset_steps = \
+        lsm_accumulation_reset_steps
+    lsm_file_data['rapid_inflow_tool'].weight_table_cache_directory = \
+        weight_table_cache_directory
+
+    # load in the datetime pattern
+    if file_datetime_pattern is None or file_datetime_re_pattern is None:
+        file_datetime_re_pattern = \
+            DEFAULT_LSM_INPUTS[lsm_file_data['grid_type']][
+                'file_datetime_re_pattern']
+        file_datetime_pattern = \
+            DEFAULT_LSM_INPUTS[lsm_file_data['grid_type']][
+                'file_datetime_pattern']
+    file_re_match = re.compile(file_datetime_re_pattern)
+
+    # get subset based on time bounds
+    if simulation_start_datetime is not None:
+        print("Filtering files by datetime ...")
+        for ensemble_files in ensemble_file_list:
             lsm_file_list_subset = []
-            for lsm_file in lsm_file_list:
-                match = file_re_match.search(lsm_file)
-                file_date = datetime.strptime(match.group(0),
-                                              file_datetime_pattern)
+            for lsm_file in ensemble_files[2]:
+                file_date = lsm_manifest.get_file_datetime(
+                    lsm_file, file_re_match, file_datetime_pattern)
                 if file_date > simulation_end_datetime:
                     break
                 if file_date >= simulation_start_datetime:
                     lsm_file_list_subset.append(lsm_file)
 
-            lsm_file_list = sorted(lsm_file_list_subset)
+            ensemble_files[2] = sorted(lsm_file_list_subset)
+
+    # read the time information of the files of all of the ensembles
+    # at once so that the reads are spread over the processors
+    use_lsm_file_info = \
+        None not in (lsm_file_data['time_var'], lsm_file_data['time_dim']) \
+        and lsm_file_data['model_name'] not in ('era_20cm', 'erai')
+    if use_lsm_file_info:
+        lsm_manifest.get_file_time_info_list(
+            [lsm_file for ensemble_files in ensemble_file_list
+             for lsm_file in ensemble_files[2]],
+            lsm_file_data,
+            num_cpus)
+    lsm_manifest.save()
+
+    # compile the weight tables once for all of the ensembles
+    # so that the workers only load them
+    if weight_table_cache_directory is not None:
+        weight_table_tool = CreateInflowFileFromGriddedRunoff()
+        weight_table_tool.weight_table_cache_directory = \
+            weight_table_cache_directory
+        for master_watershed_input_directory, _ in rapid_directories:
+            weight_table_tool.read_in_weight_table(
+                case_insensitive_file_search(
+                    master_watershed_input_directory,
+                    lsm_file_data['weight_file_name']))
+
+    def prepare_ensemble(ensemble, ensemble_file_ending, lsm_file_list):
+        """
+        Determine the time steps of an ensemble and create the inflow
+        files for it.
+        """
+        output_file_information = {
+            'ensemble': ensemble,
+        }
 
         print("Running from {0} to {1}".format(lsm_file_list[0],
                                                lsm_file_list[-1]))
 
         # get number of time steps in file
+        lsm_file_info_list = None
+        if use_lsm_file_info:
+            lsm_file_info_list = \
+                lsm_manifest.get_file_time_info_list(lsm_file_list,
+                                                     lsm_file_data)
+            lsm_grid_set = set(lsm_file_info['grid']
+                               for lsm_file_info in lsm_file_info_list)
+            if len(lsm_grid_set) > 1:
+                print("WARNING: The LSM files have {0} different grids: {1}"
+                      .format(len(lsm_grid_set), sorted(lsm_grid_set)))
+
         actual_simulation_start_datetime, actual_simulation_end_datetime, \
             time_step, total_num_time_steps = \
             determine_start_end_timestep(
@@ -872,7 +1442,8 @@ def run_lsm_rapid_process(rapid_executable_location,
                 file_re_match=file_re_match,
                 file_datetime_pattern=file_datetime_pattern,
                 expected_time_step=expected_time_step,
-                lsm_grid_info=lsm_file_data)
+                lsm_grid_info=lsm_file_data,
+                lsm_file_info_list=lsm_file_info_list)
 
         steps_per_file = int(total_num_time_steps / len(lsm_file_list))
         file_timestep_is_hourly = (time_step == 3600)
@@ -913,16 +1484,61 @@ def run_lsm_rapid_process(rapid_executable_location,
                     "Conversion to three-hourly timestep is not supported " +
                     "for {0} data.".format(lsm_file_data['model_name']))
 
+        # sum the LSM time steps to the inflow time step
+        lsm_time_step = time_step
+        inflow_time_step_factor = 1
+        if inflow_time_step is not None and \
+                int(inflow_time_step) != time_step:
+            if convert_one_hour_to_three:
+                raise ValueError("'inflow_time_step' cannot be used with "
+                                 "'convert_one_hour_to_three'.")
+            if int(inflow_time_step) % time_step != 0:
+                raise ValueError("The inflow time step of {0} seconds is not "
+                                 "a multiple of the {1} second LSM time step."
+                                 .format(inflow_time_step, time_step))
+            inflow_time_step_factor = int(inflow_time_step) // time_step
+            if steps_per_file % inflow_time_step_factor != 0 and \
+                    (incremental_inflow or resume_inflow):
+                raise ValueError("'incremental_inflow' and 'resume_inflow' "
+                                 "require the LSM files to contain whole "
+                                 "inflow time steps.")
+            num_extra_steps = \
+                int(total_num_time_steps) % inflow_time_step_factor
+            if num_extra_steps != 0:
+                print("WARNING: Number of LSM time steps needs to be "
+                      "divisible by {0}. Remainder is {1}"
+                      .format(inflow_time_step_factor, num_extra_steps))
+                print("This means your simulation will be truncated")
+            total_num_time_steps = \
+                int(total_num_time_steps) // inflow_time_step_factor
+            time_step *= inflow_time_step_factor
+
         # compile the file ending
-        out_file_ending = "{0}_{1}_{2}hr_{3:%Y%m%d}to{4:%Y%m%d}{5}"\
+        out_file_start = "{0}_{1}_{2}hr_{3:%Y%m%d}"\
             .format(lsm_file_data['model_name'],
                     lsm_file_data['grid_type'],
                     int(time_step/3600),
-                    actual_simulation_start_datetime,
+                    actual_simulation_start_datetime)
+        out_file_ending = "{0}to{1:%Y%m%d}{2}"\
+            .format(out_file_start,
                     actual_simulation_end_datetime,
                     ensemble_file_ending)
 
-        # run LSM processes
+        if (lsm_file_data['grid_type'] in ('nldas', 'lis', 'joules')) \
+                and convert_one_hour_to_three:
+            print("Grouping {0} in threes"
+                  .format(lsm_file_data['grid_type']))
+            lsm_file_list = [lsm_file_list[nldas_index:nldas_index+3]
+                             for nldas_index in
+                             range(0, len(lsm_file_list), 3)
+                             if len(lsm_file_list[
+                                    nldas_index:nldas_index+3]) == 3]
+
+        ensemble_num_cpus = min(num_cpus, len(lsm_file_list))
+        steps_per_lsm_index = int(total_num_time_steps) // len(lsm_file_list)
+
+        # prepare the inflow file for each watershed
+        watershed_list = []
         for master_watershed_input_directory, \
                 master_watershed_output_directory in rapid_directories:
             print("Running from: {0}".format(master_watershed_input_directory))
@@ -950,177 +1566,474 @@ def run_lsm_rapid_process(rapid_executable_location,
                 print("WARNING: comid_lat_lon_z file not found."
                       " The lat/lon will not be added ...")
 
-            print("Writing inflow file to: {0}"
-                  .format(master_rapid_runoff_file))
-            lsm_file_data['rapid_inflow_tool'].generateOutputInflowFile(
-                out_nc=master_rapid_runoff_file,
-                start_datetime_utc=actual_simulation_start_datetime,
-                number_of_timesteps=total_num_time_steps,
-                simulation_time_step_seconds=time_step,
-                in_rapid_connect_file=case_insensitive_file_search(
-                    master_watershed_input_directory,
-                    r'rapid_connect\.csv'),
-                in_rivid_lat_lon_z_file=in_rivid_lat_lon_z_file,
-                land_surface_model_description=lsm_file_data['description'],
-                modeling_institution=modeling_institution
-            )
-
-            job_combinations = []
-            if (lsm_file_data['grid_type'] in ('nldas', 'lis', 'joules')) \
-                    and convert_one_hour_to_three:
-                print("Grouping {0} in threes"
-                      .format(lsm_file_data['grid_type']))
-                lsm_file_list = [lsm_file_list[nldas_index:nldas_index+3]
-                                 for nldas_index in
-                                 range(0, len(lsm_file_list), 3)
-                                 if len(lsm_file_list[
-                                        nldas_index:nldas_index+3]) == 3]
-
-            if len(lsm_file_list) < num_cpus:
-                num_cpus = len(lsm_file_list)
-            # pylint: disable=no-member
-            mp_lock = multiprocessing.Manager().Lock()
-            partition_list, partition_index_list = \
-                partition(lsm_file_list, num_cpus)
-
-            for loop_index, cpu_grouped_file_list in enumerate(partition_list):
-                if cpu_grouped_file_list and partition_index_list[loop_index]:
-                    job_combinations.append((
-                        cpu_grouped_file_list,
-                        partition_index_list[loop_index],
-                        weight_table_file,
-                        lsm_file_data['grid_type'],
-                        master_rapid_runoff_file,
-                        lsm_file_data['rapid_inflow_tool'],
-                        mp_lock,
-                        steps_per_file,
-                        convert_one_hour_to_three_within_file))
-                   # COMMENTED CODE IS FOR DEBUGGING
-                   # generate_inflows_from_runoff((
-                   #    cpu_grouped_file_list,
-                   #    partition_index_list[loop_index],
-                   #    weight_table_file,
-                   #    lsm_file_data['grid_type'],
-                   #    master_rapid_runoff_file,
-                   #    lsm_file_data['rapid_inflow_tool'],
-                   #    mp_lock,
-                   #    steps_per_file,
-                   #    convert_one_hour_to_three_within_file))
-            pool = multiprocessing.Pool(num_cpus)
-            pool.map(generate_inflows_from_runoff,
-                     job_combinations)
-            pool.close()
-            pool.join()
-
-            # set up RAPID manager
-            rapid_manager = RAPID(
-                rapid_executable_location=rapid_executable_location,
-                cygwin_bin_location=cygwin_bin_location,
-                num_processors=num_cpus,
-                mpiexec_command=mpiexec_command,
-                ZS_TauR=time_step,
-                ZS_dtR=15 * 60,
-                ZS_TauM=total_num_time_steps * time_step,
-                ZS_dtM=time_step)
-
-            if initial_flows_file and os.path.exists(initial_flows_file):
-                rapid_manager.update_parameters(
-                    Qinit_file=initial_flows_file,
-                    BS_opt_Qinit=True
+            # index of the first LSM file not in the inflow file
+            inflow_start_index = None
+            if incremental_inflow:
+                inflow_start_index = find_incremental_inflow_start(
+                    master_rapid_runoff_file,
+                    'm3_riv_bas_{0}'.format(out_file_start),
+                    ensemble_file_ending,
+                    lsm_file_data['rapid_inflow_tool'],
+                    actual_simulation_start_datetime,
+                    time_step,
+                    steps_per_lsm_index,
+                    len(lsm_file_list))
+
+            completed_index_set = set()
+            if resume_inflow and inflow_start_index is None and \
+                    get_inflow_file_time_size(master_rapid_runoff_file) \
+                    == int(total_num_time_steps):
+                inflow_start_index = 0
+                completed_index_set = \
+                    read_inflow_manifest(master_rapid_runoff_file,
+                                         lsm_file_list)
+                print("Resuming inflow file: {0} ({1} of {2} complete)"
+                      .format(master_rapid_runoff_file,
+                              len(completed_index_set),
+                              len(lsm_file_list)))
+            elif incremental_inflow and inflow_start_index is not None:
+                completed_index_set = \
+                    read_inflow_manifest(master_rapid_runoff_file,
+                                         lsm_file_list)
+
+            if inflow_start_index is None:
+                inflow_start_index = 0
+                inflow_manifest_file = \
+                    get_inflow_manifest_file(master_rapid_runoff_file)
+                if os.path.exists(inflow_manifest_file):
+                    os.remove(inflow_manifest_file)
+                print("Writing inflow file to: {0}"
+                      .format(master_rapid_runoff_file))
+                lsm_file_data['rapid_inflow_tool'].generateOutputInflowFile(
+                    out_nc=master_rapid_runoff_file,
+                    start_datetime_utc=actual_simulation_start_datetime,
+                    number_of_timesteps=0 if incremental_inflow
+                    else total_num_time_steps,
+                    simulation_time_step_seconds=time_step,
+                    in_rapid_connect_file=case_insensitive_file_search(
+                        master_watershed_input_directory,
+                        r'rapid_connect\.csv'),
+                    in_rivid_lat_lon_z_file=in_rivid_lat_lon_z_file,
+                    land_surface_model_description=lsm_file_data[
+                        'description'],
+                    modeling_institution=modeling_institution,
+                    unlimited_time=incremental_inflow,
+                    file_format=inflow_file_format,
+                    chunksizes=inflow_chunksizes,
+                    complevel=inflow_complevel
                 )
+            else:
+                print("Adding to inflow file: {0}"
+                      .format(master_rapid_runoff_file))
+                lsm_file_data['rapid_inflow_tool'] \
+                    .simulation_time_step_seconds = time_step
+
+            watershed_list.append({
+                'input_directory': master_watershed_input_directory,
+                'output_directory': master_watershed_output_directory,
+                'm3_riv': master_rapid_runoff_file,
+                'weight_table': weight_table_file,
+                'rivid_lat_lon_z': in_rivid_lat_lon_z_file,
+                'inflow_index_list': [
+                    lsm_index for lsm_index
+                    in range(inflow_start_index, len(lsm_file_list))
+                    if lsm_index not in completed_index_set],
+            })
+
+        # generate the inflow for each watershed or for all
+        # watersheds at once reading each LSM file once
+        if single_pass_multi_watershed:
+            print("Generating inflow for all watersheds in one pass ...")
+            inflow_group_list = [
+                ([watershed['weight_table'] for watershed in watershed_list],
+                 [watershed['m3_riv'] for watershed in watershed_list],
+                 sorted(set().union(*[watershed['inflow_index_list']
+                                      for watershed in watershed_list])))
+            ]
+        else:
+            inflow_group_list = [(watershed['weight_table'],
+                                  watershed['m3_riv'],
+                                  watershed['inflow_index_list'])
+                                 for watershed in watershed_list]
+
+        # the size of the files is used to balance the jobs
+        lsm_file_size_list = []
+        for lsm_file in lsm_file_list:
+            if not isinstance(lsm_file, list):
+                lsm_file = [lsm_file]
+            lsm_file_size_list.append(
+                sum(lsm_manifest.get_file_size(lsm_grouped_file)
+                    for lsm_grouped_file in lsm_file))
+
+
+        return {
+            'output_file_information': output_file_information,
+            'lsm_file_list': lsm_file_list,
+            'lsm_file_size_list': lsm_file_size_list,
+            'actual_simulation_start_datetime':
+                actual_simulation_start_datetime,
+            'time_step': time_step,
+            'lsm_time_step': lsm_time_step,
+            'inflow_time_step_factor': inflow_time_step_factor,
+            'total_num_time_steps': total_num_time_steps,
+            'steps_per_file': steps_per_file,
+            'convert_one_hour_to_three_within_file':
+                convert_one_hour_to_three_within_file,
+            'out_file_ending': out_file_ending,
+            'num_cpus': ensemble_num_cpus,
+            'watershed_list': watershed_list,
+            'inflow_group_list': inflow_group_list,
+        }
 
-            # run RAPID for the watershed
-            lsm_rapid_output_file = \
-                os.path.join(master_watershed_output_directory,
-                             'Qout_{0}'.format(out_file_ending))
+    def start_inflow_group(ensemble_run, inflow_group):
+        """
+        Start generating the inflow of a group of inflow files with
+        a writer process for the files.
+        """
+        weight_table_file, master_rapid_runoff_file, inflow_index_list = \
+            inflow_group
+        rapid_inflow_file_list = master_rapid_runoff_file
+        if not isinstance(rapid_inflow_file_list, list):
+            rapid_inflow_file_list = [rapid_inflow_file_list]
+
+        # only the writer process has the inflow files open
+        write_queue = mp_manager.Queue(maxsize=2 * ensemble_run['num_cpus'])
+
+        # the inflow is generated for each LSM time step and the
+        # writer sums it to the inflow time step
+        rapid_inflow_tool = copy(lsm_file_data['rapid_inflow_tool'])
+        rapid_inflow_tool.simulation_time_step_seconds = \
+            ensemble_run['lsm_time_step']
+        # the weight tables are read once here instead of in each job
+        weight_table_list = weight_table_file
+        if not isinstance(weight_table_list, list):
+            weight_table_list = [weight_table_list]
+        rapid_inflow_tool.read_in_weight_tables(weight_table_list)
+
+        # several jobs per CPU with the largest first so that the
+        # workers finish at about the same time
+        partition_index_list = size_partition(
+            inflow_index_list,
+            [ensemble_run['lsm_file_size_list'][lsm_index]
+             for lsm_index in inflow_index_list],
+            ensemble_run['num_cpus'] * 4)[0]
+        job_combinations = []
+        for cpu_grouped_index_list in partition_index_list:
+            if cpu_grouped_index_list:
+                job_combinations.append((
+                    [ensemble_run['lsm_file_list'][lsm_index]
+                     for lsm_index in cpu_grouped_index_list],
+                    cpu_grouped_index_list,
+                    weight_table_file,
+                    lsm_file_data['grid_type'],
+                    master_rapid_runoff_file,
+                    rapid_inflow_tool,
+                    None,
+                    ensemble_run['steps_per_file'],
+                    ensemble_run['convert_one_hour_to_three_within_file'],
+                    write_queue,
+                    lsm_time_block_size,
+                    lsm_read_ahead_blocks,
+                    lsm_use_float32))
+
+        inflow_writer = multiprocessing.Process(
+            target=write_inflows_from_queue,
+            args=(rapid_inflow_file_list, write_queue),
+            kwargs={'time_step_factor':
+                    ensemble_run['inflow_time_step_factor']})
+        inflow_writer.start()
+
+        pool = inflow_pool
+        try:
+            if pool is None:
+                pool = multiprocessing.Pool(ensemble_run['num_cpus'])
+            inflow_result = pool.map_async(generate_inflows_from_runoff,
+                                           job_combinations,
+                                           chunksize=1)
+        except Exception:
+            write_queue.put(None)
+            inflow_writer.join()
+            raise
+
+        return {
+            'rapid_inflow_file_list': rapid_inflow_file_list,
+            'write_queue': write_queue,
+            'inflow_writer': inflow_writer,
+            'inflow_result': inflow_result,
+            'pool': pool,
+        }
+
+    def finish_inflow_group(ensemble_run, inflow_group_run):
+        """
+        Wait for the inflow of a group of inflow files to be written.
+        """
+        try:
+            inflow_group_run['inflow_result'].get()
+        finally:
+            if inflow_group_run['pool'] is not inflow_pool:
+                inflow_group_run['pool'].close()
+                inflow_group_run['pool'].join()
+            inflow_group_run['write_queue'].put(None)
+            inflow_group_run['inflow_writer'].join()
+        if inflow_group_run['inflow_writer'].exitcode != 0:
+            raise Exception("ERROR: Writing the inflow file failed ...")
+
+        # the time is added after the inflow so that the time steps
+        # in the file are only the ones with inflow
+        if incremental_inflow:
+            for rapid_inflow_file in \
+                    inflow_group_run['rapid_inflow_file_list']:
+                lsm_file_data['rapid_inflow_tool'].extend_output_time(
+                    rapid_inflow_file,
+                    ensemble_run['actual_simulation_start_datetime'],
+                    ensemble_run['total_num_time_steps'],
+                    ensemble_run['time_step'])
+
+    def start_routing(ensemble_run, watershed):
+        """
+        Set up RAPID for a watershed and start the simulation.
+        """
+        master_watershed_input_directory = watershed['input_directory']
+        master_rapid_runoff_file = watershed['m3_riv']
+        out_file_ending = ensemble_run['out_file_ending']
+        time_step = ensemble_run['time_step']
+
+        # set up RAPID manager
+        rapid_manager = RAPID(
+            rapid_executable_location=rapid_executable_location,
+            cygwin_bin_location=cygwin_bin_location,
+            num_processors=ensemble_run['num_cpus'],
+            mpiexec_command=mpiexec_command,
+            ZS_TauR=time_step,
+            ZS_dtR=15 * 60,
+            ZS_TauM=ensemble_run['total_num_time_steps'] * time_step,
+            ZS_dtM=time_step)
+
+        if initial_flows_file and os.path.exists(initial_flows_file):
             rapid_manager.update_parameters(
-                rapid_connect_file=case_insensitive_file_search(
-                    master_watershed_input_directory,
-                    r'rapid_connect\.csv'),
-                Vlat_file=master_rapid_runoff_file,
-                riv_bas_id_file=case_insensitive_file_search(
-                    master_watershed_input_directory,
-                    r'riv_bas_id\.csv'),
-                k_file=case_insensitive_file_search(
-                    master_watershed_input_directory,
-                    r'k\.csv'),
-                x_file=case_insensitive_file_search(
-                    master_watershed_input_directory,
-                    r'x\.csv'),
-                Qout_file=lsm_rapid_output_file
+                Qinit_file=initial_flows_file,
+                BS_opt_Qinit=True
             )
 
-            rapid_manager.update_reach_number_data()
+        # run RAPID for the watershed
+        lsm_rapid_output_file = \
+            os.path.join(watershed['output_directory'],
+                         'Qout_{0}'.format(out_file_ending))
+        rapid_manager.update_parameters(
+            rapid_connect_file=case_insensitive_file_search(
+                master_watershed_input_directory,
+                r'rapid_connect\.csv'),
+            Vlat_file=master_rapid_runoff_file,
+            riv_bas_id_file=case_insensitive_file_search(
+                master_watershed_input_directory,
+                r'riv_bas_id\.csv'),
+            k_file=case_insensitive_file_search(
+                master_watershed_input_directory,
+                r'k\.csv'),
+            x_file=case_insensitive_file_search(
+                master_watershed_input_directory,
+                r'x\.csv'),
+            Qout_file=lsm_rapid_output_file
+        )
+
+        rapid_manager.update_reach_number_data()
 
-            output_file_information[
-                os.path.basename(master_watershed_input_directory)] = {
-                    'm3_riv': master_rapid_runoff_file,
-                    'qout': lsm_rapid_output_file
-                }
+        ensemble_run['output_file_information'][
+            os.path.basename(master_watershed_input_directory)] = {
+                'm3_riv': master_rapid_runoff_file,
+                'qout': lsm_rapid_output_file
+            }
 
-            if generate_rapid_namelist_file:
-                rapid_manager.generate_namelist_file(
-                    os.path.join(master_watershed_input_directory,
-                                 "rapid_namelist_{}"
-                                 .format(out_file_ending[:-3])))
-            if run_rapid_simulation:
+        if generate_rapid_namelist_file:
+            rapid_manager.generate_namelist_file(
+                os.path.join(master_watershed_input_directory,
+                             "rapid_namelist_{}"
+                             .format(out_file_ending[:-3])))
+
+        rapid_result = None
+        if run_rapid_simulation and not run_watersheds_concurrently:
+            if routing_pool is None:
                 rapid_manager.run()
+            else:
+                rapid_result = routing_pool.apply_async(rapid_manager.run)
 
-                rapid_manager.make_output_cf_compliant(
-                    simulation_start_datetime=actual_simulation_start_datetime,
-                    comid_lat_lon_z_file=in_rivid_lat_lon_z_file,
-                    project_name="{0} Based Historical flows by {1}"
-                                 .format(lsm_file_data['description'],
-                                         modeling_institution)
-                )
+        return {
+            'watershed': watershed,
+            'rapid_manager': rapid_manager,
+            'rapid_result': rapid_result,
+            'qout': lsm_rapid_output_file,
+        }
 
-                # generate return periods
-                if generate_return_periods_file and \
-                        os.path.exists(lsm_rapid_output_file) and \
-                        lsm_rapid_output_file:
-                    return_periods_file = os.path.join(
-                        master_watershed_output_directory,
-                        'return_periods_{0}'.format(out_file_ending))
-                    # assume storm has 3 day length
-                    storm_length_days = 3
-                    generate_return_periods(
-                        qout_file=lsm_rapid_output_file,
-                        return_period_file=return_periods_file,
-                        num_cpus=num_cpus,
-                        storm_duration_days=storm_length_days,
-                        method=return_period_method)
-
-                # generate seasonal averages file
-                if generate_seasonal_averages_file and \
-                        os.path.exists(lsm_rapid_output_file) and \
-                        lsm_rapid_output_file:
-                    seasonal_averages_file = os.path.join(
-                        master_watershed_output_directory,
-                        'seasonal_averages_{0}'.format(out_file_ending))
-                    generate_seasonal_averages(lsm_rapid_output_file,
-                                               seasonal_averages_file,
-                                               num_cpus)
-
-                # generate seasonal initialization file
-                if generate_seasonal_initialization_file and \
-                        os.path.exists(lsm_rapid_output_file) and \
-                        lsm_rapid_output_file:
-                    seasonal_qinit_file = os.path.join(
-                        master_watershed_input_directory,
-                        'seasonal_qinit_{0}.csv'.format(out_file_ending[:-3]))
-                    rapid_manager.generate_seasonal_intitialization(
-                        seasonal_qinit_file)
-
-                # generate initialization file
-                if generate_initialization_file and \
-                        os.path.exists(lsm_rapid_output_file) and \
-                        lsm_rapid_output_file:
-                    qinit_file = os.path.join(
-                        master_watershed_input_directory,
-                        'qinit_{0}.csv'.format(out_file_ending[:-3]))
-                    rapid_manager.generate_qinit_from_past_qout(qinit_file)
+    def finish_routing(ensemble_run, routing_run):
+        """
+        Wait for the RAPID simulation of a watershed and generate
+        the files from its output.
+        """
+        if not run_rapid_simulation:
+            return
+
+        if routing_run['rapid_result'] is not None:
+            routing_run['rapid_result'].get()
+
+        watershed = routing_run['watershed']
+        master_watershed_input_directory = watershed['input_directory']
+        master_watershed_output_directory = watershed['output_directory']
+        rapid_manager = routing_run['rapid_manager']
+        lsm_rapid_output_file = routing_run['qout']
+        out_file_ending = ensemble_run['out_file_ending']
+
+        rapid_manager.make_output_cf_compliant(
+            simulation_start_datetime=ensemble_run[
+                'actual_simulation_start_datetime'],
+            comid_lat_lon_z_file=watershed['rivid_lat_lon_z'],
+            project_name="{0} Based Historical flows by {1}"
+                         .format(lsm_file_data['description'],
+                                 modeling_institution)
+        )
 
-        all_output_file_information.append(output_file_information)
+        # generate return periods
+        if generate_return_periods_file and \
+                os.path.exists(lsm_rapid_output_file) and \
+                lsm_rapid_output_file:
+            return_periods_file = os.path.join(
+                master_watershed_output_directory,
+                'return_periods_{0}'.format(out_file_ending))
+            # assume storm has 3 day length
+            storm_length_days = 3
+            generate_return_periods(
+                qout_file=lsm_rapid_output_file,
+                return_period_file=return_periods_file,
+                num_cpus=ensemble_run['num_cpus'],
+                storm_duration_days=storm_length_days,
+                method=return_period_method)
+
+        # generate seasonal averages file
+        if generate_seasonal_averages_file and \
+                os.path.exists(lsm_rapid_output_file) and \
+                lsm_rapid_output_file:
+            seasonal_averages_file = os.path.join(
+                master_watershed_output_directory,
+                'seasonal_averages_{0}'.format(out_file_ending))
+            generate_seasonal_averages(lsm_rapid_output_file,
+                                       seasonal_averages_file,
+                                       ensemble_run['num_cpus'])
+
+        # generate seasonal initialization file
+        if generate_seasonal_initialization_file and \
+                os.path.exists(lsm_rapid_output_file) and \
+                lsm_rapid_output_file:
+            seasonal_qinit_file = os.path.join(
+                master_watershed_input_directory,
+                'seasonal_qinit_{0}.csv'.format(out_file_ending[:-3]))
+            rapid_manager.generate_seasonal_intitialization(
+                seasonal_qinit_file)
+
+        # generate initialization file
+        if generate_initialization_file and \
+                os.path.exists(lsm_rapid_output_file) and \
+                lsm_rapid_output_file:
+            qinit_file = os.path.join(
+                master_watershed_input_directory,
+                'qinit_{0}.csv'.format(out_file_ending[:-3]))
+            rapid_manager.generate_qinit_from_past_qout(qinit_file)
+
+    def finish_ensemble_inflow(ensemble_run):
+        """
+        Wait for the inflow of an ensemble and start routing it.
+        """
+        # the inflow of the other groups is written in the meantime
+        for inflow_group_run in ensemble_run['inflow_group_runs']:
+            finish_inflow_group(ensemble_run, inflow_group_run)
+
+        # run RAPID for each watershed
+        rapid_scheduler = None
+        if run_watersheds_concurrently and run_rapid_simulation:
+            rapid_scheduler = RAPIDScheduler(num_cpus)
+        for watershed in ensemble_run['watershed_list']:
+            routing_run = start_routing(ensemble_run, watershed)
+            if rapid_scheduler is not None:
+                # the output is processed while the other watersheds run
+                rapid_scheduler.add_run(
+                    routing_run['rapid_manager'],
+                    finished_callback=lambda _, routing_run=routing_run:
+                    finish_routing(ensemble_run, routing_run))
+            elif routing_pool is None:
+                finish_routing(ensemble_run, routing_run)
+            else:
+                ensemble_run['routing_runs'].append(routing_run)
+        if rapid_scheduler is not None:
+            rapid_scheduler.run()
+
+    # several ensembles can generate inflow at the same time with
+    # their jobs sharing one pool of workers. RAPID then runs in the
+    # background one simulation at a time, as it reads its namelist
+    # from the working directory, while the next ensembles generate
+    # inflow.
+    num_parallel_ensembles = max(1, min(num_parallel_ensembles,
+                                        len(ensemble_list)))
+    # pylint: disable=no-member
+    mp_manager = multiprocessing.Manager()
+    inflow_pool = None
+    routing_pool = None
+    all_output_file_information = []
+    inflow_group_runs = []
+    inflow_ensemble_runs = []
+    routing_ensemble_runs = []
+    try:
+        if num_parallel_ensembles > 1:
+            inflow_pool = multiprocessing.Pool(num_cpus)
+            if not run_watersheds_concurrently:
+                routing_pool = multiprocessing.Pool(1)
+
+        for ensemble, ensemble_file_ending, lsm_file_list in \
+                ensemble_file_list:
+            ensemble_run = prepare_ensemble(ensemble, ensemble_file_ending,
+                                            lsm_file_list)
+            all_output_file_information.append(
+                ensemble_run['output_file_information'])
+
+            ensemble_run['inflow_group_runs'] = []
+            ensemble_run['routing_runs'] = []
+            for inflow_group in ensemble_run['inflow_group_list']:
+                inflow_group_run = start_inflow_group(ensemble_run,
+                                                      inflow_group)
+                inflow_group_runs.append(inflow_group_run)
+                if inflow_pool is None:
+                    finish_inflow_group(ensemble_run, inflow_group_run)
+                else:
+                    ensemble_run['inflow_group_runs'].append(
+                        inflow_group_run)
+            inflow_ensemble_runs.append(ensemble_run)
+
+            if len(inflow_ensemble_runs) >= num_parallel_ensembles:
+                ensemble_run = inflow_ensemble_runs.pop(0)
+                finish_ensemble_inflow(ensemble_run)
+                routing_ensemble_runs.append(ensemble_run)
+
+        while inflow_ensemble_runs:
+            ensemble_run = inflow_ensemble_runs.pop(0)
+            finish_ensemble_inflow(ensemble_run)
+            routing_ensemble_runs.append(ensemble_run)
+
+        for ensemble_run in routing_ensemble_runs:
+            for routing_run in ensemble_run['routing_runs']:
+                finish_routing(ensemble_run, routing_run)
+    except Exception:
+        # stop the jobs and writers of the other ensembles
+        for pool in (inflow_pool, routing_pool):
+            if pool is not None:
+                pool.terminate()
+        for inflow_group_run in inflow_group_runs:
+            if inflow_group_run['inflow_writer'].is_alive():
+                inflow_group_run['inflow_writer'].terminate()
+        raise
+    finally:
+        for pool in (inflow_pool, routing_pool):
+            if pool is not None:
+                pool.close()
+                pool.join()
+        # after the workers that use its queues have stopped
+        mp_manager.shutdown()
 
     # print info to user
     time_end = datetime.utcnow()
@@ -11,8 +11,14 @@ from csv import writer as csvwriter
 import datetime
 from multiprocessing import cpu_count
 import os
+import re
 from subprocess import Popen, PIPE
+import threading
 from time import gmtime
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
 
 from dateutil.parser import parse
 import numpy as np
@@ -22,6 +28,25 @@ import xarray
 from .dataset import RAPIDDataset
 from .helper_functions import csv_to_list, log, open_csv
 from .postprocess import ConvertRAPIDOutputToCF
+from .routing import MuskingumRouting
+
+# lines of the RAPID output that end the simulation early
+RAPID_ERROR_PATTERN = re.compile(r"PETSC ERROR|MPI_ABORT|"
+                                 r"Segmentation fault|\bERROR\b")
+# lines of the RAPID output with the index of the main time step
+RAPID_TIME_STEP_PATTERN = re.compile(r"time\s*step\D*(\d+)",
+                                     re.IGNORECASE)
+
+
+def _read_output_lines(stream, stream_name, line_queue):
+    """
+    Put the lines of the output stream of a process in a queue
+    with None at the end of the stream
+    """
+    for line in iter(stream.readline, b''):
+        line_queue.put((stream_name, line))
+    stream.close()
+    line_queue.put((stream_name, None))
 
 
 # -----------------------------------------------------------------------------
@@ -466,7 +491,8 @@ class RAPID(object):
             self.ZS_TauM = m3_nc.size_time*self.ZS_TauR
             self.ZS_TauO = m3_nc.size_time*self.ZS_TauR
 
-    def generate_namelist_file(self, rapid_namelist_file):
+    def generate_namelist_file(self, rapid_namelist_file,
+                               absolute_paths=False):
         """
         Generate rapid_namelist file.
 
@@ -475,6 +501,9 @@ class RAPID(object):
         rapid_namelist_file: str
             Path of namelist file to generate from
             parameters added to the RAPID manager.
+        absolute_paths: bool, optional
+            If True, the paths of the files are written as absolute paths
+            so that RAPID can run from another directory. Default is False.
         """
         log("Generating RAPID namelist file ...",
             "INFO")
@@ -494,6 +523,8 @@ class RAPID(object):
                         new_file.write("%s = %s\n" % (attr, value))
                     else:
                         if value:
+                            if absolute_paths and attr.endswith('_file'):
+                                value = os.path.abspath(value)
                             if os.name == "nt":
                                 # if windows generate file with cygpath
                                 value = self._get_cygwin_path(value)
@@ -501,7 +532,7 @@ class RAPID(object):
             new_file.write("/\n")
 
     def update_namelist_file(self, rapid_namelist_file,
-                             new_namelist_file=None):
+                             new_namelist_file=None, absolute_paths=False):
         """
         Update existing namelist file with new parameters
 
@@ -512,6 +543,9 @@ class RAPID(object):
             updated with any parameters added to the RAPID manager.
         new_namelist_file: str, optional
             Path to output the updated namelist file.
+        absolute_paths: bool, optional
+            If True, the paths of the files are written as absolute paths
+            so that RAPID can run from another directory. Default is False.
         """
         if os.path.exists(rapid_namelist_file) and rapid_namelist_file:
             log("Adding missing inputs from RAPID input file ...",
@@ -547,7 +581,8 @@ class RAPID(object):
             if new_namelist_file is None:
                 new_namelist_file = rapid_namelist_file
 
-            self.generate_namelist_file(new_namelist_file)
+            self.generate_namelist_file(new_namelist_file,
+                                        absolute_paths=absolute_paths)
         else:
             log("RAPID namelist file to update not found.",
                 "ERROR")
@@ -629,17 +664,38 @@ class RAPID(object):
         )
         crv.convert()
 
-    def run(self, rapid_namelist_file=""):
+    def run(self, rapid_namelist_file="", working_directory=None,
+            num_processors=None, progress_callback=None, timeout=None):
         """
         Run RAPID program and generate file based on inputs
         This will generate your rapid_namelist file and run RAPID from wherever
         you call this script (your working directory).
 
+        The output of RAPID is printed line by line while it runs. RAPID is
+        stopped as soon as it prints an error (see *RAPID_ERROR_PATTERN*)
+        or runs longer than the *timeout*.
+
         Parameters
         ----------
         rapid_namelist_file: str, optional
             Path of namelist file to use in the simulation.
             It will be updated with any parameters added to the RAPID manager.
+        working_directory: str, optional
+            Directory to generate the rapid_namelist file in and run RAPID
+            from. Simulations running at the same time need different
+            working directories. If given, the paths of the files are
+            written to the rapid_namelist file as absolute paths.
+            Default is the current working directory.
+        num_processors: int, optional
+            Number of processors to run this simulation with instead of
+            the number of processors of the RAPID manager.
+        progress_callback: function, optional
+            Function called with the index of the time step and the
+            number of time steps (ZS_TauM/ZS_TauR, None if not set) each
+            time RAPID prints a time step (see *RAPID_TIME_STEP_PATTERN*).
+        timeout: float, optional
+            Number of seconds after which RAPID is stopped and an
+            exception is raised. Default is no timeout.
 
 
         Linux Example:
@@ -728,15 +784,24 @@ class RAPID(object):
                 "ERROR")
 
         time_start = datetime.datetime.utcnow()
-        temp_rapid_namelist_file = os.path.join(os.getcwd(), "rapid_namelist")
+        # relative paths are relative to the current working directory
+        absolute_paths = working_directory is not None
+        if working_directory is None:
+            working_directory = os.getcwd()
+        if num_processors is None:
+            num_processors = self._num_processors
+        temp_rapid_namelist_file = os.path.join(working_directory,
+                                                "rapid_namelist")
 
         if not rapid_namelist_file or not os.path.exists(rapid_namelist_file):
             # generate input file if it does not exist
-            self.generate_namelist_file(temp_rapid_namelist_file)
+            self.generate_namelist_file(temp_rapid_namelist_file,
+                                        absolute_paths=absolute_paths)
         else:
             # update existing file
             self.update_namelist_file(rapid_namelist_file,
-                                      temp_rapid_namelist_file)
+                                      temp_rapid_namelist_file,
+                                      absolute_paths=absolute_paths)
 
         local_rapid_executable_location = \
             os.path.join(os.path.dirname(temp_rapid_namelist_file),
@@ -779,26 +844,187 @@ class RAPID(object):
         run_rapid_command = [local_rapid_executable_location,
                              "-ksp_type", self._ksp_type]
 
-        if self._num_processors > 1:
+        if num_processors > 1:
             run_rapid_command = [self._mpiexec_command,
-                                 "-n", str(self._num_processors)] \
+                                 "-n", str(num_processors)] \
                                 + run_rapid_command
 
-        process = Popen(run_rapid_command,
+        num_time_steps = None
+        if self.ZS_TauM > 0 and self.ZS_TauR > 0:
+            num_time_steps = int(self.ZS_TauM // self.ZS_TauR)
+
+        process = Popen(run_rapid_command, cwd=working_directory,
                         stdout=PIPE, stderr=PIPE, shell=False)
-        out, err = process.communicate()
-        if err:
-            rapid_cleanup(temp_link_to_rapid, temp_rapid_namelist_file)
-            raise Exception(err)
-        else:
-            log('RAPID output:',
-                "INFO")
-            for line in out.split(b'\n'):
+        process_start = datetime.datetime.utcnow()
+        # read stdout and stderr in threads so that neither pipe fills up
+        line_queue = Queue()
+        for stream_name, stream in (("stdout", process.stdout),
+                                    ("stderr", process.stderr)):
+            read_thread = threading.Thread(target=_read_output_lines,
+                                           args=(stream, stream_name,
+                                                 line_queue))
+            read_thread.daemon = True
+            read_thread.start()
+
+        log('RAPID output:',
+            "INFO")
+        num_open_streams = 2
+        err_lines = []
+        run_error = None
+        try:
+            while num_open_streams > 0:
+                wait_seconds = None
+                if timeout is not None:
+                    wait_seconds = timeout - \
+                        (datetime.datetime.utcnow() -
+                         process_start).total_seconds()
+                    if wait_seconds <= 0:
+                        run_error = "RAPID did not finish in {0} seconds." \
+                            .format(timeout)
+                        break
+                try:
+                    stream_name, line = line_queue.get(timeout=wait_seconds)
+                except Empty:
+                    continue
+                if line is None:
+                    num_open_streams -= 1
+                    continue
+                line = line.decode('utf-8', 'replace').rstrip()
                 print(line)
-        rapid_cleanup(temp_link_to_rapid, temp_rapid_namelist_file)
+                if stream_name == "stderr":
+                    err_lines.append(line)
+                if RAPID_ERROR_PATTERN.search(line):
+                    run_error = line
+                    break
+                if progress_callback is not None:
+                    time_step_match = RAPID_TIME_STEP_PATTERN.search(line)
+                    if time_step_match:
+                        progress_callback(int(time_step_match.group(1)),
+                                          num_time_steps)
+        finally:
+            if num_open_streams > 0:
+                # stopped before RAPID finished
+                process.kill()
+            process.wait()
+            rapid_cleanup(temp_link_to_rapid, temp_rapid_namelist_file)
+
+        if run_error is not None:
+            raise Exception(run_error)
+        if process.returncode != 0:
+            raise Exception("RAPID exited with code {0}.\n{1}"
+                            .format(process.returncode,
+                                    "\n".join(err_lines[-10:])))
+        if err_lines:
+            raise Exception("\n".join(err_lines))
         log("Time to run RAPID: %s" % (datetime.datetime.utcnow()-time_start),
             "INFO")
 
+    def run_muskingum(self, vlat_file_list=None):
+        """
+        Run the Muskingum routing of RAPID in Python with
+        :class:`~RAPIDpy.routing.MuskingumRouting` instead of the RAPID
+        program. This does not need the RAPID executable or MPI and uses
+        the *rapid_connect_file*, *riv_bas_id_file*, *k_file*, *x_file*,
+        *Vlat_file*, *Qinit_file* (if *BS_opt_Qinit* is set), *ZS_dtR*,
+        *ZS_TauR* and *ZS_TauM* parameters to write the *Qout_file*.
+
+        .. note:: Forcing, dam and calibration options of RAPID
+                  are not supported.
+
+        Parameters
+        ----------
+        vlat_file_list: list, optional
+            List of the m3 files of the members of an ensemble to route
+            together instead of the *Vlat_file*. The network is set up
+            once for all of the members and the Qout variable of the
+            *Qout_file* has the dimensions (time, rivid, member).
+
+
+        Example:
+
+        .. code:: python
+
+            from RAPIDpy import RAPID
+
+            rapid_manager = RAPID(
+                ZS_TauR=3*3600,
+                ZS_dtR=15*60,
+                rapid_connect_file='../rapid-io/input/rapid_connect.csv',
+                Vlat_file='../rapid-io/input/m3_riv.nc',
+                riv_bas_id_file='../rapid-io/input/riv_bas_id.csv',
+                k_file='../rapid-io/input/k.csv',
+                x_file='../rapid-io/input/x.csv',
+                Qout_file='../rapid-io/output/Qout.nc'
+            )
+
+            rapid_manager.run_muskingum()
+
+
+        Ensemble Example:
+
+        .. code:: python
+
+            from glob import glob
+            from RAPIDpy import RAPID
+
+            rapid_manager = RAPID(
+                ZS_TauR=6*3600,
+                ZS_dtR=15*60,
+                rapid_connect_file='../rapid-io/input/rapid_connect.csv',
+                riv_bas_id_file='../rapid-io/input/riv_bas_id.csv',
+                k_file='../rapid-io/input/k.csv',
+                x_file='../rapid-io/input/x.csv',
+                Qout_file='../rapid-io/output/Qout_ensemble.nc'
+            )
+
+            rapid_manager.run_muskingum(
+                vlat_file_list=sorted(glob('../rapid-io/input/m3_riv_*.nc'))
+            )
+        """
+        input_file_list = ['rapid_connect_file', 'riv_bas_id_file',
+                           'k_file', 'x_file']
+        if vlat_file_list is None:
+            input_file_list.append('Vlat_file')
+        for input_file in input_file_list:
+            if not getattr(self, input_file) or \
+                    not os.path.exists(getattr(self, input_file)):
+                log("Missing {0}. Please set before running this function ..."
+                    .format(input_file),
+                    "ERROR")
+
+        if self.ZS_dtR <= 0 or self.ZS_TauR <= 0:
+            log("Missing routing time steps ZS_dtR and ZS_TauR ...",
+                "ERROR")
+
+        time_start = datetime.datetime.utcnow()
+        qinit_file = None
+        if self.BS_opt_Qinit and self.Qinit_file:
+            qinit_file = self.Qinit_file
+
+        num_time_steps = None
+        if self.ZS_TauM > 0:
+            num_time_steps = int(self.ZS_TauM // self.ZS_TauR)
+
+        log("Running Muskingum routing ...",
+            "INFO")
+        MuskingumRouting(
+            rapid_connect_file=self.rapid_connect_file,
+            riv_bas_id_file=self.riv_bas_id_file,
+            k_file=self.k_file,
+            x_file=self.x_file
+        ).route(
+            vlat_file=self.Vlat_file if vlat_file_list is None
+            else list(vlat_file_list),
+            qout_file=self.Qout_file,
+            routing_time_step=int(self.ZS_dtR),
+            vlat_time_step=int(self.ZS_TauR),
+            qinit_file=qinit_file,
+            num_time_steps=num_time_steps
+        )
+        log("Time to run Muskingum routing: %s"
+            % (datetime.datetime.utcnow()-time_start),
+            "INFO")
+
     def generate_qinit_from_past_qout(self, qinit_file, time_index=-1,
                                       out_datetime=None):
         """
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+    routing.py
+    RAPIDpy
+
+    License: BSD-3-Clause
+"""
+from netCDF4 import Dataset
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from .dataset import RAPIDDataset
+from .helper_functions import log
+
+
+class MuskingumRouting(object):
+    """
+    This class routes the lateral inflow of a RAPID m3 file (Vlat_file)
+    through a river network with the Muskingum method of RAPID in Python
+    instead of with the RAPID program.
+
+    The inputs are the same as the inputs of RAPID. The *k_file*,
+    *x_file*, *Qinit_file* and the m3 file (without a river ID variable)
+    are in the order of the *rapid_connect_file* and the output
+    is in the order of the *riv_bas_id_file*.
+
+    Attributes
+    ----------
+    rapid_connect_file: str
+        Path to the rapid_connect file.
+    riv_bas_id_file: str
+        Path to the riv_bas_id file with the river IDs to simulate.
+    k_file: str
+        Path to the k file with the Muskingum K in seconds.
+    x_file: str
+        Path to the x file with the Muskingum X.
+
+
+    Example:
+
+    .. code:: python
+
+        from RAPIDpy.routing import MuskingumRouting
+
+        muskingum_routing = MuskingumRouting(
+            rapid_connect_file='../rapid-io/input/rapid_connect.csv',
+            riv_bas_id_file='../rapid-io/input/riv_bas_id.csv',
+            k_file='../rapid-io/input/k.csv',
+            x_file='../rapid-io/input/x.csv',
+        )
+
+        muskingum_routing.route(
+            vlat_file='../rapid-io/input/m3_riv.nc',
+            qout_file='../rapid-io/output/Qout.nc',
+            routing_time_step=15*60,
+            vlat_time_step=3*3600,
+        )
+    """
+    def __init__(self, rapid_connect_file, riv_bas_id_file, k_file, x_file):
+        rapid_connect_table = np.loadtxt(rapid_connect_file,
+                                         ndmin=2, delimiter=",", dtype=int)
+        self.river_id_array_tot = rapid_connect_table[:, 0]
+        self.river_id_array = np.loadtxt(riv_bas_id_file,
+                                         ndmin=1, delimiter=",",
+                                         usecols=(0,), dtype=int)
+        self.river_index_array = \
+            self._get_river_index_array(self.river_id_array_tot,
+                                        self.river_id_array,
+                                        rapid_connect_file)
+
+        self.k_array = np.loadtxt(k_file, ndmin=1, delimiter=",",
+                                  usecols=(0,))[self.river_index_array]
+        self.x_array = np.loadtxt(x_file, ndmin=1, delimiter=",",
+                                  usecols=(0,))[self.river_index_array]
+
+        # connect each river in the basin to the river downstream
+        # if the river downstream is in the basin as well
+        downstream_id_array = \
+            rapid_connect_table[self.river_index_array, 1]
+        basin_sort_index = np.argsort(self.river_id_array)
+        downstream_sort_index = \
+            np.searchsorted(self.river_id_array[basin_sort_index],
+                            downstream_id_array)
+        downstream_sort_index[downstream_sort_index >=
+                              self.river_id_array.size] = 0
+        self.downstream_index_array = basin_sort_index[downstream_sort_index]
+        self.downstream_index_array[
+            self.river_id_array[self.downstream_index_array] !=
+            downstream_id_array] = -1
+
+        self.river_level_array, self.level_schedule = \
+            self._get_level_schedule()
+
+        # the sum of the flows of the rivers upstream of each river
+        has_downstream = self.downstream_index_array >= 0
+        self.upstream_matrix = csr_matrix(
+            (np.ones(int(has_downstream.sum())),
+             (self.downstream_index_array[has_downstream],
+              np.where(has_downstream)[0])),
+            shape=(self.river_id_array.size, self.river_id_array.size))
+
+    @staticmethod
+    def _get_river_index_array(river_id_array_tot, river_id_array,
+                               rapid_connect_file):
+        """
+        Get the index of each river in the rapid_connect file
+        """
+        tot_sort_index = np.argsort(river_id_array_tot)
+        river_sort_index = np.searchsorted(river_id_array_tot[tot_sort_index],
+                                           river_id_array)
+        river_sort_index[river_sort_index >= river_id_array_tot.size] = 0
+        river_index_array = tot_sort_index[river_sort_index]
+        missing_river_ids = \
+            river_id_array[river_id_array_tot[river_index_array] !=
+                           river_id_array]
+        if missing_river_ids.size > 0:
+            log("River IDs {0} not found in {1} ..."
+                .format(missing_river_ids, rapid_connect_file),
+                "ERROR")
+        return river_index_array
+
+    def _get_level_schedule(self):
+        """
+        Get the topological level of the rivers and the connections
+        to solve for each level.
+
+        Rivers without rivers upstream are on level 0 and the other
+        rivers are one level below the lowest river upstream, so the
+        rivers of a level only depend on the rivers of the levels above.
+
+        Returns
+        -------
+        tuple:
+            The level of each river and a list with the connections
+            of each level from 1 down as a tuple with the unique
+            downstream river indices on the level, the upstream river
+            indices sorted by the downstream river and the start of
+            the upstream rivers of each downstream river.
+        """
+        has_downstream = self.downstream_index_array >= 0
+        upstream_index_array = np.where(has_downstream)[0]
+        downstream_index_array = self.downstream_index_array[has_downstream]
+        num_upstream_array = \
+            np.bincount(downstream_index_array,
+                        minlength=self.river_id_array.size)
+
+        river_level_array = np.full(self.river_id_array.size, -1, dtype=int)
+        level_river_index_array = np.where(num_upstream_array == 0)[0]
+        level = 0
+        while level_river_index_array.size > 0:
+            river_level_array[level_river_index_array] = level
+            level_downstream_index_array = \
+                self.downstream_index_array[level_river_index_array]
+            level_downstream_index_array = \
+                level_downstream_index_array[level_downstream_index_array >= 0]
+            num_upstream_array -= \
+                np.bincount(level_downstream_index_array,
+                            minlength=self.river_id_array.size)
+            level_river_index_array = np.unique(
+                level_downstream_index_array[
+                    num_upstream_array[level_downstream_index_array] == 0])
+            level += 1
+
+        if (river_level_array < 0).any():
+            log("The river network has a loop ...",
+                "ERROR")
+
+        # group the connections by the level of the downstream river
+        connection_order = \
+            np.lexsort((downstream_index_array,
+                        river_level_array[downstream_index_array]))
+        upstream_index_array = upstream_index_array[connection_order]
+        downstream_index_array = downstream_index_array[connection_order]
+        level_start_array = np.searchsorted(
+            river_level_array[downstream_index_array], np.arange(1, level + 1))
+
+        level_schedule = []
+        for level_start, level_end in zip(level_start_array[:-1],
+                                          level_start_array[1:]):
+            level_downstream_index_array = \
+                downstream_index_array[level_start:level_end]
+            river_start_array = np.where(np.concatenate((
+                [True],
+                level_downstream_index_array[1:] !=
+                level_downstream_index_array[:-1])))[0]
+            level_schedule.append((
+                level_downstream_index_array[river_start_array],
+                upstream_index_array[level_start:level_end],
+                river_start_array))
+        return river_level_array, level_schedule
+
+    def get_muskingum_coefficients(self, routing_time_step):
+        """
+        Get the Muskingum coefficients C1, C2 and C3 of the rivers
+
+        Parameters
+        ----------
+        routing_time_step: int
+            Routing time step in seconds (ZS_dtR).
+
+        Returns
+        -------
+        tuple:
+            C1, C2 and C3 arrays in the order of the riv_bas_id file.
+        """
+        half_time_step = routing_time_step / 2.0
+        k_x = self.k_array * self.x_array
+        denominator = self.k_array - k_x + half_time_step
+        c1_array = (half_time_step - k_x) / denominator
+        c2_array = (half_time_step + k_x) / denominator
+        c3_array = (self.k_array - k_x - half_time_step) / denominator
+        return c1_array, c2_array, c3_array
+
+    def read_qinit(self, qinit_file):
+        """
+        Read the initial flows in the order of the riv_bas_id file
+        from a Qinit file in the order of the rapid_connect file
+        """
+        return np.loadtxt(qinit_file, ndmin=1, delimiter=",",
+                          usecols=(0,))[self.river_index_array]
+
+    def _get_vlat_index_array(self, vlat_nc):
+        """
+        Get the index of each river in the m3 file
+        """
+        vlat_river_id_array = self.river_id_array_tot
+        if vlat_nc.river_id_variable in vlat_nc.qout_nc.variables:
+            vlat_river_id_array = vlat_nc.get_river_id_array()
+        elif vlat_nc.size_river_id != self.river_id_array_tot.size:
+            log("The m3 file has {0} rivers and the rapid_connect file "
+                "has {1} ...".format(vlat_nc.size_river_id,
+                                     self.river_id_array_tot.size),
+                "ERROR")
+        return self._get_river_index_array(vlat_river_id_array,
+                                           self.river_id_array,
+                                           vlat_nc.qout_nc.filepath())
+
+    def _route_step(self, qout_array, qext_c1_c2_array, c1_array,
+                    c2_array, c3_array):
+        """
+        Route the flows of the rivers (rows) of each ensemble member
+        (columns) one routing time step
+        """
+        qin_array = self.upstream_matrix.dot(qout_array)
+        qout_array = qext_c1_c2_array + c2_array * qin_array \
+            + c3_array * qout_array
+        # (I - C1*N)*Qout = b solved one level at a time
+        for downstream_index_array, upstream_index_array, \
+                river_start_array in self.level_schedule:
+            qout_array[downstream_index_array] += \
+                c1_array[downstream_index_array] * \
+                np.add.reduceat(qout_array[upstream_index_array],
+                                river_start_array, axis=0)
+        return qout_array
+
+    def route(self, vlat_file, qout_file, routing_time_step,
+              vlat_time_step, qinit_file=None, num_time_steps=None):
+        """
+        Route the lateral inflow of the m3 file and write the average
+        flow of each m3 time step to a RAPID Qout file.
+
+        The m3 files of the members of an ensemble can be routed
+        together with the network set up once. The flows of the members
+        are the columns of the arrays routed and the Qout variable has
+        the dimensions (time, rivid, member).
+
+        Parameters
+        ----------
+        vlat_file: str or list
+            Path to the m3 file with the volume of lateral inflow
+            in m3 of each time step or a list with the m3 file
+            of each member of an ensemble.
+        qout_file: str
+            Path to the Qout file to write.
+        routing_time_step: int
+            Routing time step in seconds (ZS_dtR).
+        vlat_time_step: int
+            Time step of the m3 file in seconds (ZS_TauR). It has to be
+            a multiple of the routing time step.
+        qinit_file: str, optional
+            Path to the Qinit file with the initial flows of all
+            of the members. Default is to start with no flow.
+        num_time_steps: int, optional
+            Number of time steps of the m3 file to route. Default is
+            all of them.
+        """
+        if routing_time_step <= 0 or vlat_time_step % routing_time_step:
+            log("The m3 time step {0} is not a multiple of the routing "
+                "time step {1} ...".format(vlat_time_step, routing_time_step),
+                "ERROR")
+        num_routing_steps = int(vlat_time_step // routing_time_step)
+
+        ensemble = isinstance(vlat_file, (list, tuple))
+        vlat_file_list = vlat_file if ensemble else [vlat_file]
+        num_members = len(vlat_file_list)
+        if num_members < 1:
+            log("No m3 files to route ...",
+                "ERROR")
+
+        c1_array, c2_array, c3_array = \
+            self.get_muskingum_coefficients(routing_time_step)
+        flow_shape = (self.river_id_array.size,)
+        if ensemble:
+            c1_array, c2_array, c3_array = \
+                c1_array[:, np.newaxis], c2_array[:, np.newaxis], \
+                c3_array[:, np.newaxis]
+            flow_shape = (self.river_id_array.size, num_members)
+
+        qout_array = np.zeros((self.river_id_array.size, num_members))
+        if qinit_file:
+            qout_array += self.read_qinit(qinit_file)[:, np.newaxis]
+        qout_array = qout_array.reshape(flow_shape)
+
+        vlat_nc_list = []
+        try:
+            for member_vlat_file in vlat_file_list:
+                vlat_nc_list.append(RAPIDDataset(member_vlat_file))
+            vlat_index_array_list = [self._get_vlat_index_array(vlat_nc)
+                                     for vlat_nc in vlat_nc_list]
+            vlat_var_list = [vlat_nc.qout_nc.variables[vlat_nc.q_var_name]
+                             for vlat_nc in vlat_nc_list]
+            vlat_size_time = min(vlat_nc.size_time
+                                 for vlat_nc in vlat_nc_list)
+            if vlat_size_time != max(vlat_nc.size_time
+                                     for vlat_nc in vlat_nc_list):
+                log("The m3 files of the ensemble have a different "
+                    "number of time steps ...",
+                    "ERROR")
+            if num_time_steps is None:
+                num_time_steps = vlat_size_time
+            num_time_steps = min(int(num_time_steps), vlat_size_time)
+
+            with Dataset(qout_file, "w", format="NETCDF3_CLASSIC") as qout_nc:
+                qout_nc.createDimension('time', num_time_steps)
+                qout_nc.createDimension('rivid', self.river_id_array.size)
+                qout_dimensions = ('time', 'rivid')
+                if ensemble:
+                    qout_nc.createDimension('member', num_members)
+                    qout_dimensions = ('time', 'rivid', 'member')
+                qout_var = qout_nc.createVariable('Qout', 'f4',
+                                                  qout_dimensions)
+                qout_var.long_name = ('average river water discharge '
+                                      'downstream of each river reach')
+                qout_var.units = 'm3 s-1'
+                rivid_var = qout_nc.createVariable('rivid', 'i4', ('rivid',))
+                rivid_var.long_name = 'unique identifier for each river reach'
+                rivid_var[:] = self.river_id_array
+
+                qext_array = np.zeros((self.river_id_array.size,
+                                       num_members))
+                for time_index in range(num_time_steps):
+                    for member_index, vlat_var in enumerate(vlat_var_list):
+                        qext_array[:, member_index] = \
+                            np.ma.filled(vlat_var[time_index], 0)[
+                                vlat_index_array_list[member_index]]
+                    qext_c1_c2_array = \
+                        (c1_array + c2_array) * \
+                        (qext_array.reshape(flow_shape) /
+                         float(vlat_time_step))
+                    qout_mean_array = np.zeros(qout_array.shape)
+                    for _ in range(num_routing_steps):
+                        # RAPID averages the flows at the start of the steps
+                        qout_mean_array += qout_array
+                        qout_array = self._route_step(
+                            qout_array, qext_c1_c2_array,
+                            c1_array, c2_array, c3_array)
+                    qout_var[time_index] = qout_mean_array / num_routing_steps
+        finally:
+            for vlat_nc in vlat_nc_list:
+                vlat_nc.close()
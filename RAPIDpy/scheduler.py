@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+    scheduler.py
+    RAPIDpy
+
+    License: BSD-3-Clause
+"""
+from shutil import rmtree
+from tempfile import mkdtemp
+import threading
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from .helper_functions import log
+
+
+def get_rapid_num_processors(river_size_list, num_processors):
+    """
+    Divide a budget of processors among RAPID simulations by the number
+    of river reaches (IS_riv_bas) of each simulation. Every simulation
+    gets at least one processor, no more processors than reaches and
+    no more than the budget.
+
+    Parameters
+    ----------
+    river_size_list: list
+        The number of river reaches of each simulation.
+    num_processors: int
+        The total number of processors to divide.
+
+    Returns
+    -------
+    list:
+        The number of processors of each simulation.
+    """
+    river_size_list = [max(1, int(river_size))
+                       for river_size in river_size_list]
+    total_river_size = float(sum(river_size_list))
+    return [max(1, min(num_processors, river_size,
+                       int(num_processors * river_size / total_river_size)))
+            for river_size in river_size_list]
+
+
+class RAPIDScheduler(object):
+    """
+    This class runs RAPID for several watersheds at the same time without
+    using more than a budget of processors. The processors are divided
+    among the simulations by their number of river reaches (IS_riv_bas)
+    and the largest simulations start first. Smaller simulations start
+    whenever enough processors are free. Each simulation runs RAPID in
+    its own working directory so that the rapid_namelist files do not
+    conflict.
+
+    The *finished_callback* of a simulation runs in its own thread as
+    soon as it finishes and the simulations that fit in its processors
+    have started, for example to post-process its output while the
+    other simulations run and start. Relative paths of the RAPID
+    managers are relative to the current working directory.
+
+    Attributes
+    ----------
+    num_processors: int
+        Total number of processors for the RAPID simulations.
+    working_directory: str, optional
+        Directory to create the working directories of the simulations in.
+        Default is the system temporary directory.
+
+
+    Example:
+
+    .. code:: python
+
+        from datetime import datetime
+        from os import path
+        from RAPIDpy import RAPID
+        from RAPIDpy.scheduler import RAPIDScheduler
+
+        rapid_scheduler = RAPIDScheduler(num_processors=64)
+        for watershed in ('provo', 'nfie_texas'):
+            rapid_input = path.join('../rapid-io/input', watershed)
+            rapid_manager = RAPID(
+                rapid_executable_location='~/work/rapid/src/rapid',
+                ZS_TauR=3*3600,
+                ZS_dtR=15*60,
+                ZS_TauM=365*24*3600,
+                ZS_dtM=3*3600,
+                rapid_connect_file=path.join(rapid_input, 'rapid_connect.csv'),
+                Vlat_file=path.join(rapid_input, 'm3_riv.nc'),
+                riv_bas_id_file=path.join(rapid_input, 'riv_bas_id.csv'),
+                k_file=path.join(rapid_input, 'k.csv'),
+                x_file=path.join(rapid_input, 'x.csv'),
+                Qout_file=path.join('../rapid-io/output', watershed,
+                                    'Qout.nc')
+            )
+            rapid_manager.update_reach_number_data()
+            rapid_scheduler.add_run(
+                rapid_manager,
+                finished_callback=lambda rapid_manager:
+                    rapid_manager.make_output_cf_compliant(
+                        simulation_start_datetime=datetime(1980, 1, 1)))
+
+        rapid_scheduler.run()
+    """
+    def __init__(self, num_processors, working_directory=None):
+        self.num_processors = max(1, int(num_processors))
+        self.working_directory = working_directory
+        self._run_list = []
+
+    def add_run(self, rapid_manager, rapid_namelist_file="",
+                finished_callback=None):
+        """
+        Add a RAPID simulation to run.
+
+        Parameters
+        ----------
+        rapid_manager: :obj:`~RAPIDpy.rapid.RAPID`
+            RAPID manager with the parameters of the simulation. Run
+            :meth:`~RAPIDpy.rapid.RAPID.update_reach_number_data` first
+            for the processors to be divided by the number of reaches.
+        rapid_namelist_file: str, optional
+            Path of namelist file to use in the simulation.
+        finished_callback: function, optional
+            Function called with the RAPID manager in a separate thread
+            when the simulation finishes.
+        """
+        self._run_list.append({
+            'rapid_manager': rapid_manager,
+            'rapid_namelist_file': rapid_namelist_file,
+            'finished_callback': finished_callback,
+        })
+
+    def run(self):
+        """
+        Run the RAPID simulations added and wait for all of them and
+        their callbacks to finish. If a simulation or callback fails,
+        no more simulations start and the error is raised when the
+        running simulations and callbacks finish.
+        """
+        run_list = self._run_list
+        self._run_list = []
+        num_processors_list = get_rapid_num_processors(
+            [rapid_run['rapid_manager'].IS_riv_bas
+             for rapid_run in run_list],
+            self.num_processors)
+        for rapid_run, num_processors in zip(run_list, num_processors_list):
+            rapid_run['num_processors'] = num_processors
+        pending_run_list = sorted(run_list, reverse=True,
+                                  key=lambda rapid_run:
+                                  rapid_run['num_processors'])
+
+        finished_queue = Queue()
+
+        def run_rapid(rapid_run):
+            """
+            Run RAPID in a thread and report when finished
+            """
+            try:
+                rapid_run['rapid_manager'].run(
+                    rapid_namelist_file=rapid_run['rapid_namelist_file'],
+                    working_directory=rapid_run['working_directory'],
+                    num_processors=rapid_run['num_processors'])
+            except Exception as ex:
+                finished_queue.put(('run', rapid_run, ex))
+            else:
+                finished_queue.put(('run', rapid_run, None))
+
+        def call_back(rapid_run):
+            """
+            Call the finished callback in a thread and report when finished
+            """
+            try:
+                rapid_run['finished_callback'](rapid_run['rapid_manager'])
+            except Exception as ex:
+                finished_queue.put(('callback', rapid_run, ex))
+            else:
+                finished_queue.put(('callback', rapid_run, None))
+
+        free_processors = self.num_processors
+        num_running = 0
+        num_callbacks_running = 0
+        run_error = None
+        callback_run_list = []
+        while num_running > 0 or num_callbacks_running > 0 or \
+                callback_run_list or \
+                (pending_run_list and run_error is None):
+            # start the largest simulations that fit in the free processors
+            if run_error is None:
+                for rapid_run in list(pending_run_list):
+                    if rapid_run['num_processors'] > free_processors:
+                        continue
+                    pending_run_list.remove(rapid_run)
+                    free_processors -= rapid_run['num_processors']
+                    num_running += 1
+                    rapid_run['working_directory'] = \
+                        mkdtemp(prefix='rapid_', dir=self.working_directory)
+                    log("Starting RAPID for {0} with {1} processors ..."
+                        .format(rapid_run['rapid_manager'].Qout_file,
+                                rapid_run['num_processors']),
+                        "INFO")
+                    run_thread = threading.Thread(target=run_rapid,
+                                                  args=(rapid_run,))
+                    run_thread.daemon = True
+                    run_thread.start()
+
+            # call back after starting the simulations that fit in the
+            # freed processors so they run during the post-processing
+            for rapid_run in callback_run_list:
+                num_callbacks_running += 1
+                callback_thread = threading.Thread(target=call_back,
+                                                   args=(rapid_run,))
+                callback_thread.daemon = True
+                callback_thread.start()
+            callback_run_list = []
+
+            finished_type, rapid_run, ex = finished_queue.get()
+            if finished_type == 'callback':
+                num_callbacks_running -= 1
+                if ex is not None and run_error is None:
+                    log("Finished callback for {0} failed: {1}. Waiting for "
+                        "the other simulations to finish ..."
+                        .format(rapid_run['rapid_manager'].Qout_file, ex),
+                        "WARNING")
+                    run_error = ex
+                continue
+
+            free_processors += rapid_run['num_processors']
+            num_running -= 1
+            rmtree(rapid_run['working_directory'], ignore_errors=True)
+            if ex is None and run_error is None and \
+                    rapid_run['finished_callback'] is not None:
+                callback_run_list.append(rapid_run)
+            if ex is not None and run_error is None:
+                log("RAPID for {0} failed: {1}. Waiting for the other "
+                    "simulations to finish ..."
+                    .format(rapid_run['rapid_manager'].Qout_file, ex),
+                    "WARNING")
+                run_error = ex
+
+        if run_error is not None:
+            raise run_error
@@ -39,6 +39,45 @@ def partition(lst, n):
            [list(xrange(indices[i], indices[i+1])) for i in xrange(n)]
 
 
+def size_partition(lst, size_list, n):
+    """
+        Divide list into at most n contiguous parts of about equal
+        total size ordered from largest to smallest total size
+    """
+    if not lst:
+        return [], []
+    if sum(size_list) <= 0:
+        size_list = [1] * len(lst)
+    total_size = float(sum(size_list))
+    indices = [0]
+    part_size_list = []
+    part_size = cumulative_size = 0
+    for i, size in enumerate(size_list):
+        target_size = total_size * len(indices) / n
+        # start a new part before an item that overshoots the target
+        # by more than the part is short of it
+        if part_size > 0 and len(indices) < n and \
+                cumulative_size + size - target_size > \
+                target_size - cumulative_size:
+            indices.append(i)
+            part_size_list.append(part_size)
+            part_size = 0
+            target_size = total_size * len(indices) / n
+        part_size += size
+        cumulative_size += size
+        if len(indices) < n and cumulative_size >= target_size:
+            indices.append(i + 1)
+            part_size_list.append(part_size)
+            part_size = 0
+    if indices[-1] != len(lst):
+        indices.append(len(lst))
+        part_size_list.append(part_size)
+    part_order = sorted(xrange(len(part_size_list)),
+                        key=lambda i: part_size_list[i], reverse=True)
+    return [lst[indices[i]:indices[i+1]] for i in part_order], \
+           [list(xrange(indices[i], indices[i+1])) for i in part_order]
+
+
 def get_valid_directory_list(input_directory):
     """
     Get a list of folders
@@ -9,6 +9,7 @@
 
 from datetime import datetime
 from glob import glob
+import json
 import multiprocessing
 from netCDF4 import Dataset
 from numpy.testing import assert_almost_equal
@@ -21,6 +22,10 @@ import unittest
 
 # local import
 from RAPIDpy.inflow import run_lsm_rapid_process
+from RAPIDpy.inflow.lsm_rapid_process import (check_lsm_time_coverage,
+                                               get_inflow_manifest_file)
+from RAPIDpy.inflow.lsm_manifest import LSMFileManifest
+from RAPIDpy.inflow.CreateInflowFileFromGriddedRunoff import CreateInflowFileFromGriddedRunoff
 from RAPIDpy.inflow.CreateInflowFileFromERAInterimRunoff import CreateInflowFileFromERAInterimRunoff
 from RAPIDpy.inflow.CreateInflowFileFromERA5Runoff import CreateInflowFileFromERA5Runoff
 from RAPIDpy.inflow.CreateInflowFileFromLDASRunoff import CreateInflowFileFromLDASRunoff
@@ -57,8 +62,8 @@ class TestRAPIDInflow(unittest.TestCase):
             pass
 
     def tearDown(self):
-        rmtree(os.path.join(self.OUTPUT_DATA_PATH, "input"))
-        rmtree(os.path.join(self.OUTPUT_DATA_PATH, "output"))
+        rmtree(os.path.join(self.OUTPUT_DATA_PATH, "input"), ignore_errors=True)
+        rmtree(os.path.join(self.OUTPUT_DATA_PATH, "output"), ignore_errors=True)
 
     @staticmethod
     def _compare_m3(generated_m3_file, generated_m3_file_solution):
@@ -125,7 +130,17 @@ class TestRAPIDInflow(unittest.TestCase):
                        convert_one_hour_to_three=False,
                        expected_time_step=None,
                        single_run=False,
-                       filter_dates=True):
+                       filter_dates=True,
+                       single_pass_multi_watershed=False,
+                       lsm_time_block_size=None,
+                       incremental_inflow=False,
+                       resume_inflow=False,
+                       lsm_manifest_file=None,
+                       inflow_time_step=None,
+                       lsm_read_ahead_blocks=None,
+                       lsm_use_float32=False,
+                       inflow_file_format="NETCDF3_CLASSIC",
+                       inflow_chunksizes=None):
         """
         run for automatic method
         """
@@ -161,6 +176,16 @@ class TestRAPIDInflow(unittest.TestCase):
             file_datetime_re_pattern=file_datetime_re_pattern,
             convert_one_hour_to_three=convert_one_hour_to_three,
             expected_time_step=expected_time_step,
+            single_pass_multi_watershed=single_pass_multi_watershed,
+            lsm_time_block_size=lsm_time_block_size,
+            incremental_inflow=incremental_inflow,
+            resume_inflow=resume_inflow,
+            lsm_manifest_file=lsm_manifest_file,
+            inflow_time_step=inflow_time_step,
+            lsm_read_ahead_blocks=lsm_read_ahead_blocks,
+            lsm_use_float32=lsm_use_float32,
+            inflow_file_format=inflow_file_format,
+            inflow_chunksizes=inflow_chunksizes,
         )
         return rapid_input_path, rapid_output_path, output_file_info
 
@@ -307,6 +332,146 @@ class TestRAPIDInflow(unittest.TestCase):
         generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
         self._compare_m3(generated_m3_file,generated_m3_file_solution)
 
+    def test_weight_table_cache(self):
+        """
+        Checks the compiled weight table is written, reused and rebuilt
+        """
+        rapid_input_path, rapid_output_path = self._setup_manual("x-x")
+        in_weight_table = os.path.join(rapid_input_path, 'weight_era_t511.csv')
+        weight_table_cache_directory = os.path.join(rapid_output_path, 'weight_cache')
+        cache_directory = CreateInflowFileFromERAInterimRunoff.get_weight_table_cache_directory(
+            in_weight_table, weight_table_cache_directory)
+
+        # the cache is only used with a cache directory
+        input_file_list = sorted(os.listdir(rapid_input_path))
+        csv_tool = CreateInflowFileFromERAInterimRunoff()
+        csv_tool.read_in_weight_table(in_weight_table)
+        assert sorted(os.listdir(rapid_input_path)) == input_file_list
+        assert not os.path.exists(weight_table_cache_directory)
+
+        inf_tool = CreateInflowFileFromERAInterimRunoff()
+        inf_tool.weight_table_cache_directory = weight_table_cache_directory
+        inf_tool.read_in_weight_table(in_weight_table)
+        assert os.listdir(weight_table_cache_directory) == [os.path.basename(cache_directory)]
+
+        cache_tool = CreateInflowFileFromERAInterimRunoff()
+        cache_tool.weight_table_cache_directory = weight_table_cache_directory
+        assert cache_tool._load_weight_table_cache(in_weight_table)
+        assert isinstance(cache_tool.weight_lat_indices, np.memmap)
+        # the operator uses the memory mapped arrays without copies
+        assert not cache_tool.weight_operator.data.flags.writeable
+        assert not cache_tool.weight_operator.indices.flags.writeable
+        assert cache_tool.size_stream_id == csv_tool.size_stream_id
+        assert_almost_equal(cache_tool.weight_lat_indices, csv_tool.weight_lat_indices)
+        assert_almost_equal(cache_tool.weight_lon_indices, csv_tool.weight_lon_indices)
+        assert_almost_equal(cache_tool.weight_operator.toarray(),
+                            csv_tool.weight_operator.toarray())
+
+        # the modification time is updated if the contents are the same
+        source_file = os.path.join(cache_directory, 'source.json')
+        source_mtime = os.path.getmtime(in_weight_table) + 10
+        os.utime(in_weight_table, (source_mtime, source_mtime))
+        assert cache_tool._load_weight_table_cache(in_weight_table)
+        with open(source_file) as source_json:
+            assert json.load(source_json)['source_mtime'] == source_mtime
+        assert sorted(os.listdir(cache_directory)) == \
+            sorted([array_name + '.npy'
+                    for array_name in cache_tool.weight_table_cache_arrays] +
+                   ['source.json'])
+
+        # a changed weight table invalidates the compiled weight table
+        with open(in_weight_table, 'a') as weight_table_file:
+            weight_table_file.write("\n")
+        assert not cache_tool._load_weight_table_cache(in_weight_table)
+
+    def test_lsm_file_manifest(self):
+        """
+        Checks the LSM file manifest detects files rewritten in place
+        """
+        lsm_data_location = os.path.join(self.OUTPUT_DATA_PATH, 'output', 'lsm_manifest_data')
+        os.makedirs(os.path.join(lsm_data_location, '2002'))
+        lsm_file_list = [os.path.join(lsm_data_location, '2002', file_name)
+                         for file_name in ('20020830.nc', '20020831.nc')]
+        for lsm_file in lsm_file_list:
+            with open(lsm_file, 'w') as lsm_nc:
+                lsm_nc.write('runoff')
+
+        lsm_manifest = LSMFileManifest(lsm_data_location)
+        lsm_manifest.update()
+        assert lsm_manifest.get_file_list(['.nc']) == lsm_file_list
+        for lsm_file in lsm_file_list:
+            lsm_manifest._get_file_info(lsm_file)['time_size'] = 8
+
+        # rewrite a file without changing the directory
+        directory_mtime = os.path.getmtime(os.path.dirname(lsm_file_list[0]))
+        with open(lsm_file_list[0], 'w') as lsm_nc:
+            lsm_nc.write('more runoff')
+        os.utime(lsm_file_list[0], (directory_mtime + 10, directory_mtime + 10))
+        os.utime(os.path.dirname(lsm_file_list[0]), (directory_mtime, directory_mtime))
+
+        lsm_manifest.update()
+        assert lsm_manifest.get_file_size(lsm_file_list[0]) == len('more runoff')
+        assert 'time_size' not in lsm_manifest._get_file_info(lsm_file_list[0])
+        assert lsm_manifest._get_file_info(lsm_file_list[1])['time_size'] == 8
+
+    def test_deaccumulate_runoff(self):
+        """
+        Checks converting accumulated runoff to the runoff in each time step
+        """
+        step_runoff = np.random.RandomState(0).rand(8, 5)
+        step_runoff[6, 2] = -1
+        accumulated_runoff = np.concatenate([np.cumsum(step_runoff[:4], axis=0),
+                                             np.cumsum(step_runoff[4:], axis=0)])
+        expected_runoff = np.where(step_runoff < 0, 0, step_runoff)
+
+        assert_almost_equal(
+            CreateInflowFileFromGriddedRunoff._deaccumulate_runoff(accumulated_runoff, 4),
+            expected_runoff)
+
+        # in blocks of time not aligned with the resets
+        block_runoff_list = []
+        previous_runoff = None
+        for block_start in range(0, 8, 3):
+            block_runoff_list.append(
+                CreateInflowFileFromGriddedRunoff._deaccumulate_runoff(
+                    accumulated_runoff[block_start:block_start + 3], 4,
+                    block_start, previous_runoff))
+            previous_runoff = accumulated_runoff[block_start:block_start + 3][-1]
+        assert_almost_equal(np.concatenate(block_runoff_list), expected_runoff)
+
+    def test_check_lsm_time_coverage(self):
+        """
+        Checks the validation of the times in the LSM files
+        """
+        def file_info(time_start, time_end, time_increasing=True):
+            return {'time_size': 2,
+                    'time_start': time_start,
+                    'time_end': time_end,
+                    'time_step': 3600,
+                    'time_increasing': time_increasing,
+                    'time_uniform': time_increasing}
+
+        lsm_file_list = ['lsm_0.nc', 'lsm_1.nc']
+        check_lsm_time_coverage(lsm_file_list,
+                                [file_info('2000-01-01T00:00:00', '2000-01-01T01:00:00'),
+                                 file_info('2000-01-01T02:00:00', '2000-01-01T03:00:00')],
+                                3600)
+        # gaps only warn
+        check_lsm_time_coverage(lsm_file_list,
+                                [file_info('2000-01-01T00:00:00', '2000-01-01T01:00:00'),
+                                 file_info('2000-01-01T05:00:00', '2000-01-01T06:00:00')],
+                                3600)
+        with pytest.raises(ValueError):
+            check_lsm_time_coverage(lsm_file_list,
+                                    [file_info('2000-01-01T00:00:00', '2000-01-01T01:00:00'),
+                                     file_info('2000-01-01T01:00:00', '2000-01-01T02:00:00')],
+                                    3600)
+        with pytest.raises(ValueError):
+            check_lsm_time_coverage(lsm_file_list,
+                                    [file_info('2000-01-01T00:00:00', '2000-01-01T01:00:00'),
+                                     file_info('2000-01-01T03:00:00', '2000-01-01T02:00:00', False)],
+                                    3600)
+
     def test_generate_nldas2_inflow(self):
         """
         Checks generating inflow file from NLDAS V2 LSM
@@ -502,6 +667,88 @@ class TestRAPIDInflow(unittest.TestCase):
         generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
         self._compare_m3(generated_m3_file,generated_m3_file_solution)
 
+    def test_generate_erai_t255_inflow_float32(self):
+        """
+        Checks accumulated ERA Interim t255 runoff is converted in float64
+        when generating inflow in float32
+        """
+        rapid_input_path, rapid_output_path = self._setup_manual("x-x")
+
+        lsm_file_list = sorted(glob(os.path.join(self.LSM_INPUT_DATA_PATH, 'erai3t255', '*.nc')))
+        mp_lock = multiprocessing.Manager().Lock()
+
+        m3_file_name = "m3_riv_bas_erai_t255_3hr_20140820to20140821.nc"
+        generated_m3_file = os.path.join(rapid_output_path, m3_file_name)
+        m3_riv_list = []
+        for use_float32 in (False, True):
+            inf_tool = CreateInflowFileFromERAInterimRunoff()
+            inf_tool.generateOutputInflowFile(out_nc=generated_m3_file,
+                                              start_datetime_utc=datetime(2014,8,20),
+                                              number_of_timesteps=len(lsm_file_list)*8,
+                                              simulation_time_step_seconds=3*3600,
+                                              in_rapid_connect_file=os.path.join(rapid_input_path, 'rapid_connect.csv'),
+                                              in_rivid_lat_lon_z_file=os.path.join(rapid_input_path, 'comid_lat_lon_z.csv'),
+                                              land_surface_model_description="RAPID Inflow from ERA Interim (T255 Grid) 3 Hourly Runoff",
+                                              modeling_institution="US Army Engineer Research and Development Center"
+                                              )
+            inf_tool.execute(nc_file_list=lsm_file_list,
+                             index_list=list(xrange(len(lsm_file_list))),
+                             in_weight_table=os.path.join(rapid_input_path, 'weight_era_t255.csv'),
+                             out_nc=generated_m3_file,
+                             grid_type='t255',
+                             mp_lock=mp_lock,
+                             use_float32=use_float32)
+            with Dataset(generated_m3_file) as m3_nc:
+                m3_riv_list.append(m3_nc.variables['m3_riv'][:])
+
+        # the same as float64 as the runoff is not converted in float32
+        np.testing.assert_array_equal(m3_riv_list[0], m3_riv_list[1])
+
+    def test_execute_weight_tables_read_in(self):
+        """
+        Checks weight tables read in before generating inflow are only
+        read again when they change
+        """
+        rapid_input_path, rapid_output_path = self._setup_manual("x-x")
+
+        lsm_file_list = sorted(glob(os.path.join(self.LSM_INPUT_DATA_PATH, 'erai3t255', '*.nc')))
+        in_weight_table = os.path.join(rapid_input_path, 'weight_era_t255.csv')
+        mp_lock = multiprocessing.Manager().Lock()
+
+        m3_file_name = "m3_riv_bas_erai_t255_3hr_20140820to20140821.nc"
+        generated_m3_file = os.path.join(rapid_output_path, m3_file_name)
+        inf_tool = CreateInflowFileFromERAInterimRunoff()
+        inf_tool.read_in_weight_tables([in_weight_table])
+        # double the weights read in to see which ones are used
+        inf_tool.weight_operator_list = [2 * inf_tool.weight_operator]
+
+        def generate_m3_riv():
+            inf_tool.generateOutputInflowFile(out_nc=generated_m3_file,
+                                              start_datetime_utc=datetime(2014,8,20),
+                                              number_of_timesteps=len(lsm_file_list)*8,
+                                              simulation_time_step_seconds=3*3600,
+                                              in_rapid_connect_file=os.path.join(rapid_input_path, 'rapid_connect.csv'),
+                                              in_rivid_lat_lon_z_file=os.path.join(rapid_input_path, 'comid_lat_lon_z.csv'),
+                                              land_surface_model_description="RAPID Inflow from ERA Interim (T255 Grid) 3 Hourly Runoff",
+                                              modeling_institution="US Army Engineer Research and Development Center"
+                                              )
+            inf_tool.execute(nc_file_list=lsm_file_list,
+                             index_list=list(xrange(len(lsm_file_list))),
+                             in_weight_table=in_weight_table,
+                             out_nc=generated_m3_file,
+                             grid_type='t255',
+                             mp_lock=mp_lock)
+            with Dataset(generated_m3_file) as m3_nc:
+                return m3_nc.variables['m3_riv'][:]
+
+        doubled_m3_riv = generate_m3_riv()
+        # a weight table with a new modification time is read again
+        weight_table_mtime = os.path.getmtime(in_weight_table) + 10
+        os.utime(in_weight_table, (weight_table_mtime, weight_table_mtime))
+        m3_riv = generate_m3_riv()
+        assert m3_riv.max() > 0
+        assert_almost_equal(doubled_m3_riv, 2 * m3_riv)
+
     def test_generate_gldas2_inflow(self):
         """
         Checks generating inflow file from GLDAS V2 LSM
@@ -576,6 +823,26 @@ class TestRAPIDInflow(unittest.TestCase):
         # check output file info
         assert output_file_info[0]['u-k']['m3_riv'] == generated_m3_file
 
+    def test_generate_lis_inflow_float32(self):
+        """
+        Checks generating inflow file from LIS LSM in float32
+        """
+        # run main process
+        rapid_input_path, rapid_output_path, output_file_info = \
+            self._run_automatic('lis', "u-k", convert_one_hour_to_three=True,
+                                lsm_use_float32=True)
+
+        # CHECK OUTPUT
+        # m3_riv
+        m3_file_name = "m3_riv_bas_nasa_lis_3hr_20110121to20110121.nc"
+        generated_m3_file = os.path.join(rapid_output_path, m3_file_name)
+        generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+        with Dataset(generated_m3_file) as d1, \
+                Dataset(generated_m3_file_solution) as d2:
+            np.testing.assert_allclose(d1.variables['m3_riv'][:],
+                                       d2.variables['m3_riv'][:],
+                                       rtol=1e-5)
+
     def test_generate_lis_inflow2(self):
         """
         Checks generating inflow file from LIS LSM manually
@@ -699,6 +966,150 @@ class TestRAPIDInflow(unittest.TestCase):
         # check output file info
         assert output_file_info[0]['x-x']['m3_riv'] == generated_m3_file
 
+    def test_generate_erai_t511_24_inflow_incremental(self):
+        """
+        Checks adding to an inflow file from ERA Interim t511 24hr LSM
+        """
+        lsm_file_list = sorted(glob(os.path.join(self.LSM_INPUT_DATA_PATH, 'erai24', '*.nc')))
+        lsm_incremental_path = os.path.join(self.OUTPUT_DATA_PATH, "output", "lsm_incremental")
+        try:
+            os.makedirs(lsm_incremental_path)
+        except OSError:
+            pass
+
+        # generate the inflow from the first file
+        copy(lsm_file_list[0], lsm_incremental_path)
+        rapid_input_path, rapid_output_path, output_file_info = \
+            self._run_automatic(lsm_incremental_path, "x-x",
+                                expected_time_step=24*3600,
+                                incremental_inflow=True)
+        first_m3_file = output_file_info[0]['x-x']['m3_riv']
+
+        # add the inflow from the rest of the files
+        for lsm_file in lsm_file_list[1:]:
+            copy(lsm_file, lsm_incremental_path)
+        rapid_input_path, rapid_output_path, output_file_info = \
+            self._run_automatic(lsm_incremental_path, "x-x",
+                                incremental_inflow=True)
+
+        # CHECK OUTPUT
+        # m3_riv
+        m3_file_name = "m3_riv_bas_erai_t511_24hr_19990109to19990110.nc"
+        generated_m3_file = os.path.join(rapid_output_path, m3_file_name)
+        generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+        self._compare_m3(generated_m3_file,generated_m3_file_solution)
+        assert output_file_info[0]['x-x']['m3_riv'] == generated_m3_file
+        assert not os.path.exists(first_m3_file)
+
+    def test_generate_erai_t511_24_inflow_resume(self):
+        """
+        Checks resuming an inflow file from ERA Interim t511 24hr LSM
+        """
+        rapid_input_path, rapid_output_path, output_file_info = self._run_automatic('erai24', "x-x")
+        generated_m3_file = output_file_info[0]['x-x']['m3_riv']
+        manifest_file = get_inflow_manifest_file(generated_m3_file)
+
+        # remove the inflow after the first file as if the run stopped
+        with open(manifest_file) as manifest:
+            manifest_lines = manifest.readlines()
+        assert len(manifest_lines) == 2
+        with open(manifest_file, 'w') as manifest:
+            manifest.write(manifest_lines[0])
+        with Dataset(generated_m3_file, 'a') as m3_nc:
+            m3_nc.variables['m3_riv'][1:] = 0
+
+        rapid_input_path, rapid_output_path, output_file_info = \
+            self._run_automatic('erai24', "x-x", resume_inflow=True)
+
+        # CHECK OUTPUT
+        # m3_riv
+        m3_file_name = "m3_riv_bas_erai_t511_24hr_19990109to19990110.nc"
+        generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+        self._compare_m3(generated_m3_file,generated_m3_file_solution)
+        with open(manifest_file) as manifest:
+            assert len(manifest.readlines()) == 2
+
+    def test_generate_erai_t511_24_inflow_lsm_manifest(self):
+        """
+        Checks generating inflow file from ERA Interim t511 24hr LSM
+        with the LSM file manifest written and reused
+        """
+        lsm_manifest_file = os.path.join(self.OUTPUT_DATA_PATH, "input", "lsm_manifest.json")
+        m3_file_name = "m3_riv_bas_erai_t511_24hr_19990109to19990110.nc"
+        generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+        for _ in range(2):
+            rapid_input_path, rapid_output_path, output_file_info = \
+                self._run_automatic('erai24', "x-x",
+                                    lsm_manifest_file=lsm_manifest_file)
+            assert os.path.exists(lsm_manifest_file)
+
+            # CHECK OUTPUT
+            # m3_riv
+            generated_m3_file = os.path.join(rapid_output_path, m3_file_name)
+            self._compare_m3(generated_m3_file,generated_m3_file_solution)
+            os.remove(generated_m3_file)
+
+    def test_generate_erai_t511_24_inflow_parallel_ensembles(self):
+        """
+        Checks generating inflow files from ERA Interim t511 24hr LSM
+        for ensembles in parallel
+        """
+        rapid_input_path, rapid_output_path = self._setup_automated("x-x")
+        lsm_ensemble_path = os.path.join(self.OUTPUT_DATA_PATH, "output", "lsm_ensembles")
+        os.mkdir(lsm_ensemble_path)
+        for lsm_file in glob(os.path.join(self.LSM_INPUT_DATA_PATH, 'erai24', '*.nc')):
+            for ensemble in (1, 2):
+                copy(lsm_file,
+                     os.path.join(lsm_ensemble_path,
+                                  "{0}_{1}.nc".format(os.path.basename(lsm_file)[:-3],
+                                                      ensemble)))
+
+        output_file_info = run_lsm_rapid_process(
+            rapid_executable_location=RAPID_EXE_PATH,
+            cygwin_bin_location=self.CYGWIN_BIN_PATH,
+            rapid_io_files_location=self.OUTPUT_DATA_PATH,
+            lsm_data_location=lsm_ensemble_path,
+            simulation_start_datetime=datetime(1980, 1, 1),
+            simulation_end_datetime=datetime(2014, 12, 31),
+            ensemble_list=[1, 2],
+            generate_rapid_namelist_file=False,
+            run_rapid_simulation=False,
+            use_all_processors=True,
+            num_parallel_ensembles=2,
+        )
+        assert [info['ensemble'] for info in output_file_info] == [1, 2]
+
+        # CHECK OUTPUT
+        # m3_riv
+        m3_file_name = "m3_riv_bas_erai_t511_24hr_19990109to19990110.nc"
+        generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+        for ensemble in (1, 2):
+            generated_m3_file = os.path.join(rapid_output_path,
+                                             "{0}_{1}.nc".format(m3_file_name[:-3], ensemble))
+            self._compare_m3(generated_m3_file,generated_m3_file_solution)
+
+    def test_generate_erai_t511_24_inflow_single_pass(self):
+        """
+        Checks generating inflow files from ERA Interim t511 24hr LSM
+        for multiple watersheds in one pass
+        """
+        self._setup_automated("x-x")
+        copytree(os.path.join(self.COMPARE_DATA_PATH, "gis", "x-x"),
+                 os.path.join(self.RAPID_DATA_PATH, "x-x-copy"))
+
+        # run main process
+        rapid_input_path, rapid_output_path, output_file_info = \
+            self._run_automatic('erai24', "x-x",
+                                single_pass_multi_watershed=True)
+
+        # CHECK OUTPUT
+        m3_file_name = "m3_riv_bas_erai_t511_24hr_19990109to19990110.nc"
+        generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+        for watershed in ("x-x", "x-x-copy"):
+            generated_m3_file = os.path.join(self.OUTPUT_DATA_PATH, "output", watershed, m3_file_name)
+            self._compare_m3(generated_m3_file, generated_m3_file_solution)
+            assert output_file_info[0][watershed]['m3_riv'] == generated_m3_file
+
     def test_generate_erai_t511_24_inflow2(self):
         """
         Checks generating inflow file from ERA Interim t511 24hr LSM manually
@@ -832,3 +1243,95 @@ class TestRAPIDInflow(unittest.TestCase):
         self._compare_m3(generated_m3_file,generated_m3_file_solution)
         # check output file info
         assert output_file_info[0]['mendocino']['m3_riv'] == generated_m3_file
+
+    def test_generate_era5_inflow_three_hourly_inflow_time_step(self):
+        """
+        Checks generating inflow file from ERA5 LSM summed to the
+        inflow time step as it is written.
+        """
+        rapid_input_path, rapid_output_path, output_file_info = \
+            self._run_automatic("era5", "mendocino",
+                                file_datetime_pattern="%Y%m%d",
+                                file_datetime_re_pattern=r'\d{8}',
+                                single_run=True, filter_dates=False,
+                                inflow_time_step=3*3600)
+
+        # CHECK OUTPUT
+        # m3_riv
+        m3_file_name = "m3_riv_bas_era5_era5_3hr_20190101to20190101.nc"
+        generated_m3_file = os.path.join(rapid_output_path, m3_file_name)
+        generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+        with Dataset(generated_m3_file) as d1, \
+                Dataset(generated_m3_file_solution) as d2:
+            np.testing.assert_allclose(d1.variables['m3_riv'][:],
+                                       d2.variables['m3_riv'][:],
+                                       rtol=1e-5, atol=1e-4)
+            assert_almost_equal(d1.variables['time'][:], d2.variables['time'][:])
+
+    def test_generate_era5_inflow_three_hourly_time_blocks(self):
+        """
+        Checks generating inflow file from ERA5 LSM in blocks of time.
+        """
+        rapid_input_path, rapid_output_path, output_file_info = \
+            self._run_automatic("era5", "mendocino",
+                                file_datetime_pattern="%Y%m%d",
+                                file_datetime_re_pattern=r'\d{8}',
+                                convert_one_hour_to_three=True,
+                                single_run=True, filter_dates=False,
+                                lsm_time_block_size=4)
+
+        # CHECK OUTPUT
+        # m3_riv
+        m3_file_name = "m3_riv_bas_era5_era5_3hr_20190101to20190101.nc"
+        generated_m3_file = os.path.join(rapid_output_path, m3_file_name)
+        generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+        self._compare_m3(generated_m3_file,generated_m3_file_solution)
+
+    def test_generate_era5_inflow_three_hourly_netcdf4(self):
+        """
+        Checks generating a chunked and compressed NETCDF4 inflow file
+        from ERA5 LSM.
+        """
+        rapid_input_path, rapid_output_path, output_file_info = \
+            self._run_automatic("era5", "mendocino",
+                                file_datetime_pattern="%Y%m%d",
+                                file_datetime_re_pattern=r'\d{8}',
+                                convert_one_hour_to_three=True,
+                                single_run=True, filter_dates=False,
+                                lsm_time_block_size=3,
+                                inflow_file_format="NETCDF4",
+                                inflow_chunksizes=(2, 50))
+
+        # CHECK OUTPUT
+        # m3_riv
+        m3_file_name = "m3_riv_bas_era5_era5_3hr_20190101to20190101.nc"
+        generated_m3_file = os.path.join(rapid_output_path, m3_file_name)
+        generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+        self._compare_m3(generated_m3_file,generated_m3_file_solution)
+        with Dataset(generated_m3_file) as d1:
+            assert d1.data_model == "NETCDF4"
+            m3_riv_var = d1.variables['m3_riv']
+            assert m3_riv_var.chunking()[0] == 2
+            assert m3_riv_var.filters()['zlib']
+            assert m3_riv_var.filters()['shuffle']
+
+    def test_generate_era5_inflow_three_hourly_read_ahead(self):
+        """
+        Checks generating inflow file from ERA5 LSM reading the
+        blocks of time ahead in a thread.
+        """
+        rapid_input_path, rapid_output_path, output_file_info = \
+            self._run_automatic("era5", "mendocino",
+                                file_datetime_pattern="%Y%m%d",
+                                file_datetime_re_pattern=r'\d{8}',
+                                convert_one_hour_to_three=True,
+                                single_run=True, filter_dates=False,
+                                lsm_time_block_size=4,
+                                lsm_read_ahead_blocks=2)
+
+        # CHECK OUTPUT
+        # m3_riv
+        m3_file_name = "m3_riv_bas_era5_era5_3hr_20190101to20190101.nc"
+        generated_m3_file = os.path.join(rapid_output_path, m3_file_name)
+        generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+        self._compare_m3(generated_m3_file,generated_m3_file_solution)
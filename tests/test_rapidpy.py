@@ -10,21 +10,31 @@
 from datetime import datetime
 from filecmp import cmp as fcmp
 from netCDF4 import Dataset
+from numpy.testing import assert_almost_equal
+import numpy as np
 import os
 from pytz import timezone
-from shutil import copy
+from shutil import copy, rmtree
 import pytest
+import sys
+import time
 
 #local import
 from RAPIDpy import RAPID
 from RAPIDpy import RAPIDDataset
+from RAPIDpy.cache import RAPIDResultCache
 from RAPIDpy.dataset import compare_qout_files
+from RAPIDpy.decomposition import (decompose_rapid_input_directory,
+                                   run_rapid_groups)
 from RAPIDpy.helper_functions import (compare_csv_decimal_files,
                                       compare_csv_timeseries_files,
                                       remove_files)
 
 from RAPIDpy.postprocess import find_goodness_of_fit, find_goodness_of_fit_csv
 from RAPIDpy.postprocess import ConvertRAPIDOutputToCF
+from RAPIDpy.routing import MuskingumRouting
+from RAPIDpy.scheduler import RAPIDScheduler, get_rapid_num_processors
+from RAPIDpy.utilities import size_partition
 
 #GLOBAL VARIABLES
 MAIN_TESTS_FOLDER = os.path.dirname(os.path.abspath(__file__))
@@ -314,6 +324,453 @@ def test_run_rapid_simulation():
 
     remove_files(generated_qout_file)
 
+def test_run_muskingum_simulation():
+    """
+    Test Running Muskingum Simulation without RAPID
+    """
+
+    print("TEST 7.1: TEST RUNNING MUSKINGUM SIMULATION")
+    generated_qout_file = os.path.join(OUTPUT_DATA_PATH, 'Qout_nasa_lis_3hr_20020830_muskingum.nc')
+
+    rapid_manager = RAPID(rapid_connect_file=os.path.join(INPUT_DATA_PATH, 'rapid_connect.csv'),
+                          riv_bas_id_file=os.path.join(INPUT_DATA_PATH, 'riv_bas_id.csv'),
+                          Vlat_file=os.path.join(INPUT_DATA_PATH, 'm3_nasa_lis_3hr_20020830.nc'),
+                          k_file=os.path.join(INPUT_DATA_PATH, 'k.csv'),
+                          x_file=os.path.join(INPUT_DATA_PATH, 'x.csv'),
+                          ZS_dtM=10800,
+                          ZS_dtR=900,
+                          ZS_TauM=2*86400,
+                          ZS_TauR=10800,
+                          Qout_file=generated_qout_file
+                         )
+    rapid_manager.run_muskingum()
+
+    generated_qout_file_solution = os.path.join(COMPARE_DATA_PATH,
+                                                'Qout_nasa_lis_3hr_20020830.nc')
+
+    #check Qout
+    assert (compare_qout_files(generated_qout_file, generated_qout_file_solution))
+    with RAPIDDataset(generated_qout_file) as qout_nc, \
+            RAPIDDataset(generated_qout_file_solution) as qout_nc_solution:
+        assert_almost_equal(qout_nc.get_qout(), qout_nc_solution.get_qout(), decimal=3)
+
+    remove_files(generated_qout_file)
+
+def test_run_muskingum_ensemble_simulation():
+    """
+    Test Running Muskingum Simulation of an Ensemble without RAPID
+    """
+
+    print("TEST 7.2: TEST RUNNING MUSKINGUM ENSEMBLE SIMULATION")
+    generated_qout_file = os.path.join(OUTPUT_DATA_PATH, 'Qout_nasa_lis_3hr_20020830_muskingum_ensemble.nc')
+    vlat_file = os.path.join(INPUT_DATA_PATH, 'm3_nasa_lis_3hr_20020830.nc')
+
+    rapid_manager = RAPID(rapid_connect_file=os.path.join(INPUT_DATA_PATH, 'rapid_connect.csv'),
+                          riv_bas_id_file=os.path.join(INPUT_DATA_PATH, 'riv_bas_id.csv'),
+                          k_file=os.path.join(INPUT_DATA_PATH, 'k.csv'),
+                          x_file=os.path.join(INPUT_DATA_PATH, 'x.csv'),
+                          ZS_dtR=900,
+                          ZS_TauR=10800,
+                          Qout_file=generated_qout_file
+                         )
+    rapid_manager.run_muskingum(vlat_file_list=[vlat_file, vlat_file])
+
+    generated_qout_file_solution = os.path.join(COMPARE_DATA_PATH,
+                                                'Qout_nasa_lis_3hr_20020830.nc')
+
+    with Dataset(generated_qout_file) as qout_nc, \
+            RAPIDDataset(generated_qout_file_solution) as qout_nc_solution:
+        qout_var = qout_nc.variables['Qout']
+        assert qout_var.dimensions == ('time', 'rivid', 'member')
+        qout_solution = qout_nc_solution.get_qout().T
+        for member_index in range(2):
+            assert_almost_equal(qout_var[:, :, member_index], qout_solution, decimal=3)
+
+    remove_files(generated_qout_file)
+
+def test_muskingum_level_schedule():
+    """
+    Test the topological levels of the Muskingum routing network
+    """
+    print("TEST 7.3: TEST MUSKINGUM LEVEL SCHEDULE")
+    muskingum_routing = MuskingumRouting(
+        rapid_connect_file=os.path.join(INPUT_DATA_PATH, 'rapid_connect.csv'),
+        riv_bas_id_file=os.path.join(INPUT_DATA_PATH, 'riv_bas_id.csv'),
+        k_file=os.path.join(INPUT_DATA_PATH, 'k.csv'),
+        x_file=os.path.join(INPUT_DATA_PATH, 'x.csv'))
+
+    river_level_array = muskingum_routing.river_level_array
+    downstream_index_array = muskingum_routing.downstream_index_array
+    has_downstream = downstream_index_array >= 0
+    # every river is below all of the rivers upstream
+    assert (river_level_array[downstream_index_array[has_downstream]] >
+            river_level_array[has_downstream]).all()
+    assert len(muskingum_routing.level_schedule) == river_level_array.max()
+    num_connections = 0
+    for level, (level_downstream_index_array, upstream_index_array, _) in \
+            enumerate(muskingum_routing.level_schedule, 1):
+        assert (river_level_array[level_downstream_index_array] == level).all()
+        num_connections += upstream_index_array.size
+    assert num_connections == has_downstream.sum()
+
+def test_run_muskingum_decomposed_simulation():
+    """
+    Test Running Muskingum Simulation of a Network divided into groups
+    """
+    print("TEST 7.4: TEST RUNNING MUSKINGUM DECOMPOSED SIMULATION")
+    decomposition_path = os.path.join(OUTPUT_DATA_PATH, 'decomposition')
+    os.makedirs(decomposition_path)
+    group_input_directory_list = \
+        decompose_rapid_input_directory(INPUT_DATA_PATH, decomposition_path, 3)
+    assert len(group_input_directory_list) == 3
+
+    rapid_connect_table = np.loadtxt(os.path.join(INPUT_DATA_PATH, 'rapid_connect.csv'),
+                                     delimiter=",", dtype=int)
+    with Dataset(os.path.join(INPUT_DATA_PATH, 'm3_nasa_lis_3hr_20020830.nc')) as m3_nc:
+        m3_riv = m3_nc.variables['m3_riv'][:]
+
+    # the m3 file of each group in the order of its rapid_connect file
+    group_vlat_file_list = []
+    for group_input_directory in group_input_directory_list:
+        group_rapid_connect_table = \
+            np.loadtxt(os.path.join(group_input_directory, 'rapid_connect.csv'),
+                       delimiter=",", dtype=int, ndmin=2)
+        # the rivers downstream are in the group or outside the network
+        downstream_id_array = group_rapid_connect_table[:, 1]
+        downstream_id_array = downstream_id_array[
+            ~np.isin(downstream_id_array, group_rapid_connect_table[:, 0])]
+        assert not np.isin(downstream_id_array, rapid_connect_table[:, 0]).any()
+        group_river_index = [np.where(rapid_connect_table[:, 0] == river_id)[0][0]
+                             for river_id in group_rapid_connect_table[:, 0]]
+        group_vlat_file = os.path.join(group_input_directory, 'm3_riv.nc')
+        with Dataset(group_vlat_file, 'w') as m3_nc:
+            m3_nc.createDimension('time', m3_riv.shape[0])
+            m3_nc.createDimension('rivid', len(group_river_index))
+            m3_nc.createVariable('m3_riv', 'f4', ('time', 'rivid'))[:] = \
+                m3_riv[:, group_river_index]
+            m3_nc.createVariable('rivid', 'i4', ('rivid',))[:] = \
+                group_rapid_connect_table[:, 0]
+        group_vlat_file_list.append(group_vlat_file)
+
+    # the input files of the groups are found ignoring case
+    for file_name in ('riv_bas_id.csv', 'k.csv', 'x.csv'):
+        os.rename(os.path.join(group_input_directory_list[0], file_name),
+                  os.path.join(group_input_directory_list[0], file_name.upper()))
+
+    generated_qout_file = os.path.join(decomposition_path, 'Qout_nasa_lis_3hr_20020830_decomposed.nc')
+    rapid_manager = RAPID(rapid_connect_file=os.path.join(INPUT_DATA_PATH, 'rapid_connect.csv'),
+                          riv_bas_id_file=os.path.join(INPUT_DATA_PATH, 'riv_bas_id.csv'),
+                          ZS_dtR=900,
+                          ZS_TauR=10800,
+                          Qout_file=generated_qout_file
+                         )
+    run_rapid_groups(rapid_manager, group_input_directory_list,
+                     group_vlat_file_list, num_processes=2, muskingum=True)
+
+    generated_qout_file_solution = os.path.join(COMPARE_DATA_PATH,
+                                                'Qout_nasa_lis_3hr_20020830.nc')
+    with RAPIDDataset(generated_qout_file) as qout_nc, \
+            RAPIDDataset(generated_qout_file_solution) as qout_nc_solution:
+        assert (qout_nc.get_river_id_array() == qout_nc_solution.get_river_id_array()).all()
+        assert_almost_equal(qout_nc.get_qout(), qout_nc_solution.get_qout(), decimal=3)
+    os.remove(generated_qout_file)
+
+    if os.name != "nt":
+        # the RAPID program with relative paths and a fake RAPID
+        # routing with MuskingumRouting from the rapid_namelist file
+        fake_rapid_exe = os.path.join(decomposition_path, 'fake_rapid.py')
+        with open(fake_rapid_exe, 'w') as fake_rapid:
+            fake_rapid.write(
+                "#!{0}\n"
+                "import re, sys\n"
+                "sys.path.insert(0, {1!r})\n"
+                "from RAPIDpy.routing import MuskingumRouting\n"
+                "with open('rapid_namelist') as namelist_file:\n"
+                "    nl = dict(re.findall(r\"^(\\w+) = '?([^'\\n]*)'?$\",\n"
+                "                         namelist_file.read(), re.M))\n"
+                "MuskingumRouting(nl['rapid_connect_file'], nl['riv_bas_id_file'],\n"
+                "                 nl['k_file'], nl['x_file']).route(\n"
+                "    nl['Vlat_file'], nl['Qout_file'], int(nl['ZS_dtR']),\n"
+                "    int(nl['ZS_TauR']))\n"
+                .format(sys.executable,
+                        os.path.dirname(MAIN_TESTS_FOLDER)))
+        os.chmod(fake_rapid_exe, 0o755)
+
+        original_directory = os.getcwd()
+        os.chdir(OUTPUT_DATA_PATH)
+        try:
+            rapid_manager = RAPID(
+                rapid_executable_location=fake_rapid_exe,
+                num_processors=2,
+                rapid_connect_file=os.path.relpath(os.path.join(INPUT_DATA_PATH, 'rapid_connect.csv')),
+                riv_bas_id_file=os.path.relpath(os.path.join(INPUT_DATA_PATH, 'riv_bas_id.csv')),
+                ZS_dtR=900,
+                ZS_TauR=10800,
+                Qout_file=os.path.relpath(generated_qout_file))
+            run_rapid_groups(
+                rapid_manager,
+                [os.path.relpath(group_input_directory)
+                 for group_input_directory in group_input_directory_list],
+                [os.path.relpath(group_vlat_file)
+                 for group_vlat_file in group_vlat_file_list])
+        finally:
+            os.chdir(original_directory)
+
+        with RAPIDDataset(generated_qout_file) as qout_nc, \
+                RAPIDDataset(generated_qout_file_solution) as qout_nc_solution:
+            assert_almost_equal(qout_nc.get_qout(), qout_nc_solution.get_qout(), decimal=3)
+
+    rmtree(decomposition_path)
+
+def test_rapid_scheduler():
+    """
+    Test dividing the processors among RAPID simulations
+    """
+    print("TEST 7.5: TEST RAPID SCHEDULER")
+    assert get_rapid_num_processors([1000000, 10000, 5], 64) == [63, 1, 1]
+    assert get_rapid_num_processors([300, 100, 50, 50], 4) == [2, 1, 1, 1]
+    assert get_rapid_num_processors([2, 0], 8) == [2, 1]
+
+    # a failed simulation is raised after the others finish
+    rapid_scheduler = RAPIDScheduler(num_processors=2,
+                                     working_directory=OUTPUT_DATA_PATH)
+    finished_list = []
+    for _ in range(3):
+        rapid_scheduler.add_run(RAPID(IS_riv_bas=10),
+                                finished_callback=finished_list.append)
+    with pytest.raises(Exception):
+        rapid_scheduler.run()
+    assert not finished_list
+    assert not [directory for directory in os.listdir(OUTPUT_DATA_PATH)
+                if directory.startswith('rapid_')]
+
+@pytest.mark.skipif(os.name == "nt", reason='Uses a shell script as RAPID')
+def test_rapid_scheduler_relative_paths():
+    """
+    Test running RAPID simulations with relative paths in the scheduler
+    """
+    print("TEST 7.5.1: TEST RAPID SCHEDULER WITH RELATIVE PATHS")
+    fake_rapid_exe = os.path.join(OUTPUT_DATA_PATH, 'fake_rapid.sh')
+    with open(fake_rapid_exe, 'w') as fake_rapid:
+        fake_rapid.write(
+            "#!/bin/sh\n"
+            "vlat=$(sed -n \"s/^Vlat_file = '\\(.*\\)'$/\\1/p\" rapid_namelist)\n"
+            "qout=$(sed -n \"s/^Qout_file = '\\(.*\\)'$/\\1/p\" rapid_namelist)\n"
+            "test -f \"$vlat\" || { echo \"missing $vlat\" >&2; exit 1; }\n"
+            "cp \"$vlat\" \"$qout\"\n")
+    os.chmod(fake_rapid_exe, 0o755)
+
+    original_directory = os.getcwd()
+    os.chdir(MAIN_TESTS_FOLDER)
+    try:
+        rapid_scheduler = RAPIDScheduler(num_processors=1,
+                                         working_directory=OUTPUT_DATA_PATH)
+        qout_file_list = []
+        finished_list = []
+
+        def finished_callback(rapid_manager):
+            assert os.path.exists(rapid_manager.Qout_file)
+            finished_list.append(rapid_manager.Qout_file)
+            if os.path.abspath(rapid_manager.Qout_file) == \
+                    os.path.abspath(qout_file_list[0]):
+                # the other simulations run during the first callback
+                for _ in range(200):
+                    if os.path.exists(qout_file_list[-1]):
+                        break
+                    time.sleep(0.1)
+                assert os.path.exists(qout_file_list[-1])
+
+        for run_index in range(3):
+            qout_file = os.path.join('output',
+                                     'Qout_scheduler_{0}.nc'.format(run_index))
+            qout_file_list.append(qout_file)
+            rapid_scheduler.add_run(
+                RAPID(rapid_executable_location=fake_rapid_exe,
+                      IS_riv_bas=10,
+                      Vlat_file=os.path.join('data',
+                                             'm3_nasa_lis_3hr_20020830.nc'),
+                      Qout_file=qout_file),
+                finished_callback=finished_callback)
+        remove_files(*qout_file_list)
+        rapid_scheduler.run()
+        assert len(finished_list) == 3
+        for qout_file in qout_file_list:
+            assert fcmp(qout_file,
+                        os.path.join('data', 'm3_nasa_lis_3hr_20020830.nc'),
+                        shallow=False)
+        remove_files(*qout_file_list)
+    finally:
+        os.chdir(original_directory)
+    os.remove(fake_rapid_exe)
+
+@pytest.mark.skipif(os.name == "nt", reason='Uses a shell script as RAPID')
+def test_run_rapid_output_stream():
+    """
+    Test reading the RAPID output while it runs
+    """
+    print("TEST 7.6: TEST RAPID OUTPUT STREAM")
+    fake_rapid_exe = os.path.join(OUTPUT_DATA_PATH, 'fake_rapid.sh')
+
+    def write_fake_rapid(script_lines):
+        with open(fake_rapid_exe, 'w') as fake_rapid:
+            fake_rapid.write("#!/bin/sh\n" + "\n".join(script_lines) + "\n")
+        os.chmod(fake_rapid_exe, 0o755)
+
+    rapid_manager = RAPID(rapid_executable_location=fake_rapid_exe,
+                          ZS_TauM=3*10800,
+                          ZS_TauR=10800)
+
+    # progress of the time steps
+    write_fake_rapid(["for step in 1 2 3; do echo \"Time step: $step\"; done"])
+    progress_list = []
+    rapid_manager.run(working_directory=OUTPUT_DATA_PATH,
+                      progress_callback=lambda time_step, num_time_steps:
+                      progress_list.append((time_step, num_time_steps)))
+    assert progress_list == [(1, 3), (2, 3), (3, 3)]
+
+    # errors stop RAPID before it finishes
+    write_fake_rapid(["echo '[0]PETSC ERROR: Out of memory' >&2",
+                      "sleep 30"])
+    time_start = datetime.utcnow()
+    with pytest.raises(Exception) as ex:
+        rapid_manager.run(working_directory=OUTPUT_DATA_PATH)
+    assert "PETSC ERROR" in str(ex.value)
+    assert (datetime.utcnow() - time_start).total_seconds() < 20
+
+    write_fake_rapid(["sleep 30"])
+    time_start = datetime.utcnow()
+    with pytest.raises(Exception) as ex:
+        rapid_manager.run(working_directory=OUTPUT_DATA_PATH, timeout=1)
+    assert "did not finish" in str(ex.value)
+    assert (datetime.utcnow() - time_start).total_seconds() < 20
+
+    # any output to stderr is an error
+    write_fake_rapid(["echo 'warning' >&2"])
+    with pytest.raises(Exception):
+        rapid_manager.run(working_directory=OUTPUT_DATA_PATH)
+
+    # so is exiting with an error code
+    write_fake_rapid(["echo 'Time step: 1'", "exit 3"])
+    with pytest.raises(Exception) as ex:
+        rapid_manager.run(working_directory=OUTPUT_DATA_PATH)
+    assert "code 3" in str(ex.value)
+
+    assert not os.path.exists(os.path.join(OUTPUT_DATA_PATH,
+                                           'rapid_namelist'))
+    os.remove(fake_rapid_exe)
+
+@pytest.mark.skipif(os.name == "nt", reason='Uses a shell script as RAPID')
+def test_rapid_result_cache():
+    """
+    Test copying the RAPID output from the cache
+    """
+    print("TEST 7.7: TEST RAPID RESULT CACHE")
+    cache_path = os.path.join(OUTPUT_DATA_PATH, 'rapid_cache')
+    input_qout_file = os.path.join(COMPARE_DATA_PATH,
+                                   'Qout_nasa_lis_3hr_20020830.nc')
+    generated_qout_file = os.path.join(OUTPUT_DATA_PATH,
+                                       'Qout_nasa_lis_3hr_20020830_cache.nc')
+    run_log_file = os.path.join(OUTPUT_DATA_PATH, 'fake_rapid_runs.txt')
+    fake_rapid_exe = os.path.join(OUTPUT_DATA_PATH, 'fake_rapid.sh')
+    with open(fake_rapid_exe, 'w') as fake_rapid:
+        fake_rapid.write("#!/bin/sh\ncp {0} {1}\necho run >> {2}\n"
+                         .format(input_qout_file, generated_qout_file,
+                                 run_log_file))
+    os.chmod(fake_rapid_exe, 0o755)
+    k_file = os.path.join(OUTPUT_DATA_PATH, 'k_cache.csv')
+    copy(os.path.join(INPUT_DATA_PATH, 'k.csv'), k_file)
+
+    def get_num_runs():
+        with open(run_log_file) as run_log:
+            return len(run_log.readlines())
+
+    rapid_manager = RAPID(rapid_executable_location=fake_rapid_exe,
+                          rapid_connect_file=os.path.join(INPUT_DATA_PATH, 'rapid_connect.csv'),
+                          riv_bas_id_file=os.path.join(INPUT_DATA_PATH, 'riv_bas_id.csv'),
+                          Vlat_file=os.path.join(INPUT_DATA_PATH, 'm3_nasa_lis_3hr_20020830.nc'),
+                          k_file=k_file,
+                          x_file=os.path.join(INPUT_DATA_PATH, 'x.csv'),
+                          ZS_dtM=10800,
+                          ZS_dtR=900,
+                          ZS_TauM=2*86400,
+                          ZS_TauR=10800,
+                          Qout_file=generated_qout_file)
+    rapid_cache = RAPIDResultCache(cache_path)
+    assert not rapid_cache.run(rapid_manager,
+                               working_directory=OUTPUT_DATA_PATH)
+    os.remove(generated_qout_file)
+    assert rapid_cache.run(rapid_manager, working_directory=OUTPUT_DATA_PATH)
+    assert get_num_runs() == 1
+    assert fcmp(generated_qout_file, input_qout_file, shallow=False)
+
+    # converting to CF replaces the output without changing the cache
+    for cache_hit in (False, True):
+        assert rapid_cache.run(rapid_manager,
+                               working_directory=OUTPUT_DATA_PATH)
+        assert rapid_cache.make_output_cf_compliant(
+            rapid_manager,
+            simulation_start_datetime=datetime(2002, 8, 30),
+            project_name="ERA Interim (T511 Grid) 3 Hourly Runoff Based "
+                         "Historical flows by US Army ERDC") == cache_hit
+        assert (compare_qout_files(
+            generated_qout_file,
+            os.path.join(COMPARE_DATA_PATH,
+                         'Qout_nasa_lis_3hr_20020830_CF_no_lat_lon_z.nc')))
+    assert get_num_runs() == 1
+
+    # changed inputs run RAPID again
+    with open(k_file, 'a') as k_csv:
+        k_csv.write("1000\n")
+    assert not rapid_cache.run(rapid_manager,
+                               working_directory=OUTPUT_DATA_PATH)
+    assert get_num_runs() == 2
+    assert len(os.listdir(cache_path)) == 3
+
+    # least recently used simulations are removed
+    rapid_cache.max_size = os.path.getsize(input_qout_file)
+    rapid_cache.evict()
+    assert len(os.listdir(cache_path)) == 1
+    assert rapid_cache.run(rapid_manager, working_directory=OUTPUT_DATA_PATH)
+
+    rmtree(cache_path)
+    remove_files(generated_qout_file, run_log_file, fake_rapid_exe, k_file)
+
+@pytest.mark.skipif(os.name == "nt", reason='Uses a shell script as RAPID')
+def test_rapid_result_cache_same_output_file():
+    """
+    Test running different simulations to the same output file
+    does not change the cache
+    """
+    print("TEST 7.8: TEST RAPID RESULT CACHE WITH THE SAME OUTPUT FILE")
+    cache_path = os.path.join(OUTPUT_DATA_PATH, 'rapid_cache')
+    generated_qout_file = os.path.join(OUTPUT_DATA_PATH, 'Qout_cache.nc')
+    k_file = os.path.join(OUTPUT_DATA_PATH, 'k_cache.csv')
+    fake_rapid_exe = os.path.join(OUTPUT_DATA_PATH, 'fake_rapid.sh')
+    # writes into the existing output file like RAPID
+    with open(fake_rapid_exe, 'w') as fake_rapid:
+        fake_rapid.write("#!/bin/sh\ncat {0} > {1}\n"
+                         .format(k_file, generated_qout_file))
+    os.chmod(fake_rapid_exe, 0o755)
+
+    rapid_manager = RAPID(rapid_executable_location=fake_rapid_exe,
+                          k_file=k_file,
+                          Qout_file=generated_qout_file)
+    rapid_cache = RAPIDResultCache(cache_path)
+    for k_value in ("1000\n", "2000\n"):
+        with open(k_file, 'w') as k_csv:
+            k_csv.write(k_value)
+        assert not rapid_cache.run(rapid_manager,
+                                   working_directory=OUTPUT_DATA_PATH)
+
+    with open(k_file, 'w') as k_csv:
+        k_csv.write("1000\n")
+    assert rapid_cache.run(rapid_manager, working_directory=OUTPUT_DATA_PATH)
+    with open(generated_qout_file) as qout_file:
+        assert qout_file.read() == "1000\n"
+
+    rmtree(cache_path)
+    remove_files(generated_qout_file, fake_rapid_exe, k_file)
+
 def test_convert_file_to_be_cf_compliant_new_format_comid_lat_lon_z():
     """
     Test Convert RAPID Output to be CF Compliant for new format with COMID_LAT_LON_Z
@@ -975,3 +1432,48 @@ def test_dataset_exceptions():
             qout_nc.write_flows_to_gssha_time_series_ihg(
                 dummy_file,
                 dummy_file)
+
+
+def test_dataset_river_index_lookup():
+    """This tests looking up the river index in RAPIDDataset"""
+    cf_input_qout_file = os.path.join(COMPARE_DATA_PATH,
+                                      'Qout_nasa_lis_3hr_20020830_CF.nc')
+    with RAPIDDataset(cf_input_qout_file) as qout_nc:
+        river_id_array = qout_nc.get_river_id_array()
+        for river_index, river_id in enumerate(river_id_array):
+            assert qout_nc.get_river_index(river_id) == river_index
+        with pytest.raises(IndexError):
+            qout_nc.get_river_index(-1)
+
+        river_id_list = [river_id_array[3], -1, river_id_array[0],
+                         river_id_array.max() + 1, river_id_array[-1]]
+        river_index_array, river_id_found_array = \
+            qout_nc.get_river_index_array(river_id_list)
+        assert (river_id_found_array == [True, False, True,
+                                         False, True]).all()
+        assert (river_index_array[river_id_found_array] ==
+                [3, 0, river_id_array.size - 1]).all()
+
+        river_index_list, valid_river_ids, missing_river_ids = \
+            qout_nc.get_subset_riverid_index_list(river_id_list)
+        assert (river_index_list == [0, 3, river_id_array.size - 1]).all()
+        assert (valid_river_ids == [river_id_array[0], river_id_array[3],
+                                    river_id_array[-1]]).all()
+        assert (missing_river_ids == [-1, river_id_array.max() + 1]).all()
+
+
+def test_size_partition():
+    """
+    Checks that the parts are contiguous, balanced by size,
+    and ordered from largest to smallest
+    """
+    lst = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']
+    part_list, part_index_list = \
+        size_partition(lst, [10, 1, 1, 1, 1, 1, 1, 20], 4)
+    assert part_list == [['h'], ['a'], ['b', 'c', 'd', 'e', 'f', 'g']]
+    assert part_index_list == [[7], [0], [1, 2, 3, 4, 5, 6]]
+
+    part_list, part_index_list = size_partition(lst, [1] * 8, 20)
+    assert sorted(part_list) == [[item] for item in lst]
+
+    assert size_partition([], [], 4) == ([], [])